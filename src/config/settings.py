@@ -15,6 +15,18 @@ DEFAULT_SETTINGS = {
     },
     "database_base_dir": str(Path(__file__).resolve().parents[2] / "databases"),
     "csv_export_base_dir": str(Path(__file__).resolve().parents[2] / "csv_exports"),
+    # Applied to every connection opened through src.data_access.connections (None skips one).
+    # The databases may sit on a shared drive, so the default is a rollback journal; WAL
+    # (shared memory, no cross-file atomic commits) is opt-in, e.g.
+    # "sqlite_pragmas": {"journal_mode": "WAL", "synchronous": "NORMAL"} in settings.json.
+    "sqlite_pragmas": {
+        "busy_timeout": 5000,
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size": -16000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
 }
 
 # --- Load Settings ---
@@ -76,12 +88,20 @@ def load_calculation_constants():
 SETTINGS = load_settings()
 CALCULATION_CONSTANTS = load_calculation_constants()
 
+_settings_reload_listeners = []
+
+def add_settings_reload_listener(callback):
+    """Registers a callable run after every reload_app_settings() (e.g. to drop pooled connections)."""
+    _settings_reload_listeners.append(callback)
+
 def reload_app_settings():
     global SETTINGS
     global CALCULATION_CONSTANTS
     SETTINGS = load_settings()
     CALCULATION_CONSTANTS = load_calculation_constants()
     print(f"DEBUG: CALCULATION_CONSTANTS loaded: {CALCULATION_CONSTANTS}")
+    for callback in _settings_reload_listeners:
+        callback()
 
 # --- Dynamic Path Getters ---
 def get_database_path(db_name: str) -> Path:
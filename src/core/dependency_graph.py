@@ -0,0 +1,98 @@
+# src/core/dependency_graph.py
+import json
+import re
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
+
+from src.core.node_engine import get_compiled_dag
+
+
+def topological_order(nodes: Iterable[Any], deps_of: Callable[[Any], Iterable[Any]]) -> Tuple[List[Any], List[Any]]:
+    """
+    Kahn's algorithm over the subgraph induced by nodes. deps_of(n) returns what n
+    depends on; dependencies outside nodes are ignored. Returns (order, cyclic) where
+    order lists dependencies before their dependents (ties keep the input order) and
+    cyclic holds the nodes that sit on, or behind, a dependency cycle.
+    """
+    nodes = list(dict.fromkeys(nodes))
+    node_set = set(nodes)
+    in_degree = {n: 0 for n in nodes}
+    dependents: Dict[Any, List[Any]] = {n: [] for n in nodes}
+    for n in nodes:
+        for d in set(deps_of(n)):
+            if d in node_set and d != n:
+                in_degree[n] += 1
+                dependents[d].append(n)
+            elif d == n:
+                in_degree[n] += 1  # self-reference can never be resolved
+
+    queue = deque(n for n in nodes if in_degree[n] == 0)
+    order = []
+    while queue:
+        n = queue.popleft()
+        order.append(n)
+        for m in dependents[n]:
+            in_degree[m] -= 1
+            if in_degree[m] == 0:
+                queue.append(m)
+
+    done = set(order)
+    return order, [n for n in nodes if n not in done]
+
+
+def _parse_formula_dependencies(spec: Dict[str, Any]) -> List[int]:
+    """KPI ids referenced by a spec's formula_json (node DAG) or legacy formula_string."""
+    formula_json = spec.get("formula_json")
+    if formula_json:
+        try:
+            dag_data = json.loads(formula_json)
+            if isinstance(dag_data, dict) and "nodes" in dag_data:
+                return [d["kpi_id"] for d in get_compiled_dag(formula_json).dependencies if d.get("kpi_id") is not None]
+        except (ValueError, TypeError, KeyError):
+            return []
+    formula_string = spec.get("formula_string")
+    if formula_string:
+        return [int(i) for i in re.findall(r'\[(\d+)\]', formula_string)]
+    return []
+
+
+class KpiDependencyGraph:
+    """
+    KPI-level dependency graph of calculated specs, built once from all specs.
+
+    Holds forward (kpi -> inputs) and reverse (kpi -> dependents) edges so that the
+    set of KPIs affected by a change and their recompute order each take one
+    O(V+E) pass, however deep formula chains go.
+    """
+
+    def __init__(self, specs: Iterable[Dict[str, Any]]):
+        self.specs: Dict[int, Dict[str, Any]] = {s["id"]: s for s in specs}
+        self.dependencies: Dict[int, List[int]] = {}
+        self.dependents: Dict[int, List[int]] = {}
+        for kid, spec in self.specs.items():
+            if not spec.get("is_calculated"): continue
+            deps = list(dict.fromkeys(_parse_formula_dependencies(spec)))
+            self.dependencies[kid] = deps
+            for d in deps:
+                self.dependents.setdefault(d, []).append(kid)
+
+    def dirty_set(self, changed_kpi_ids: Iterable[int]) -> Set[int]:
+        """The changed KPIs plus every KPI that transitively depends on one of them."""
+        dirty = set(changed_kpi_ids)
+        queue = deque(dirty)
+        while queue:
+            for dependent in self.dependents.get(queue.popleft(), []):
+                if dependent not in dirty:
+                    dirty.add(dependent)
+                    queue.append(dependent)
+        return dirty
+
+    def topological_order(self, kpi_ids: Iterable[int]) -> List[int]:
+        """
+        Orders kpi_ids so every KPI follows the KPIs it depends on. KPIs caught in a
+        cycle are appended last (their order is then arbitrary) with a warning.
+        """
+        order, cyclic = topological_order(sorted(kpi_ids), lambda k: self.dependencies.get(k, []))
+        if cyclic:
+            print(f"WARNING: Circular formula dependencies between KPIs {cyclic}; their recompute order is undefined.")
+        return order + cyclic
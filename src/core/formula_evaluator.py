@@ -0,0 +1,98 @@
+# src/core/formula_evaluator.py
+import ast
+import re
+from functools import lru_cache, reduce
+from typing import Any, Dict, List, Mapping
+
+import numpy as np
+
+_KPI_REF_PATTERN = re.compile(r'\[(\d+)\]')
+
+_ALLOWED_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_ALLOWED_UNARYOPS = (ast.UAdd, ast.USub)
+
+SCALAR_FUNCTIONS = {"abs": abs, "min": min, "max": max, "round": round}
+VECTOR_FUNCTIONS = {
+    "abs": np.abs,
+    "min": lambda *args: reduce(np.minimum, args),
+    "max": lambda *args: reduce(np.maximum, args),
+    "round": np.round,
+}
+
+
+class FormulaError(ValueError):
+    """Raised when a formula string is not a valid, whitelisted expression."""
+
+
+def _validate(node: ast.AST):
+    """Rejects anything but arithmetic on numbers, names and the whitelisted functions."""
+    if isinstance(node, ast.Expression):
+        _validate(node.body)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, _ALLOWED_BINOPS):
+        _validate(node.left)
+        _validate(node.right)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, _ALLOWED_UNARYOPS):
+        _validate(node.operand)
+    elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        pass
+    elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+        if node.id.startswith("__"):
+            raise FormulaError(f"Name '{node.id}' is not allowed")
+    elif isinstance(node, ast.Call):
+        if not (isinstance(node.func, ast.Name) and node.func.id in SCALAR_FUNCTIONS) or node.keywords:
+            raise FormulaError(f"Only {sorted(SCALAR_FUNCTIONS)} calls are allowed")
+        for arg in node.args:
+            _validate(arg)
+    else:
+        raise FormulaError(f"Unsupported expression element: {type(node).__name__}")
+
+
+class CompiledFormula:
+    """
+    A legacy formula parsed once into validated Python bytecode.
+
+    [ID] references read the value mapping's 'kpi_ID' entry and default to 0 when
+    missing; any other name must be present in the mapping. Values may be floats or
+    NumPy arrays (pass vectorized=True to get element-wise min/max/abs/round).
+    """
+
+    def __init__(self, formula: str):
+        self.formula = formula
+        self.kpi_ids: List[int] = list(dict.fromkeys(int(i) for i in _KPI_REF_PATTERN.findall(formula)))
+        processed = _KPI_REF_PATTERN.sub(r'kpi_\1', formula)
+        try:
+            tree = ast.parse(processed.strip(), mode="eval")
+        except SyntaxError as e:
+            raise FormulaError(f"Invalid formula '{formula}': {e.msg}") from None
+        _validate(tree)
+        self.names = sorted({n.id for n in ast.walk(tree) if isinstance(n, ast.Name)} - set(SCALAR_FUNCTIONS))
+        self._code = compile(tree, "<formula>", "eval")
+
+    def __call__(self, values: Mapping[str, Any], vectorized: bool = False):
+        namespace: Dict[str, Any] = {f"kpi_{kid}": 0.0 for kid in self.kpi_ids}
+        namespace.update(values)
+        namespace.update(VECTOR_FUNCTIONS if vectorized else SCALAR_FUNCTIONS)
+        return eval(self._code, {"__builtins__": {}}, namespace)
+
+
+@lru_cache(maxsize=1024)
+def compile_formula(formula: str) -> CompiledFormula:
+    """Returns the cached compiled form of a formula string (raises FormulaError if invalid)."""
+    return CompiledFormula(formula)
+
+
+def evaluate_formula(formula: str, values: Mapping[str, Any]) -> float:
+    """Evaluates a formula for scalar values."""
+    return float(compile_formula(formula)(values))
+
+
+def evaluate_formula_vectorized(formula: str, values: Mapping[str, Any], size) -> np.ndarray:
+    """
+    Evaluates a formula once over arrays of the given size (a length, or a shape such
+    as plants x days). Elements that come out non-finite (e.g. a division by zero) are
+    set to 0.
+    """
+    with np.errstate(all="ignore"):
+        result = np.broadcast_to(np.asarray(compile_formula(formula)(values, vectorized=True), dtype=float), size).copy()
+    result[~np.isfinite(result)] = 0.0
+    return result
@@ -4,8 +4,14 @@ import math
 import uuid
 import re
 import ast
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from functools import reduce
 from typing import Dict, List, Any, Optional
 
+import numpy as np
+
 class NodeType:
     KPI_INPUT = "kpi_input"
     CONSTANT = "constant"
@@ -54,12 +60,26 @@ class KpiDAG:
     def __init__(self, nodes: List[KpiNode] = None, edges: List[KpiEdge] = None):
         self.nodes: Dict[str, KpiNode] = {n.id: n for n in (nodes or [])}
         self.edges: List[KpiEdge] = edges or []
+        self._plan: Optional["DagPlan"] = None
 
     def add_node(self, node: KpiNode):
         self.nodes[node.id] = node
+        self.invalidate()
 
     def add_edge(self, edge: KpiEdge):
         self.edges.append(edge)
+        self.invalidate()
+
+    def invalidate(self):
+        """Drops the cached plan; call after changing nodes, edges or node data in place."""
+        self._plan = None
+
+    @property
+    def plan(self) -> "DagPlan":
+        """The compiled DagPlan, built on first use and kept until invalidate()."""
+        if self._plan is None:
+            self._plan = self.compile()
+        return self._plan
 
     def to_json(self) -> str:
         return json.dumps({
@@ -77,9 +97,9 @@ class KpiDAG:
             return ""
         
         memo = {}
-        return self._to_formula_recursive(output_node.id, memo)
+        return self._to_formula_recursive(output_node.id, memo, self.incoming_edges())
 
-    def _to_formula_recursive(self, node_id: str, memo: Dict[str, str]) -> str:
+    def _to_formula_recursive(self, node_id: str, memo: Dict[str, str], incoming: Dict[str, List[KpiEdge]]) -> str:
         if node_id in memo:
             return memo[node_id]
 
@@ -94,13 +114,7 @@ class KpiDAG:
             kpi_id = node.data.get("kpi_id")
             result = f"[{kpi_id}]"
         elif node.type in (NodeType.OPERATOR, NodeType.OUTPUT):
-            inputs = []
-            node_edges = [e for e in self.edges if e.target == node_id]
-            # Sort edges by target_handle to ensure consistent order
-            node_edges.sort(key=lambda e: e.target_handle)
-            
-            for edge in node_edges:
-                inputs.append(self._to_formula_recursive(edge.source, memo))
+            inputs = [self._to_formula_recursive(edge.source, memo, incoming) for edge in incoming.get(node_id, [])]
 
             if node.type == NodeType.OUTPUT:
                 result = inputs[0] if inputs else "0"
@@ -231,47 +245,95 @@ class KpiDAG:
         edges = [KpiEdge.from_dict(e) for e in data.get("edges", [])]
         return cls(nodes, edges)
 
-    def evaluate(self, kpi_resolver_func, default_target_num: int = 1) -> float:
+    def incoming_edges(self) -> Dict[str, List[KpiEdge]]:
+        """Adjacency lists keyed by target node id, each sorted by target handle."""
+        incoming: Dict[str, List[KpiEdge]] = {}
+        for e in self.edges:
+            incoming.setdefault(e.target, []).append(e)
+        for node_edges in incoming.values():
+            node_edges.sort(key=lambda e: e.target_handle)
+        return incoming
+
+    def compile(self) -> "DagPlan":
+        """
+        Flattens the part of the graph that feeds the output node into a DagPlan: a
+        linear, dependency-ordered list of steps with operand indices, which can be
+        evaluated many times without recursion or edge scans.
+
+        While flattening, identical steps (the same KPI input, constant, or operator
+        over the same operands) share one slot and operators over constants only are
+        folded into a constant, so every distinct input and subexpression is
+        evaluated once. Raises ValueError if the output depends on a cycle.
+        """
         output_node = next((n for n in self.nodes.values() if n.type == NodeType.OUTPUT), None)
         if not output_node:
-            return 0.0
-        
-        memo = {}
-        return self._evaluate_recursive(output_node.id, kpi_resolver_func, memo, default_target_num)
-
-    def _evaluate_recursive(self, node_id: str, resolver, memo: Dict[str, float], default_target_num: int) -> float:
-        if node_id in memo:
-            return memo[node_id]
-
-        node = self.nodes.get(node_id)
-        if not node:
-            return 0.0
-
-        result = 0.0
-        if node.type == NodeType.CONSTANT:
-            result = float(node.data.get("value", 0.0))
-        elif node.type == NodeType.KPI_INPUT:
-            kpi_id = node.data.get("kpi_id")
-            target_num = node.data.get("target_num", default_target_num)
-            result = resolver(kpi_id, target_num)
-        elif node.type in (NodeType.OPERATOR, NodeType.OUTPUT):
-            inputs = []
-            node_edges = [e for e in self.edges if e.target == node_id]
-            node_edges.sort(key=lambda e: e.target_handle)
-            
-            for edge in node_edges:
-                inputs.append(self._evaluate_recursive(edge.source, resolver, memo, default_target_num))
+            return DagPlan([])
+
+        incoming = self.incoming_edges()
+        slots: Dict[str, int] = {}
+        steps = []
+        step_slots: Dict[tuple, int] = {}  # step -> slot, for common subexpressions
+
+        def add_step(kind, arg, operands=()):
+            if kind == DagPlan.OPERATOR and all(steps[i][0] == DagPlan.CONST for i in operands):
+                folded = DagPlan._fold_constant(arg, [steps[i][1] for i in operands])
+                if folded is not None:
+                    kind, arg, operands = DagPlan.CONST, folded, ()
+            step = (kind, arg, operands)
+            if step not in step_slots:
+                steps.append(step)
+                step_slots[step] = len(steps) - 1
+            return step_slots[step]
+
+        on_path = set()
+        stack = [(output_node.id, False)]
+        while stack:
+            node_id, expanded = stack.pop()
+            node = self.nodes.get(node_id)
+            if expanded:
+                on_path.discard(node_id)
+                if not node:
+                    slots[node_id] = add_step(DagPlan.CONST, 0.0)
+                elif node.type == NodeType.CONSTANT:
+                    slots[node_id] = add_step(DagPlan.CONST, float(node.data.get("value", 0.0)))
+                elif node.type == NodeType.KPI_INPUT:
+                    slots[node_id] = add_step(DagPlan.INPUT, (node.data.get("kpi_id"), node.data.get("target_num", DagPlan.DEFAULT_TARGET)))
+                else:
+                    operands = tuple(slots[e.source] for e in incoming.get(node_id, []))
+                    if node.type == NodeType.OUTPUT:
+                        slots[node_id] = add_step(DagPlan.OUTPUT, None, operands)
+                    elif node.type == NodeType.OPERATOR:
+                        slots[node_id] = add_step(DagPlan.OPERATOR, node.data.get("op", "+"), operands)
+                    else:
+                        slots[node_id] = add_step(DagPlan.CONST, 0.0)
+                continue
+
+            if node_id in slots: continue
+            if node_id in on_path:
+                raise ValueError(f"Formula graph has a cycle through node '{node_id}'")
+            on_path.add(node_id)
+            stack.append((node_id, True))
+            if node and node.type in (NodeType.OPERATOR, NodeType.OUTPUT):
+                for e in reversed(incoming.get(node_id, [])):
+                    if e.source not in slots:
+                        stack.append((e.source, False))
+        return DagPlan(DagPlan._prune(steps))
 
-            if node.type == NodeType.OUTPUT:
-                result = inputs[0] if inputs else 0.0
-            else:
-                op = node.data.get("op", "+")
-                result = self._apply_operator(op, inputs)
+    def evaluate(self, kpi_resolver_func, default_target_num: int = 1) -> float:
+        return self.plan.evaluate(kpi_resolver_func, default_target_num)
 
-        memo[node_id] = result
-        return result
+    def evaluate_array(self, kpi_resolver_func, size, default_target_num: int = 1) -> np.ndarray:
+        """
+        Vectorised counterpart of evaluate(): kpi_resolver_func(kpi_id, target_num) returns
+        an array (e.g. one value per day, or a plants x days matrix) and the whole DAG is
+        evaluated once with element-wise operators: '/' yields 0 where the divisor is ~0
+        and min/max/avg combine their inputs element by element. size is the length or
+        shape of the result; inputs and constants are broadcast to it.
+        """
+        return self.plan.evaluate_array(kpi_resolver_func, size, default_target_num)
 
-    def _apply_operator(self, op: str, inputs: List[float]) -> float:
+    @staticmethod
+    def _apply_operator(op: str, inputs: List[float]) -> float:
         if not inputs:
             return 0.0
         
@@ -299,6 +361,37 @@ class KpiDAG:
         
         return 0.0
 
+    @staticmethod
+    def _apply_operator_array(op: str, inputs: List[Any]):
+        """Element-wise version of _apply_operator over arrays (or scalars)."""
+        if not inputs:
+            return 0.0
+
+        if op == "+":
+            return reduce(np.add, inputs)
+        elif op == "-":
+            return inputs[0] - reduce(np.add, inputs[1:]) if len(inputs) > 1 else -inputs[0]
+        elif op == "*":
+            return reduce(np.multiply, inputs, 1.0)
+        elif op == "/":
+            if len(inputs) < 2:
+                return 0.0
+            num, den = np.broadcast_arrays(np.asarray(inputs[0], dtype=float), np.asarray(inputs[1], dtype=float))
+            safe = np.abs(den) >= 1e-12
+            return np.divide(num, den, out=np.zeros(num.shape), where=safe)
+        elif op == "pow":
+            if len(inputs) < 2: return inputs[0]
+            with np.errstate(invalid="ignore", over="ignore", divide="ignore"):
+                return np.power(np.asarray(inputs[0], dtype=float), inputs[1])
+        elif op == "min":
+            return reduce(np.minimum, inputs)
+        elif op == "max":
+            return reduce(np.maximum, inputs)
+        elif op == "avg":
+            return reduce(np.add, inputs) / len(inputs)
+
+        return 0.0
+
     def find_all_kpi_dependencies(self) -> List[Dict[str, Any]]:
         deps = []
         for node in self.nodes.values():
@@ -310,6 +403,7 @@ class KpiDAG:
         return deps
 
     def has_cycle(self) -> bool:
+        incoming = self.incoming_edges()
         visited = set()
         path = set()
 
@@ -320,8 +414,7 @@ class KpiDAG:
             visited.add(node_id)
             path.add(node_id)
             
-            node_edges = [e for e in self.edges if e.target == node_id]
-            for edge in node_edges:
+            for edge in incoming.get(node_id, []):
                 if visit(edge.source): return True
                 
             path.remove(node_id)
@@ -331,7 +424,131 @@ class KpiDAG:
             if visit(node_id): return True
         return False
 
+class DagPlan:
+    """
+    Compiled, reusable evaluation plan of a KpiDAG (see KpiDAG.compile).
+
+    steps are (kind, arg, operand_indices) in dependency order; the last step is the
+    output. arg is the constant value, the (kpi_id, target_num) of an input, or the
+    operator symbol.
+    """
+    CONST, INPUT, OPERATOR, OUTPUT = range(4)
+    DEFAULT_TARGET = object()  # input node without its own target_num
+
+    def __init__(self, steps: List[tuple]):
+        self.steps = steps
+
+    @staticmethod
+    def _fold_constant(op: str, values: List[float]) -> Optional[float]:
+        """Value of an operator over constants, or None if it is not a finite number."""
+        try:
+            value = float(KpiDAG._apply_operator(op, values))
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+        return value if math.isfinite(value) else None
+
+    @staticmethod
+    def _prune(steps: List[tuple]) -> List[tuple]:
+        """Drops steps the output no longer reads (e.g. operands of folded operators)."""
+        if not steps:
+            return steps
+        live = {len(steps) - 1}
+        for i in range(len(steps) - 1, -1, -1):
+            if i in live:
+                live.update(steps[i][2])
+        new_index = {}
+        pruned = []
+        for i, (kind, arg, operands) in enumerate(steps):
+            if i in live:
+                new_index[i] = len(pruned)
+                pruned.append((kind, arg, tuple(new_index[j] for j in operands)))
+        return pruned
+
+    @property
+    def kpi_inputs(self) -> List[tuple]:
+        """(kpi_id, target_num or DEFAULT_TARGET) of every input the output reads."""
+        return [arg for kind, arg, _ in self.steps if kind == DagPlan.INPUT]
+
+    def _run(self, resolve_input, apply_operator):
+        if not self.steps:
+            return 0.0
+        values = []
+        for kind, arg, operands in self.steps:
+            if kind == DagPlan.CONST:
+                values.append(arg)
+            elif kind == DagPlan.INPUT:
+                values.append(resolve_input(*arg))
+            elif kind == DagPlan.OUTPUT:
+                values.append(values[operands[0]] if operands else 0.0)
+            else:
+                values.append(apply_operator(arg, [values[i] for i in operands]))
+        return values[-1]
+
+    def evaluate(self, kpi_resolver_func, default_target_num: int = 1) -> float:
+        def resolve_input(kpi_id, target_num):
+            return kpi_resolver_func(kpi_id, default_target_num if target_num is DagPlan.DEFAULT_TARGET else target_num)
+        return self._run(resolve_input, KpiDAG._apply_operator)
+
+    def evaluate_array(self, kpi_resolver_func, size, default_target_num: int = 1) -> np.ndarray:
+        """Elements that come out non-finite (e.g. pow of a negative base) are set to 0, as in evaluate_formula_vectorized."""
+        def resolve_input(kpi_id, target_num):
+            tn = default_target_num if target_num is DagPlan.DEFAULT_TARGET else target_num
+            return np.asarray(kpi_resolver_func(kpi_id, tn), dtype=float)
+        with np.errstate(all="ignore"):
+            result = self._run(resolve_input, KpiDAG._apply_operator_array)
+            result = np.broadcast_to(np.asarray(result, dtype=float), size).copy()
+        result[~np.isfinite(result)] = 0.0
+        return result
+
+# --- Process-wide cache of parsed and compiled formula graphs ---
+CompiledDag = namedtuple("CompiledDag", ["dag", "plan", "dependencies"])
+
+_COMPILED_DAG_CACHE_SIZE = 256
+_compiled_dag_cache: "OrderedDict[str, CompiledDag]" = OrderedDict()
+_compiled_dag_lock = threading.Lock()
+
+
+def _formula_hash(formula_json: str) -> str:
+    return hashlib.sha1(formula_json.encode("utf-8")).hexdigest()
+
+
+def get_compiled_dag(formula_json: str) -> CompiledDag:
+    """
+    Returns the parsed DAG, its compiled plan and its KPI dependencies for a
+    formula_json string, from a bounded LRU keyed by the formula's hash.
+    The cached objects are shared: use them for evaluation only, never edit them.
+    """
+    key = _formula_hash(formula_json)
+    with _compiled_dag_lock:
+        hit = _compiled_dag_cache.get(key)
+        if hit is not None:
+            _compiled_dag_cache.move_to_end(key)
+            return hit
+
+    dag = KpiDAG.from_json(formula_json)
+    compiled = CompiledDag(dag, dag.plan, dag.find_all_kpi_dependencies())
+    with _compiled_dag_lock:
+        _compiled_dag_cache[key] = compiled
+        while len(_compiled_dag_cache) > _COMPILED_DAG_CACHE_SIZE:
+            _compiled_dag_cache.popitem(last=False)
+    return compiled
+
+
+def invalidate_compiled_dag(formula_json: str = None):
+    """Drops one formula from the compiled DAG cache, or the whole cache when None."""
+    with _compiled_dag_lock:
+        if formula_json is None:
+            _compiled_dag_cache.clear()
+        else:
+            _compiled_dag_cache.pop(_formula_hash(formula_json), None)
+
+
 def check_for_global_circular_dependencies(kpis_data: Dict[int, Dict[str, Any]]) -> List[List[Any]]:
+    """
+    Full scan for cycles across the given specs. Spec saves do not need it: they
+    check only the new formula's inputs against the persistent index in
+    src.kpi_management.dependency_index.
+    """
     graph = {}
     for kpi_id, data in kpis_data.items():
         # Check both target1 and target2 (legacy) or all targets in data_cache if needed
@@ -342,34 +559,33 @@ def check_for_global_circular_dependencies(kpis_data: Dict[int, Dict[str, Any]])
         try:
             dag_data = json.loads(formula)
             if not (isinstance(dag_data, dict) and "nodes" in dag_data): continue
-            dag = KpiDAG.from_json(formula)
-            deps = dag.find_all_kpi_dependencies()
+            deps = get_compiled_dag(formula).dependencies
             graph[kpi_id] = [d['kpi_id'] for d in deps]
         except: continue
 
+    # Iterative DFS; path_pos maps each node on the current path to its position
+    end = object()
     cycles = []
     visited = set()
     path = []
-    path_set = set()
-
-    def dfs(node):
-        if node in path_set:
-            idx = path.index(node)
-            cycles.append(path[idx:])
-            return
-        if node in visited: return
-        
-        visited.add(node)
-        path.append(node)
-        path_set.add(node)
-        
-        for neighbor in graph.get(node, []):
-            dfs(neighbor)
-            
-        path.pop()
-        path_set.remove(node)
+    path_pos = {}
+    for start in list(graph.keys()):
+        if start in visited: continue
+        visited.add(start)
+        path.append(start)
+        path_pos[start] = 0
+        stack = [iter(graph.get(start, []))]
+        while stack:
+            neighbor = next(stack[-1], end)
+            if neighbor is end:
+                stack.pop()
+                del path_pos[path.pop()]
+            elif neighbor in path_pos:
+                cycles.append(path[path_pos[neighbor]:])
+            elif neighbor not in visited:
+                visited.add(neighbor)
+                path_pos[neighbor] = len(path)
+                path.append(neighbor)
+                stack.append(iter(graph.get(neighbor, [])))
 
-    for node in list(graph.keys()):
-        dfs(node)
-        
     return cycles
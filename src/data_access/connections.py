@@ -0,0 +1,213 @@
+# src/data_access/connections.py
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.config import settings as app_config
+
+# Idle connections kept per thread and database file
+_MAX_IDLE_PER_DB = 2
+
+# Stable schema names of attached_session() -> database file. The daily targets file is
+# the session's main database (a real file, so commits spanning the attached files are
+# atomic); the others are ATTACHed under their alias.
+SESSION_SCHEMAS = {
+    "main": "db_kpi_days.db",
+    "kpis": "db_kpis.db",
+    "plants": "db_plants.db",
+    "targets": "db_kpi_targets.db",
+    "templates": "db_kpi_templates.db",
+    "weeks": "db_kpi_weeks.db",
+    "months": "db_kpi_months.db",
+    "quarters": "db_kpi_quarters.db",
+}
+
+_PRAGMA_NAME = re.compile(r"[a-z_]+")
+_PRAGMA_VALUE = re.compile(r"-?[A-Za-z0-9_]+")
+
+_local = threading.local()
+_generation = [0]  # bumped by invalidate_connections(); stale thread pools are dropped on next use
+
+
+def _resolve_path(db) -> str:
+    """A database file name ("db_kpis.db") resolves against database_base_dir; paths are used as given."""
+    if isinstance(db, Path) or os.path.dirname(str(db)):
+        return str(db)
+    return str(app_config.get_database_path(db))
+
+
+def pragma_profile() -> dict:
+    """The configured PRAGMA name -> value profile (settings key "sqlite_pragmas"); None values are skipped."""
+    return {**app_config.DEFAULT_SETTINGS["sqlite_pragmas"], **(app_config.SETTINGS.get("sqlite_pragmas") or {})}
+
+
+def apply_pragmas(conn, schema: str = None, profile: dict = None):
+    """Applies the pragma profile (or the given one) to a connection, or to one of its attached schemas."""
+    prefix = f"{schema}." if schema else ""
+    for name, value in (profile or pragma_profile()).items():
+        if value is None: continue
+        if not (_PRAGMA_NAME.fullmatch(name) and _PRAGMA_VALUE.fullmatch(str(value))):
+            print(f"WARNING: Ignoring invalid SQLite pragma setting {name}={value!r}.")
+            continue
+        try:
+            conn.execute(f"PRAGMA {prefix}{name} = {value}")
+        except sqlite3.Error as e:
+            print(f"WARNING: Could not apply PRAGMA {prefix}{name} = {value}: {e}")
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    apply_pragmas(conn)
+    return conn
+
+
+def _session_profile() -> dict:
+    """The pragma profile of attached sessions: a rollback journal unless WAL was opted into."""
+    profile = pragma_profile()
+    if profile.get("journal_mode") is None:
+        profile["journal_mode"] = "DELETE"
+    return profile
+
+
+def _open_session(key: str) -> sqlite3.Connection:
+    profile = _session_profile()
+    # mode=rw so a missing file is reported instead of silently created
+    main_path = app_config.get_database_path(SESSION_SCHEMAS["main"])
+    if main_path.exists():
+        conn = sqlite3.connect(f"{main_path.resolve().as_uri()}?mode=rw", uri=True)
+    else:
+        print(f"WARNING: Database {SESSION_SCHEMAS['main']} not found at {main_path}; the session has no daily targets.")
+        conn = sqlite3.connect(":memory:")
+    apply_pragmas(conn, profile=profile)
+    for alias, db_name in SESSION_SCHEMAS.items():
+        if alias == "main": continue
+        path = app_config.get_database_path(db_name)
+        if not path.exists():
+            print(f"WARNING: Database {db_name} not found at {path}; schema '{alias}' is not attached.")
+            continue
+        conn.execute(f"ATTACH DATABASE ? AS {alias}", (f"{path.resolve().as_uri()}?mode=rw",))
+        apply_pragmas(conn, alias, profile)
+    return conn
+
+
+def session_schemas(conn) -> set:
+    """Schema names of an attached_session() whose database file is actually present."""
+    names = {row[1]: row[2] for row in conn.execute("PRAGMA database_list")}
+    return {name for name in SESSION_SCHEMAS if names.get(name)}
+
+
+def _thread_pool() -> dict:
+    pool = getattr(_local, "pool", None)
+    if pool is not None and pool["pid"] == os.getpid() and pool["generation"] == _generation[0]:
+        return pool
+    if pool is not None and pool["pid"] == os.getpid():
+        _close_idle(pool)
+    # Connections inherited through fork() are never reused (or closed) in the child
+    pool = {"pid": os.getpid(), "generation": _generation[0], "idle": {}}
+    _local.pool = pool
+    return pool
+
+
+def _close_idle(pool: dict):
+    for conns in pool["idle"].values():
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+    pool["idle"] = {}
+
+
+def _release(pool: dict, key: str, conn: sqlite3.Connection):
+    """Resets per-use state and keeps the connection for reuse by this thread."""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = None
+        conn.execute("PRAGMA foreign_keys = OFF")
+    except sqlite3.Error:
+        conn.close()
+        return
+    idle = pool["idle"].setdefault(key, [])
+    if pool is getattr(_local, "pool", None) and pool["generation"] == _generation[0] and len(idle) < _MAX_IDLE_PER_DB:
+        idle.append(conn)
+    else:
+        conn.close()
+
+
+@contextmanager
+def _pooled(key: str, opener):
+    pool = _thread_pool()
+    idle = pool["idle"].get(key)
+    conn = idle.pop() if idle else opener(key)
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _release(pool, key, conn)
+
+
+def db_connection(db):
+    """
+    Yields a tuned connection to one database file (a name such as "db_kpis.db" or a
+    path), reused across calls by the current thread.
+
+    Like `with sqlite3.connect(...)`, the block is committed on success and rolled
+    back on error. row_factory and foreign_keys are reset when the connection is
+    returned; do not close or ATTACH to it (use open_connection for that).
+    Nested calls for the same file get separate connections.
+    """
+    return _pooled(_resolve_path(db), _open)
+
+
+def attached_session():
+    """
+    Yields a reusable per-thread connection over every database under the
+    SESSION_SCHEMAS names (main = daily targets, kpis, plants, targets, templates,
+    weeks, months, quarters), so queries spanning databases run as single statements,
+    e.g. "SELECT ... FROM targets.annual_targets t JOIN plants.plants p ...".
+    Missing files are left out (see session_schemas).
+
+    Commits on success and rolls back on error. With the default rollback journal the
+    commit is atomic across all files; with WAL opted into it is atomic per file only.
+    """
+    key = "session:" + "|".join(str(app_config.get_database_path(db_name)) for db_name in SESSION_SCHEMAS.values())
+    return _pooled(key, _open_session)
+
+
+@contextmanager
+def open_connection(db):
+    """
+    Yields a new tuned connection that is closed afterwards, for work that changes
+    connection state (e.g. ATTACH). Commits on success, rolls back on error.
+    """
+    conn = _open(_resolve_path(db))
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def invalidate_connections():
+    """
+    Drops every pooled connection: the calling thread's are closed now, other
+    threads' when they next ask for one. Called when the app settings are reloaded.
+    """
+    _generation[0] += 1
+    pool = getattr(_local, "pool", None)
+    if pool is not None and pool["pid"] == os.getpid():
+        _close_idle(pool)
+    _local.pool = None
+
+
+app_config.add_settings_reload_listener(invalidate_connections)
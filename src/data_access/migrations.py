@@ -0,0 +1,160 @@
+# src/data_access/migrations.py
+import sqlite3
+import traceback
+
+from src.config import settings as app_config
+from src.data_access.connections import db_connection, SESSION_SCHEMAS
+from src.kpi_management.hierarchy import NODE_PATHS_DDL, NODE_PATHS_REBUILD
+
+# Ordered schema migrations: (version, database file, description, statements).
+# Versions are global and only ever appended; each database records the versions
+# applied to it in its own schema_version table. A change to the DDL in
+# setup_databases() must also append a migration (statements may be empty) so
+# that existing databases get one full setup run.
+MIGRATIONS = [
+    (1, "db_kpi_targets.db", "Index annual targets by plant/year and by KPI", [
+        "CREATE INDEX IF NOT EXISTS idx_annual_targets_plant_year ON annual_targets (plant_id, year)",
+        "CREATE INDEX IF NOT EXISTS idx_annual_targets_kpi_year ON annual_targets (kpi_id, year)",
+        # kpi_annual_target_values(annual_target_id) is covered by its UNIQUE(annual_target_id, target_number)
+    ]),
+    (2, "db_kpis.db", "Index the KPI hierarchy and per-plant visibility", [
+        "CREATE INDEX IF NOT EXISTS idx_kpi_nodes_parent ON kpi_nodes (parent_id)",
+        "CREATE INDEX IF NOT EXISTS idx_kpi_indicators_node ON kpi_indicators (node_id)",
+        "CREATE INDEX IF NOT EXISTS idx_kpi_plant_visibility_plant ON kpi_plant_visibility (plant_id, kpi_id)",
+    ]),
+    (3, "db_kpi_templates.db", "Index global split indicators and years", [
+        "CREATE INDEX IF NOT EXISTS idx_global_split_indicators_indicator ON global_split_indicators (indicator_id)",
+        "CREATE INDEX IF NOT EXISTS idx_global_split_years_year ON global_split_years (year)",
+    ]),
+    (4, "db_kpi_days.db", "Index daily targets by KPI", [
+        "CREATE INDEX IF NOT EXISTS idx_daily_targets_kpi_year ON daily_targets (kpi_id, year)",
+    ]),
+    (5, "db_kpi_weeks.db", "Index weekly targets by KPI", [
+        "CREATE INDEX IF NOT EXISTS idx_weekly_targets_kpi_year ON weekly_targets (kpi_id, year)",
+    ]),
+    (6, "db_kpi_months.db", "Index monthly targets by KPI", [
+        "CREATE INDEX IF NOT EXISTS idx_monthly_targets_kpi_year ON monthly_targets (kpi_id, year)",
+    ]),
+    (7, "db_kpi_quarters.db", "Index quarterly targets by KPI", [
+        "CREATE INDEX IF NOT EXISTS idx_quarterly_targets_kpi_year ON quarterly_targets (kpi_id, year)",
+    ]),
+    (8, "db_kpis.db", "Materialize KPI node paths", [NODE_PATHS_DDL, *NODE_PATHS_REBUILD]),
+]
+
+# Hot retriever queries that must be answered through an index: (database file, SQL)
+HOT_QUERIES = [
+    ("db_kpi_targets.db", "SELECT * FROM annual_targets WHERE plant_id=? AND year=?"),
+    ("db_kpi_targets.db", "SELECT * FROM annual_targets WHERE year=? AND plant_id IN (?, ?)"),
+    ("db_kpi_targets.db", "SELECT * FROM annual_targets WHERE kpi_id=? AND year=?"),
+    ("db_kpi_targets.db", "DELETE FROM annual_targets WHERE kpi_id=?"),
+    ("db_kpi_targets.db", "SELECT * FROM kpi_annual_target_values WHERE annual_target_id=? ORDER BY target_number"),
+    ("db_kpis.db", "SELECT * FROM kpi_nodes WHERE parent_id=?"),
+    ("db_kpis.db", "SELECT * FROM kpi_indicators WHERE node_id=?"),
+    ("db_kpis.db", "SELECT kpi_id, is_enabled FROM kpi_plant_visibility WHERE plant_id=?"),
+    ("db_kpis.db", "SELECT plant_id, is_enabled FROM kpi_plant_visibility WHERE kpi_id=?"),
+    ("db_kpis.db", "SELECT s.*, np.path FROM kpis s JOIN kpi_indicators i ON s.indicator_id = i.id LEFT JOIN kpi_node_paths np ON i.node_id = np.node_id WHERE s.id=?"),
+    ("db_kpis.db", "SELECT * FROM kpis WHERE indicator_id=?"),
+    ("db_kpi_templates.db", "SELECT s.* FROM global_kpi_splits s JOIN global_split_indicators i ON s.id = i.global_split_id WHERE i.indicator_id=?"),
+    ("db_kpi_templates.db", "SELECT s.* FROM global_kpi_splits s JOIN global_split_years y ON s.id = y.global_split_id WHERE y.year=?"),
+    ("db_kpi_templates.db", "SELECT year FROM global_split_years WHERE global_split_id=?"),
+    ("db_kpi_days.db", "SELECT * FROM daily_targets WHERE kpi_id=? AND year=?"),
+    ("db_kpi_days.db", "DELETE FROM daily_targets WHERE kpi_id=?"),
+    ("db_kpi_days.db", "SELECT date_value, target_value FROM daily_targets WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?"),
+    ("db_kpi_days.db", "SELECT * FROM daily_targets WHERE year=? AND plant_id=? AND kpi_id IN (?, ?) AND target_number IN (?, ?)"),
+    ("db_kpi_weeks.db", "SELECT * FROM weekly_targets WHERE kpi_id=? AND year=?"),
+    ("db_kpi_months.db", "SELECT * FROM monthly_targets WHERE kpi_id=? AND year=?"),
+    ("db_kpi_quarters.db", "SELECT * FROM quarterly_targets WHERE kpi_id=? AND year=?"),
+]
+
+
+# Version every database is stamped with after a clean setup_databases() run
+SCHEMA_VERSION = max(v for v, _, _, _ in MIGRATIONS)
+
+
+def latest_schema_version(db_name: str) -> int:
+    """Highest migration version that targets db_name (0 if none does)."""
+    return max((v for v, db, _, _ in MIGRATIONS if db == db_name), default=0)
+
+
+def get_schema_version(conn) -> int:
+    """Highest migration version recorded in a database (0 before any migration ran)."""
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )"""
+    )
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def run_migrations() -> bool:
+    """
+    Applies, database by database and in version order, every migration not yet
+    recorded in that database's schema_version, then refreshes its planner
+    statistics with ANALYZE. Each database is migrated in one transaction.
+    Returns False if any database failed to migrate.
+    """
+    ok = True
+    for db_name in dict.fromkeys(db for _, db, _, _ in MIGRATIONS):
+        db_path = app_config.get_database_path(db_name)
+        try:
+            with db_connection(db_path) as conn:
+                current = get_schema_version(conn)
+                pending = [m for m in MIGRATIONS if m[1] == db_name and m[0] > current]
+                for version, _, description, statements in pending:
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+                    print(f"INFO: Applied migration {version} to {db_name}: {description}")
+                if pending:
+                    conn.execute("ANALYZE")
+        except sqlite3.Error as e:
+            ok = False
+            print(f"ERROR: Migration of {db_path} failed: {e}")
+            print(traceback.format_exc())
+    return ok
+
+
+def stamp_schema_version():
+    """Records SCHEMA_VERSION in every database once a full setup has completed cleanly."""
+    for db_name in SESSION_SCHEMAS.values():
+        with db_connection(db_name) as conn:
+            if get_schema_version(conn) < SCHEMA_VERSION:
+                conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (SCHEMA_VERSION, "Schema set up"))
+
+
+def schema_is_current() -> bool:
+    """
+    True when all databases exist and carry SCHEMA_VERSION: one indexed read per
+    database, without any DDL, so startup can skip setup_databases' full run.
+    """
+    for db_name in SESSION_SCHEMAS.values():
+        db_path = app_config.get_database_path(db_name)
+        if not db_path.exists():
+            return False
+        with db_connection(db_path) as conn:
+            try:
+                version = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+            except sqlite3.OperationalError:
+                return False
+        if version != SCHEMA_VERSION:
+            return False
+    return True
+
+
+def check_query_plans() -> list:
+    """
+    Runs EXPLAIN QUERY PLAN on every HOT_QUERIES entry and returns the ones that
+    are not answered through an index, as (database file, SQL, plan) tuples.
+    """
+    problems = []
+    for db_name, sql in HOT_QUERIES:
+        with db_connection(db_name) as conn:
+            params = (1,) * sql.count("?")
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+        uses_index = any("USING" in step and ("INDEX" in step or "PRIMARY KEY" in step) for step in plan)
+        full_scan = any(step.startswith("SCAN ") and "USING" not in step for step in plan)
+        if full_scan or not uses_index:
+            problems.append((db_name, sql, plan))
+    return problems
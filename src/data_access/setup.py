@@ -5,6 +5,9 @@ from pathlib import Path  # To ensure CSV_EXPORT_BASE_PATH is handled as a Path
 
 # Import configurations from app_config.py
 from src.config import settings as app_config 
+from src.data_access.connections import db_connection
+from src.data_access.migrations import run_migrations, schema_is_current, stamp_schema_version
+from src.kpi_management.hierarchy import NODE_PATHS_DDL, rebuild_node_paths
 
 from src.interfaces.common_ui.constants import (
         CALC_TYPE_INCREMENTAL,
@@ -23,13 +26,20 @@ from src.interfaces.common_ui.constants import (
         WEEKDAY_BIAS_FACTOR_MEDIA,
     )
 
-def setup_databases():
+def setup_databases(force: bool = False):
     """
     Sets up all necessary SQLite databases and their tables.
     Creates tables if they don't exist and attempts to alter existing tables
     to add new columns if they are missing.
+
+    Returns straight away when every database already carries the current schema
+    version (stamped after the last clean setup), unless force is True.
     """
+    if not force and schema_is_current():
+        return
+
     print("Starting database setup...")
+    setup_errors = 0
 
     csv_export_path = app_config.get_csv_export_path()
     if csv_export_path:
@@ -57,7 +67,7 @@ def setup_databases():
     db_kpi_templates_path = app_config.get_database_path("db_kpi_templates.db")
     print(f"Setting up tables in {db_kpi_templates_path}...")
     try:
-        with sqlite3.connect(db_kpi_templates_path) as conn:
+        with db_connection(db_kpi_templates_path) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """CREATE TABLE IF NOT EXISTS kpi_indicator_templates (
@@ -123,6 +133,7 @@ def setup_databases():
             conn.commit()
         print(f"Table setup in {db_kpi_templates_path} completed.")
     except sqlite3.Error as e:
+        setup_errors += 1
         print(f"ERROR during setup of {db_kpi_templates_path}: {e}")
         print(traceback.format_exc())
 
@@ -130,7 +141,7 @@ def setup_databases():
     db_kpis_path = app_config.get_database_path("db_kpis.db")
     print(f"Setting up tables in {db_kpis_path}...")
     try:
-        with sqlite3.connect(db_kpis_path) as conn:
+        with db_connection(db_kpis_path) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "PRAGMA foreign_keys = ON;"  # Ensure FK constraints are active during setup for consistency
@@ -267,8 +278,27 @@ def setup_databases():
             )
             conn.commit()
 
+            # --- Formula dependency index (KPI -> input KPI), kept up to date by spec saves ---
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS kpi_formula_dependencies (
+                    kpi_id INTEGER NOT NULL,
+                    depends_on_kpi_id INTEGER NOT NULL,
+                    PRIMARY KEY (kpi_id, depends_on_kpi_id),
+                    FOREIGN KEY (kpi_id) REFERENCES kpis(id) ON DELETE CASCADE
+                )"""
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_kpi_formula_dependencies_dep ON kpi_formula_dependencies (depends_on_kpi_id)"
+            )
+
+            # Materialized hierarchy path of every node, maintained by kpi_management.hierarchy
+            cursor.execute(NODE_PATHS_DDL)
+            rebuild_node_paths(conn)
+            conn.commit()
+
         print(f"Table setup in {db_kpis_path} completed.")
     except sqlite3.Error as e:
+        setup_errors += 1
         print(f"ERROR during setup of {db_kpis_path}: {e}")
         print(traceback.format_exc())
 
@@ -276,7 +306,7 @@ def setup_databases():
     db_plants_path = app_config.get_database_path("db_plants.db")
     print(f"Setting up tables in {db_plants_path}...")
     try:
-        with sqlite3.connect(db_plants_path) as conn:
+        with db_connection(db_plants_path) as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """CREATE TABLE IF NOT EXISTS plants (
@@ -314,6 +344,7 @@ def setup_databases():
             conn.commit()
         print(f"Table setup in {db_plants_path} completed.")
     except sqlite3.Error as e:
+        setup_errors += 1
         print(f"ERROR during setup of {db_plants_path}: {e}")
         print(traceback.format_exc())
 
@@ -321,7 +352,7 @@ def setup_databases():
     db_targets_path = app_config.get_database_path("db_kpi_targets.db")
     print(f"Setting up tables in {db_targets_path}...")
     try:
-        with sqlite3.connect(db_targets_path) as conn:
+        with db_connection(db_targets_path) as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(
@@ -390,11 +421,13 @@ def setup_databases():
             conn.commit()
         print(f"Table setup in {db_targets_path} completed.")
     except sqlite3.Error as e:
+        setup_errors += 1
         print(f"ERROR during setup of {db_targets_path}: {e}")
         print(traceback.format_exc())
     except (
         NameError
     ) as ne:  # Catches if PROFILE_ANNUAL_PROGRESSIVE or REPARTITION_LOGIC_YEAR are not imported
+        setup_errors += 1
         print(
             f"Configuration ERROR (NameError) for DB_TARGETS: {ne}. Ensure constants are in app_config.py."
         )
@@ -428,7 +461,7 @@ def setup_databases():
     for db_path, table_name, period_col_def in db_configs_periods:
         print(f"Setting up table '{table_name}' in {db_path}...")
         try:
-            with sqlite3.connect(db_path) as conn:
+            with db_connection(db_path) as conn:
                 cursor = conn.cursor()
                 period_col_name_for_unique = period_col_def.split()[0]  # e.g., "date_value"
                 # Check and rename 'stabilimento_id' to 'plant_id' if it exists
@@ -458,9 +491,38 @@ def setup_databases():
                 conn.commit()
             print(f"Table setup in '{table_name}' in {db_path} completed.")
         except sqlite3.Error as e:
+            setup_errors += 1
             print(f"ERROR during setup of {table_name} in {db_path}: {e}")
             print(traceback.format_exc())
 
+    # --- Repartition fingerprints (stored next to the daily rows they describe) ---
+    print(f"Setting up table 'repartition_fingerprints' in {db_kpi_days_path}...")
+    try:
+        with db_connection(db_kpi_days_path) as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS repartition_fingerprints (
+                    year INTEGER NOT NULL,
+                    plant_id INTEGER NOT NULL,
+                    kpi_id INTEGER NOT NULL,
+                    target_number INTEGER NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    PRIMARY KEY (year, plant_id, kpi_id, target_number)
+                )"""
+            )
+            conn.commit()
+        print(f"Table setup in 'repartition_fingerprints' in {db_kpi_days_path} completed.")
+    except sqlite3.Error as e:
+        setup_errors += 1
+        print(f"ERROR during setup of repartition_fingerprints in {db_kpi_days_path}: {e}")
+        print(traceback.format_exc())
+
+    # --- Versioned migrations (indexes, statistics) on top of the tables above ---
+    if not run_migrations():
+        setup_errors += 1
+
+    # Only a clean run lets the next start take the fast path
+    if setup_errors == 0:
+        stamp_schema_version()
     print("Database check and setup completed.")
 
 
@@ -7,6 +7,7 @@ import traceback
 from pathlib import Path
 
 from src.config import settings as app_config
+from src.data_access.connections import db_connection, attached_session, session_schemas
 from src.config.settings import get_database_path
 
 def _handle_db_connection_error(db_name, func_name):
@@ -19,7 +20,7 @@ def _handle_db_connection_error(db_name, func_name):
 # --- Hierarchy & Legacy ---
 def get_hierarchy_nodes(parent_id=None):
     if _handle_db_connection_error("db_kpis.db", "get_hierarchy_nodes"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         sql = "SELECT * FROM kpi_nodes WHERE parent_id IS ?" if parent_id is None else "SELECT * FROM kpi_nodes WHERE parent_id = ?"
         rows = conn.execute(sql, (parent_id,)).fetchall()
@@ -27,7 +28,7 @@ def get_hierarchy_nodes(parent_id=None):
 
 def get_indicators_by_node(node_id):
     if _handle_db_connection_error("db_kpis.db", "get_indicators_by_node"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         sql = "SELECT * FROM kpi_indicators WHERE node_id IS ?" if node_id is None else "SELECT * FROM kpi_indicators WHERE node_id = ?"
         rows = conn.execute(sql, (node_id,)).fetchall()
@@ -40,7 +41,7 @@ def get_kpi_indicators_by_subgroup(subgroup_id: int):
 def get_kpi_groups():
     """Legacy support: returns groups from kpi_nodes."""
     if _handle_db_connection_error("db_kpis.db", "get_kpi_groups"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT id, name FROM kpi_nodes WHERE node_type = 'group'").fetchall()
         return [dict(r) for r in rows]
@@ -48,7 +49,7 @@ def get_kpi_groups():
 def get_all_kpi_subgroups():
     """Legacy support: returns subgroups from kpi_nodes."""
     if _handle_db_connection_error("db_kpis.db", "get_all_kpi_subgroups"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT id, name, parent_id as group_id FROM kpi_nodes WHERE node_type = 'subgroup'").fetchall()
         return [dict(r) for r in rows]
@@ -56,7 +57,7 @@ def get_all_kpi_subgroups():
 def get_all_kpi_indicators():
     """Returns all indicator names and IDs."""
     if _handle_db_connection_error("db_kpis.db", "get_all_kpi_indicators"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT id, name, node_id, subgroup_id FROM kpi_indicators").fetchall()
         return [dict(r) for r in rows]
@@ -64,40 +65,39 @@ def get_all_kpi_indicators():
 def get_all_kpis():
     """Returns all records from the kpis table."""
     if _handle_db_connection_error("db_kpis.db", "get_all_kpis"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM kpis").fetchall()
         return [dict(r) for r in rows]
 
 # --- KPI Specifications ---
+# Specs with indicator and hierarchy names; paths come from the materialized kpi_node_paths
+_KPI_DETAILED_SQL = """
+    SELECT
+        s.id,
+        i.id as indicator_id,
+        i.id as actual_indicator_id,
+        i.name as indicator_name,
+        i.node_id,
+        np.path as hierarchy_path,
+        s.*
+    FROM kpis s
+    JOIN kpi_indicators i ON s.indicator_id = i.id
+    LEFT JOIN kpi_node_paths np ON i.node_id = np.node_id
+"""
+
+_KPI_PLANT_VISIBLE_CONDITION = """
+    (s.id NOT IN (SELECT kpi_id FROM kpi_plant_visibility) OR
+     s.id IN (SELECT kpi_id FROM kpi_plant_visibility WHERE plant_id = ? AND is_enabled = 1))
+"""
+
 def get_all_kpis_detailed(only_visible=False, plant_id: int = None) -> list:
     """Fetches all KPI specs with hierarchy names."""
     if _handle_db_connection_error("db_kpis.db", "get_all_kpis_detailed"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         
-        base_query = """
-            WITH RECURSIVE NodePaths AS (
-                SELECT id, name, parent_id, name as path
-                FROM kpi_nodes
-                WHERE parent_id IS NULL
-                UNION ALL
-                SELECT n.id, n.name, n.parent_id, np.path || ' > ' || n.name
-                FROM kpi_nodes n
-                JOIN NodePaths np ON n.parent_id = np.id
-            )
-            SELECT
-                s.id,
-                i.id as indicator_id,
-                i.id as actual_indicator_id,
-                i.name as indicator_name,
-                i.node_id,
-                np.path as hierarchy_path,
-                s.*
-            FROM kpis s
-            JOIN kpi_indicators i ON s.indicator_id = i.id
-            LEFT JOIN NodePaths np ON i.node_id = np.id
-        """
+        base_query = _KPI_DETAILED_SQL
         
         conditions = []
         params = []
@@ -106,10 +106,7 @@ def get_all_kpis_detailed(only_visible=False, plant_id: int = None) -> list:
             conditions.append("s.visible = 1")
         
         if plant_id:
-            conditions.append("""
-                (s.id NOT IN (SELECT kpi_id FROM kpi_plant_visibility) OR 
-                 s.id IN (SELECT kpi_id FROM kpi_plant_visibility WHERE plant_id = ? AND is_enabled = 1))
-            """)
+            conditions.append(_KPI_PLANT_VISIBLE_CONDITION)
             params.append(plant_id)
         
         if conditions:
@@ -118,18 +115,31 @@ def get_all_kpis_detailed(only_visible=False, plant_id: int = None) -> list:
         rows = conn.execute(base_query, params).fetchall()
         return [dict(r) for r in rows]
 
+def _get_kpi_detailed_where(key_condition: str, key, plant_id: int = None, caller: str = "get_kpi_detailed_by_id"):
+    """Single detailed spec matching an indexed key condition, or None (also if hidden for plant_id)."""
+    if _handle_db_connection_error("db_kpis.db", caller): return None
+    query = _KPI_DETAILED_SQL + " WHERE " + key_condition
+    params = [key]
+    if plant_id:
+        query += " AND " + _KPI_PLANT_VISIBLE_CONDITION
+        params.append(plant_id)
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(query, params).fetchone()
+        return dict(row) if row else None
+
 def get_kpi_detailed_by_id(kpi_spec_id: int, plant_id: int = None):
     """Fetches a single KPI spec by its ID."""
-    all_kpis = get_all_kpis_detailed(plant_id=plant_id)
-    for k in all_kpis:
-        if k['id'] == kpi_spec_id:
-            return k
-    return None
+    return _get_kpi_detailed_where("s.id = ?", kpi_spec_id, plant_id)
+
+def get_kpi_detailed_by_indicator_id(indicator_id: int, plant_id: int = None):
+    """Fetches the KPI spec of an indicator (kpis.indicator_id is unique)."""
+    return _get_kpi_detailed_where("s.indicator_id = ?", indicator_id, plant_id, "get_kpi_detailed_by_indicator_id")
 
 # --- Plants ---
 def get_all_plants(visible_only=False):
     if _handle_db_connection_error("db_plants.db", "get_all_plants"): return []
-    with sqlite3.connect(app_config.get_database_path("db_plants.db")) as conn:
+    with db_connection(app_config.get_database_path("db_plants.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM plants" + (" WHERE visible = 1" if visible_only else "") + " ORDER BY name").fetchall()
         return [dict(r) for r in rows]
@@ -137,14 +147,14 @@ def get_all_plants(visible_only=False):
 # --- Templates ---
 def get_kpi_indicator_templates():
     if _handle_db_connection_error("db_kpi_templates.db", "get_kpi_indicator_templates"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpi_templates.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_templates.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM kpi_indicator_templates ORDER BY name").fetchall()
         return [dict(r) for r in rows]
 
 def get_template_defined_indicators(template_id):
     if _handle_db_connection_error("db_kpi_templates.db", "get_template_defined_indicators"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpi_templates.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_templates.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM template_defined_indicators WHERE template_id = ?", (template_id,)).fetchall()
         return [dict(r) for r in rows]
@@ -153,58 +163,70 @@ def get_template_defined_indicators(template_id):
 def get_kpi_annual_target_values(annual_target_id):
     """Fetches all target values for a specific annual target record."""
     if _handle_db_connection_error("db_kpi_targets.db", "get_kpi_annual_target_values"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM kpi_annual_target_values WHERE annual_target_id = ? ORDER BY target_number", (annual_target_id,)).fetchall()
         return [dict(r) for r in rows]
 
+def _enrich_annual_target(row, target_values):
+    """Attaches normalized target values (and their legacy flat keys) to an annual_targets row."""
+    enriched_data = dict(row)
+    enriched_data['target_values'] = [dict(tv) for tv in target_values]
+    for tv in target_values:
+        tn = tv['target_number']
+        enriched_data[f'annual_target{tn}'] = tv['target_value']
+        enriched_data[f'is_target{tn}_manual'] = tv['is_manual']
+        enriched_data[f'target{tn}_is_formula_based'] = tv['is_formula_based']
+        enriched_data[f'target{tn}_formula'] = tv['formula']
+        enriched_data[f'target{tn}_formula_inputs'] = tv['formula_inputs']
+    return enriched_data
+
 def get_annual_target_entry(year, plant_id, kpi_id):
     if _handle_db_connection_error("db_kpi_targets.db", "get_annual_target_entry"): return None
-    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn:
         conn.row_factory = sqlite3.Row
         row = conn.execute("SELECT * FROM annual_targets WHERE year=? AND plant_id=? AND kpi_id=?", (year, plant_id, kpi_id)).fetchone()
         
         if row:
-            enriched_data = dict(row)
-            target_values = get_kpi_annual_target_values(row['id'])
-            enriched_data['target_values'] = [dict(tv) for tv in target_values]
-            
-            for tv in target_values:
-                tn = tv['target_number']
-                enriched_data[f'annual_target{tn}'] = tv['target_value']
-                enriched_data[f'is_target{tn}_manual'] = tv['is_manual']
-                enriched_data[f'target{tn}_is_formula_based'] = tv['is_formula_based']
-                enriched_data[f'target{tn}_formula'] = tv['formula']
-                enriched_data[f'target{tn}_formula_inputs'] = tv['formula_inputs']
-            
-            return enriched_data
+            return _enrich_annual_target(row, get_kpi_annual_target_values(row['id']))
         return None
 
 def get_annual_targets(plant_id, year):
     if _handle_db_connection_error("db_kpi_targets.db", "get_annual_targets"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM annual_targets WHERE plant_id=? AND year=?", (plant_id, year)).fetchall()
-        
-        enriched_rows = []
-        for row in rows:
-            enriched_data = dict(row)
-            target_values = get_kpi_annual_target_values(row['id'])
-            enriched_data['target_values'] = [dict(tv) for tv in target_values]
-            for tv in target_values:
-                tn = tv['target_number']
-                enriched_data[f'annual_target{tn}'] = tv['target_value']
-                enriched_data[f'is_target{tn}_manual'] = tv['is_manual']
-                enriched_data[f'target{tn}_is_formula_based'] = tv['is_formula_based']
-                enriched_data[f'target{tn}_formula'] = tv['formula']
-                enriched_data[f'target{tn}_formula_inputs'] = tv['formula_inputs']
-            enriched_rows.append(enriched_data)
-            
-        return enriched_rows
+        return [_enrich_annual_target(row, get_kpi_annual_target_values(row['id'])) for row in rows]
+
+def get_annual_target_entries_for_plants(year, plant_ids) -> dict:
+    """
+    Fetches the enriched annual target entries of several plants for one year
+    with two set-based queries. Returns {(plant_id, kpi_id): entry}.
+    """
+    plant_ids = list(plant_ids)
+    if not plant_ids or _handle_db_connection_error("db_kpi_targets.db", "get_annual_target_entries_for_plants"): return {}
+    placeholders = ",".join("?" for _ in plant_ids)
+    with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f"SELECT * FROM annual_targets WHERE year=? AND plant_id IN ({placeholders})", [year, *plant_ids]).fetchall()
+        values = conn.execute(f"""
+            SELECT v.* FROM kpi_annual_target_values v
+            JOIN annual_targets t ON v.annual_target_id = t.id
+            WHERE t.year=? AND t.plant_id IN ({placeholders})
+            ORDER BY v.annual_target_id, v.target_number
+        """, [year, *plant_ids]).fetchall()
+
+    values_by_target = {}
+    for v in values:
+        values_by_target.setdefault(v['annual_target_id'], []).append(v)
+    return {
+        (row['plant_id'], row['kpi_id']): _enrich_annual_target(row, values_by_target.get(row['id'], []))
+        for row in rows
+    }
 
 def get_available_target_numbers_for_kpi(year, plant_id, kpi_id):
     """Returns a list of distinct target numbers available for this KPI/Year/Plant."""
-    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn:
         conn.row_factory = sqlite3.Row
         res = conn.execute("SELECT DISTINCT target_number FROM kpi_annual_target_values v JOIN annual_targets t ON v.annual_target_id = t.id WHERE t.kpi_id=? AND t.year=? AND t.plant_id=?", (kpi_id, year, plant_id)).fetchall()
         return sorted([r['target_number'] for r in res])
@@ -213,7 +235,7 @@ def get_periodic_targets_for_kpi(year, plant_id, kpi_id, period_type, target_num
     if period_type == "Year":
         db_name = "db_kpi_targets.db"
         if _handle_db_connection_error(db_name, "get_periodic_targets_for_kpi"): return []
-        with sqlite3.connect(app_config.get_database_path(db_name)) as conn:
+        with db_connection(app_config.get_database_path(db_name)) as conn:
             conn.row_factory = sqlite3.Row
             rows = conn.execute("""
                 SELECT 'Year' as period, v.target_value as Target 
@@ -232,7 +254,7 @@ def get_periodic_targets_for_kpi(year, plant_id, kpi_id, period_type, target_num
 
     if not db_name or _handle_db_connection_error(db_name, "get_periodic_targets_for_kpi"): return []
 
-    with sqlite3.connect(app_config.get_database_path(db_name)) as conn:
+    with db_connection(app_config.get_database_path(db_name)) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute(f"SELECT {col_name} as period, target_value as Target FROM {table_name} WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?", (year, plant_id, kpi_id, target_number)).fetchall()
         return [dict(r) for r in rows]
@@ -241,14 +263,13 @@ def get_periodic_targets_for_kpi_all_plants(kpi_spec_id: int, period_type: str,
     """Fetches periodic targets for a specific KPI across all plants, including plant names."""
     if period_type == "Year":
         db_name = "db_kpi_targets.db"
-        plants_db_path = app_config.get_database_path("db_plants.db")
         if _handle_db_connection_error(db_name, "get_periodic_targets_for_kpi_all_plants"): return []
 
         query = """
             SELECT t.year, t.plant_id, p.name as plant_name, t.kpi_id, v.target_number, 'Year' as period, v.target_value 
-            FROM kpi_annual_target_values v
-            JOIN annual_targets t ON v.annual_target_id = t.id
-            LEFT JOIN plants_db.plants p ON t.plant_id = p.id
+            FROM targets.kpi_annual_target_values v
+            JOIN targets.annual_targets t ON v.annual_target_id = t.id
+            LEFT JOIN plants.plants p ON t.plant_id = p.id
             WHERE t.kpi_id = ?
         """
         params = [kpi_spec_id]
@@ -256,27 +277,26 @@ def get_periodic_targets_for_kpi_all_plants(kpi_spec_id: int, period_type: str,
             query += " AND t.year = ?"
             params.append(year)
 
-        with sqlite3.connect(app_config.get_database_path(db_name)) as conn:
+        with attached_session() as conn:
             conn.row_factory = sqlite3.Row
-            conn.execute(f"ATTACH DATABASE '{plants_db_path}' AS plants_db")
             rows = conn.execute(query, params).fetchall()
             return [dict(r) for r in rows]
 
     db_map = { "Day": "days", "Week": "weeks", "Month": "months", "Quarter": "quarters" }
     col_map = { "Day": "date_value", "Week": "week_value", "Month": "month_value", "Quarter": "quarter_value" }
     
-    db_name = f"db_kpi_{db_map.get(period_type)}.db"
+    db_suffix = db_map.get(period_type)
+    schema = "main" if period_type == "Day" else db_suffix
+    db_name = f"db_kpi_{db_suffix}.db"
     table_name = "daily_targets" if period_type == "Day" else f"{period_type.lower()}ly_targets"
     col_name = col_map.get(period_type, "period")
     
     if _handle_db_connection_error(db_name, "get_periodic_targets_for_kpi_all_plants"): return []
     
-    plants_db_path = app_config.get_database_path("db_plants.db")
-    
     query = f"""
         SELECT t.year, t.plant_id, p.name as plant_name, t.kpi_id, t.target_number, t.{col_name} as period, t.target_value 
-        FROM {table_name} t
-        LEFT JOIN plants p ON t.plant_id = p.id
+        FROM {schema}.{table_name} t
+        LEFT JOIN plants.plants p ON t.plant_id = p.id
         WHERE t.kpi_id = ?
     """
     params = [kpi_spec_id]
@@ -284,17 +304,15 @@ def get_periodic_targets_for_kpi_all_plants(kpi_spec_id: int, period_type: str,
         query += " AND t.year = ?"
         params.append(year)
         
-    with sqlite3.connect(app_config.get_database_path(db_name)) as conn:
+    with attached_session() as conn:
         conn.row_factory = sqlite3.Row
-        conn.execute(f"ATTACH DATABASE '{plants_db_path}' AS plants_db")
-        query = query.replace("FROM plants p", "FROM plants_db.plants p")
         rows = conn.execute(query, params).fetchall()
         return [dict(r) for r in rows]
 
 def get_all_annual_target_entries_for_export() -> list:
     """Fetches all records from annual_targets for CSV export."""
     if _handle_db_connection_error("db_kpi_targets.db", "get_all_annual_target_entries_for_export"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM annual_targets").fetchall()
         return [dict(r) for r in rows]
@@ -310,7 +328,7 @@ def get_all_periodic_targets_for_export(period_type: str) -> list:
     
     if _handle_db_connection_error(db_name, "get_all_periodic_targets_for_export"): return []
     
-    with sqlite3.connect(app_config.get_database_path(db_name)) as conn:
+    with db_connection(app_config.get_database_path(db_name)) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute(f"SELECT year, plant_id, kpi_id, target_number, {col_name}, target_value FROM {table_name}").fetchall()
         return [dict(r) for r in rows]
@@ -318,7 +336,7 @@ def get_all_periodic_targets_for_export(period_type: str) -> list:
 def get_all_kpi_nodes():
     """Returns all records from the kpi_nodes table."""
     if _handle_db_connection_error("db_kpis.db", "get_all_kpi_nodes"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM kpi_nodes").fetchall()
         return [dict(r) for r in rows]
@@ -326,7 +344,7 @@ def get_all_kpi_nodes():
 def get_all_kpi_plant_visibility():
     """Returns all records from the kpi_plant_visibility table."""
     if _handle_db_connection_error("db_kpis.db", "get_all_kpi_plant_visibility"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT * FROM kpi_plant_visibility").fetchall()
         return [dict(r) for r in rows]
@@ -334,18 +352,9 @@ def get_all_kpi_plant_visibility():
 def get_all_kpi_definitions_for_export():
     """Fetches all KPI definitions enriched with indicator and node names."""
     if _handle_db_connection_error("db_kpis.db", "get_all_kpi_definitions_for_export"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("""
-            WITH RECURSIVE NodePaths AS (
-                SELECT id, name, parent_id, name as path
-                FROM kpi_nodes
-                WHERE parent_id IS NULL
-                UNION ALL
-                SELECT n.id, n.name, n.parent_id, np.path || ' > ' || n.name
-                FROM kpi_nodes n
-                JOIN NodePaths np ON n.parent_id = np.id
-            )
             SELECT 
                 s.id as kpi_id,
                 i.name as indicator_name,
@@ -356,7 +365,7 @@ def get_all_kpi_definitions_for_export():
                 s.visible
             FROM kpis s
             JOIN kpi_indicators i ON s.indicator_id = i.id
-            LEFT JOIN NodePaths np ON i.node_id = np.id
+            LEFT JOIN kpi_node_paths np ON i.node_id = np.node_id
         """).fetchall()
         return [dict(r) for r in rows]
 
@@ -364,47 +373,54 @@ def get_all_annual_targets_enriched():
     """Fetches all annual targets enriched with plant and KPI names."""
     if _handle_db_connection_error("db_kpi_targets.db", "get_all_annual_targets_enriched"): return []
     
-    plants_db = app_config.get_database_path("db_plants.db")
-    kpis_db = app_config.get_database_path("db_kpis.db")
-    
-    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+    with attached_session() as conn:
         conn.row_factory = sqlite3.Row
-        conn.execute(f"ATTACH DATABASE '{plants_db}' AS plants_db")
-        conn.execute(f"ATTACH DATABASE '{kpis_db}' AS kpis_db")
-        
         rows = conn.execute("""
             SELECT 
                 t.*,
                 p.name as plant_name,
                 i.name as indicator_name
-            FROM annual_targets t
-            LEFT JOIN plants_db.plants p ON t.plant_id = p.id
-            LEFT JOIN kpis_db.kpis s ON t.kpi_id = s.id
-            LEFT JOIN kpis_db.kpi_indicators i ON s.indicator_id = i.id
+            FROM targets.annual_targets t
+            LEFT JOIN plants.plants p ON t.plant_id = p.id
+            LEFT JOIN kpis.kpis s ON t.kpi_id = s.id
+            LEFT JOIN kpis.kpi_indicators i ON s.indicator_id = i.id
         """).fetchall()
         return [dict(r) for r in rows]
 
+# period type -> (attached_session() schema, table, period column)
+_UNIFIED_PERIOD_TABLES = {
+    "days": ("main", "daily_targets", "date_value"),
+    "weeks": ("weeks", "weekly_targets", "week_value"),
+    "months": ("months", "monthly_targets", "month_value"),
+    "quarters": ("quarters", "quarterly_targets", "quarter_value"),
+}
+
+def _unified_periodic_targets_sql(conn, func_name):
+    """
+    UNION ALL of the period tables present in an attached_session(), one row per period
+    target; a missing period database is reported and left out. None if all are missing.
+    """
+    present = session_schemas(conn)
+    parts = [
+        f"SELECT year, plant_id, kpi_id, target_number, target_value, '{pt}' AS period_type, {col} AS period_value FROM {schema}.{table}"
+        for pt, (schema, table, col) in _UNIFIED_PERIOD_TABLES.items()
+        if not _handle_db_connection_error(f"db_kpi_{pt}.db", func_name) and schema in present
+    ]
+    return " UNION ALL ".join(parts) or None
+
 def get_all_periodic_targets_unified():
     """Combines all periodic targets (days, weeks, months, quarters) into a single list."""
-    unified_data = []
-    period_types = ["days", "weeks", "months", "quarters"]
-    
-    for pt in period_types:
-        rows = get_all_periodic_targets_for_export(pt)
-        col_name = { "days": "date_value", "weeks": "week_value", "months": "month_value", "quarters": "quarter_value" }[pt]
-        
-        for row in rows:
-            d = dict(row)
-            d['period_type'] = pt
-            d['period_value'] = d.pop(col_name)
-            unified_data.append(d)
-            
-    return unified_data
+    with attached_session() as conn:
+        unified_sql = _unified_periodic_targets_sql(conn, "get_all_periodic_targets_unified")
+        if not unified_sql: return []
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(unified_sql).fetchall()
+        return [dict(r) for r in rows]
 
 def get_daily_targets_for_kpi(year, plant_id, kpi_id, target_number):
     """Fetches all daily targets for a specific KPI/Year/Plant/TargetNum."""
     if _handle_db_connection_error("db_kpi_days.db", "get_daily_targets_for_kpi"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpi_days.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_days.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("""
             SELECT date_value, target_value 
@@ -414,9 +430,45 @@ def get_daily_targets_for_kpi(year, plant_id, kpi_id, target_number):
         """, (year, plant_id, kpi_id, target_number)).fetchall()
         return [dict(r) for r in rows]
 
+def get_daily_target_rows_for_kpis(year, plant_id, kpi_target_pairs) -> list:
+    """
+    Fetches the daily targets of several (kpi_id, target_number) series of one plant/year
+    in a single query. Returns (kpi_id, target_number, day_of_year_index, target_value)
+    tuples ordered by kpi and date, with day_of_year_index starting at 0.
+    """
+    pairs = set(kpi_target_pairs)
+    if not pairs or _handle_db_connection_error("db_kpi_days.db", "get_daily_target_rows_for_kpis"): return []
+    kpi_ids = sorted({k for k, _ in pairs})
+    target_numbers = sorted({t for _, t in pairs})
+    with db_connection(app_config.get_database_path("db_kpi_days.db")) as conn:
+        rows = conn.execute(f"""
+            SELECT kpi_id, target_number, CAST(strftime('%j', date_value) AS INTEGER) - 1, target_value
+            FROM daily_targets
+            WHERE year=? AND plant_id=? AND kpi_id IN ({",".join("?" for _ in kpi_ids)})
+              AND target_number IN ({",".join("?" for _ in target_numbers)})
+            ORDER BY kpi_id, target_number, date_value
+        """, (year, plant_id, *kpi_ids, *target_numbers)).fetchall()
+    return [r for r in rows if (r[0], r[1]) in pairs]
+
+def get_repartition_fingerprints(year, plant_ids) -> dict:
+    """Returns the stored repartition fingerprints of several plants, keyed by (plant_id, kpi_id, target_number)."""
+    plant_ids = list(plant_ids)
+    if not plant_ids or _handle_db_connection_error("db_kpi_days.db", "get_repartition_fingerprints"): return {}
+    placeholders = ",".join("?" for _ in plant_ids)
+    with db_connection(app_config.get_database_path("db_kpi_days.db")) as conn:
+        try:
+            rows = conn.execute(
+                f"SELECT plant_id, kpi_id, target_number, fingerprint FROM repartition_fingerprints WHERE year=? AND plant_id IN ({placeholders})",
+                [year, *plant_ids],
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"WARNING (get_repartition_fingerprints): {e}")
+            return {}
+        return {(r[0], r[1], r[2]): r[3] for r in rows}
+
 def get_distinct_years():
     if _handle_db_connection_error("db_kpi_targets.db", "get_distinct_years"): return []
-    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+    with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT DISTINCT year FROM annual_targets ORDER BY year DESC").fetchall()
         return [dict(r) for r in rows]
@@ -431,7 +483,7 @@ def get_all_global_splits(year: int = None) -> list[dict]:
         params.append(year)
     query += " ORDER BY name"
 
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         conn.row_factory = sqlite3.Row
         try:
             rows = conn.execute(query, params).fetchall()
@@ -451,23 +503,33 @@ def get_lean_targets() -> list[dict]:
     Returns a minimal, high-portability list of target data.
     Columns: Indicator, Plant, Year, PeriodType, PeriodValue, TargetNumber, Value
     """
-    unified = get_all_periodic_targets_unified()
-    if not unified: return []
-    
-    # Enrichment
-    plants = {p['id']: p['name'] for p in get_all_plants()}
-    kpis = {k['id']: k['indicator_name'] for k in get_all_kpis_detailed()}
-    
-    lean_data = []
-    for row in unified:
-        lean_data.append({
-            "Indicator": kpis.get(row['kpi_id'], f"ID:{row['kpi_id']}"),
-            "Plant": plants.get(row['plant_id'], f"ID:{row['plant_id']}"),
-            "Year": row['year'],
-            "PeriodType": row['period_type'],
-            "PeriodValue": row['period_value'],
-            "TargetID": row['target_number'],
-            "Value": row['target_value']
-        })
-    return lean_data
+    with attached_session() as conn:
+        unified_sql = _unified_periodic_targets_sql(conn, "get_lean_targets")
+        if not unified_sql: return []
+        present = session_schemas(conn)
+        # Names fall back to 'ID:<id>' per row, or for all rows when their database is missing
+        indicator_expr, kpi_joins = "'ID:' || u.kpi_id", ""
+        if "kpis" in present:
+            indicator_expr = "COALESCE(i.name, 'ID:' || u.kpi_id)"
+            kpi_joins = """
+            LEFT JOIN kpis.kpis s ON u.kpi_id = s.id
+            LEFT JOIN kpis.kpi_indicators i ON s.indicator_id = i.id"""
+        plant_expr, plant_join = "'ID:' || u.plant_id", ""
+        if "plants" in present:
+            plant_expr = "COALESCE(p.name, 'ID:' || u.plant_id)"
+            plant_join = "LEFT JOIN plants.plants p ON u.plant_id = p.id"
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f"""
+            SELECT
+                {indicator_expr} AS Indicator,
+                {plant_expr} AS Plant,
+                u.year AS Year,
+                u.period_type AS PeriodType,
+                u.period_value AS PeriodValue,
+                u.target_number AS TargetID,
+                u.target_value AS Value
+            FROM ({unified_sql}) u
+            {plant_join}{kpi_joins}
+        """).fetchall()
+        return [dict(r) for r in rows]
 
@@ -247,6 +247,7 @@ class NodeEditorDialog(tk.Toplevel):
                 for e in existing:
                     self.canvas.delete(self.edges_ui[e.id])
                     self.dag.edges.remove(e)
+                self.dag.invalidate()
 
                 # Create new edge
                 edge_id = str(uuid.uuid4())
@@ -295,6 +296,7 @@ class NodeEditorDialog(tk.Toplevel):
             self.canvas.delete(f"socket and {node_id}")
             del self.nodes_ui[node_id]
             del self.dag.nodes[node_id]
+            self.dag.invalidate()
             self.selected_node = None
             
         elif self.selected_edge:
@@ -303,6 +305,7 @@ class NodeEditorDialog(tk.Toplevel):
             if edge:
                 self.canvas.delete(self.edges_ui[edge_id])
                 self.dag.edges.remove(edge)
+                self.dag.invalidate()
                 del self.edges_ui[edge_id]
             self.selected_edge = None
 
@@ -418,7 +421,8 @@ class NodeEditorDialog(tk.Toplevel):
         self.canvas.delete(node_id)
         self.canvas.delete(f"socket and {node_id}")
         
-        # Redraw
+        # Redraw (node data may have changed)
+        self.dag.invalidate()
         node = self.dag.nodes[node_id]
         self._draw_node(node)
         
@@ -5,6 +5,13 @@ import io
 import traceback
 from pathlib import Path
 from src.config.settings import get_database_path
+from src.data_access.connections import db_connection
+from src.kpi_management.hierarchy import rebuild_node_paths
+from src.target_management.periodic_writer import clear_repartition_fingerprints
+from src.kpi_management.dependency_index import rebuild_dependency_index
+
+# Imported target tables whose rows invalidate the repartition fingerprints of their series
+_FINGERPRINTED_TARGET_TABLES = {'annual_targets', 'daily_targets', 'weekly_targets', 'monthly_targets', 'quarterly_targets'}
 
 def get_table_columns(cursor: sqlite3.Cursor, table_name: str) -> list[str]:
     """Fetches the column names for a given table."""
@@ -14,6 +21,8 @@ def get_table_columns(cursor: sqlite3.Cursor, table_name: str) -> list[str]:
 def import_from_zip(zip_path: str):
     """Restores the database state from a ZIP backup by appending data."""
     try:
+        stale_fingerprints = set()  # (year, plant_id, kpi_id) keys; None entry clears all
+        imported_tables = set()
         with zipfile.ZipFile(zip_path, 'r') as zipf:
             # The order is critical to respect foreign key constraints
             import_order = {
@@ -44,7 +53,7 @@ def import_from_zip(zip_path: str):
                     if not data:
                         continue
 
-                    with sqlite3.connect(db_path) as conn:
+                    with db_connection(db_path) as conn:
                         cursor = conn.cursor()
                         db_columns = get_table_columns(cursor, table_name)
                         
@@ -64,8 +73,27 @@ def import_from_zip(zip_path: str):
                         
                         # Execute for all valid rows
                         cursor.executemany(sql, [list(row.values()) for row in valid_data])
+                        if table_name == 'kpi_nodes':
+                            rebuild_node_paths(conn)
                         conn.commit()
 
+                    imported_tables.add(table_name)
+                    if table_name == 'kpis':
+                        stale_fingerprints.add(None)
+                    elif table_name in _FINGERPRINTED_TARGET_TABLES:
+                        if {'year', 'plant_id', 'kpi_id'} <= set(valid_data[0]):
+                            stale_fingerprints.update((r['year'], r['plant_id'], r['kpi_id']) for r in valid_data)
+                        else:
+                            stale_fingerprints.add(None)
+
+        # Imported formula specs bypass the incremental index updates of spec saves
+        if 'kpis' in imported_tables:
+            rebuild_dependency_index()
+
+        # Imported specs or targets change repartition inputs behind the stored fingerprints
+        if stale_fingerprints:
+            clear_repartition_fingerprints(None if None in stale_fingerprints else stale_fingerprints)
+
         return "Database restore/append completed successfully."
 
     except Exception as e:
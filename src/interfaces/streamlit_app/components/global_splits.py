@@ -11,6 +11,8 @@ import math
 from src.kpi_management import splits as kpi_splits_manager
 from src import data_retriever
 from src.services import split_analyzer
+from src.config import settings as app_config
+from src.target_management.repartition import preview_repartition
 from src.interfaces.common_ui.constants import (
     DISTRIBUTION_PROFILE_OPTIONS,
     PROFILE_EVEN,
@@ -254,6 +256,19 @@ def app():
                         st.rerun()
                     except Exception as e: st.error(f"Error: {e}")
 
+            with st.expander("📈 Split Preview (100 units, Incremental)"):
+                try:
+                    preview_year = (years_raw or [datetime.datetime.now().year])[0]
+                    # Same logic and values the update button saves
+                    pv = preview_repartition(preview_year, 100.0, app_config.CALC_TYPE_INCREMENTAL, "universal",
+                                             json.loads(new_values_json), st.session_state[f"edit_split_profile_{split_id}"],
+                                             split.get('profile_params') or {})
+                    fig = px.bar(x=calendar.month_name[1:], y=pv["monthly"], labels={'x': 'Month', 'y': 'Share'},
+                                 title=f"Monthly split for {preview_year}")
+                    fig.update_layout(height=300, margin=dict(l=0, r=0, t=30, b=0))
+                    st.plotly_chart(fig, use_container_width=True, key=f"preview_{split_id}")
+                except Exception as e: st.warning(f"Preview unavailable: {e}")
+
             if st.button("🗑️ Delete Template", use_container_width=True):
                 st.session_state[f"confirm_delete_{split_id}"] = True
 
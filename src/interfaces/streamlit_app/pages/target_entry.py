@@ -176,12 +176,12 @@ def save_all_targets_entry():
         targets_data_map[str(kpi_id)] = targets_data
 
     try:
-        annual_targets_manager.save_annual_targets(
+        result = annual_targets_manager.save_annual_targets(
             year=year,
             plant_id=plant_id,
             targets_data_map=targets_data_map
         )
-        st.success("All targets have been saved.")
+        st.success(f"All targets have been saved ({result['changed_kpis']} KPIs changed, {result['repartitioned_series']} periodic series regenerated).")
         load_kpi_targets_for_entry_target() # Reload data to show updated state
     except Exception as e:
         st.error(f"Error saving targets: {e}")
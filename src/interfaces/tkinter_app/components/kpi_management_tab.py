@@ -360,18 +360,16 @@ class KpiManagementTab(ttk.Frame):
         return expanded
 
     def _evaluate_formula_preview(self, spec) -> float:
-        from src.core.node_engine import KpiDAG
+        from src.core.node_engine import get_compiled_dag
         f_json = spec.get('formula_json')
         f_str = spec.get('formula_string')
         
         try:
             if f_json:
-                dag = KpiDAG.from_json(f_json)
-                return dag.evaluate(lambda kid, tn: 10.0)
+                return get_compiled_dag(f_json).plan.evaluate(lambda kid, tn: 10.0)
             elif f_str:
-                import re
-                processed = re.sub(r'\[\d+\]', '10.0', f_str)
-                return float(eval(processed, {"__builtins__": None}, {"abs": abs, "min": min, "max": max, "round": round}))
+                from src.core.formula_evaluator import compile_formula, evaluate_formula
+                return evaluate_formula(f_str, {f"kpi_{kid}": 10.0 for kid in compile_formula(f_str).kpi_ids})
         except:
             return 0.0
         return 0.0
@@ -494,8 +492,8 @@ class KpiManagementTab(ttk.Frame):
         dialog = MoveNodeDialog(self.app, -1, ind['name'], self.node_cache)
         if dialog.result_parent_id != -999:
             db_path = app_config.get_database_path("db_kpis.db")
-            import sqlite3
-            with sqlite3.connect(db_path) as conn:
+            from src.data_access.connections import db_connection
+            with db_connection(db_path) as conn:
                 conn.execute("UPDATE kpi_indicators SET node_id = ? WHERE id = ?", (dialog.result_parent_id, ind_id))
                 conn.commit()
             self.refresh_tree()
@@ -407,14 +407,7 @@ class ResultsTab(ttk.Frame):
                 return
 
             indicator_actual_id = selected_indicator_details_obj["id"]
-            kpi_spec_obj = next(
-                (
-                    spec
-                    for spec in db_retriever.get_all_kpis_detailed(only_visible=False, plant_id=plant_id_res)
-                    if spec["actual_indicator_id"] == indicator_actual_id
-                ),
-                None,
-            )
+            kpi_spec_obj = db_retriever.get_kpi_detailed_by_indicator_id(indicator_actual_id, plant_id=plant_id_res)
 
             if not kpi_spec_obj:
                 self.summary_label_var_vis.set(
@@ -2,11 +2,11 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 import json
-import re
 from src import data_retriever
 from src.target_management import annual as annual_targets_manager
 from src.kpi_management import specs as kpi_specs_manager
-from src.core.node_engine import KpiDAG
+from src.core.node_engine import get_compiled_dag
+from src.core.formula_evaluator import compile_formula, evaluate_formula
 import datetime
 
 class TargetEntryTab(ttk.Frame):
@@ -338,25 +338,23 @@ class TargetEntryTab(ttk.Frame):
 
         if f_json:
             try:
-                dag = KpiDAG.from_json(f_json)
+                plan = get_compiled_dag(f_json).plan
                 def resolver(id, target_num):
                     target_num = int(target_num)
                     k_data = self.all_kpis_data_cache.get(int(id))
                     if k_data and target_num in k_data['targets']:
                         return k_data['targets'][target_num]['val']
                     return 0.0
-                return dag.evaluate(resolver, default_target_num=tn)
+                return plan.evaluate(resolver, default_target_num=tn)
             except: return 0.0
         elif f_str:
-            processed = f_str
-            for match in re.findall(r'\[(\d+)\]', f_str):
-                mid = int(match)
-                k_data = self.all_kpis_data_cache.get(mid)
-                val = 0.0
-                if k_data and tn in k_data['targets']:
-                    val = k_data['targets'][tn]['val']
-                processed = processed.replace(f"[{match}]", str(val))
-            try: return float(eval(processed, {"__builtins__": None}, {"abs": abs, "min": min, "max": max, "round": round}))
+            try:
+                values = {}
+                for mid in compile_formula(f_str).kpi_ids:
+                    k_data = self.all_kpis_data_cache.get(mid)
+                    if k_data and tn in k_data['targets']:
+                        values[f"kpi_{mid}"] = float(k_data['targets'][tn]['val'])
+                return evaluate_formula(f_str, values)
             except: return 0.0
         return 0.0
 
@@ -391,9 +389,9 @@ class TargetEntryTab(ttk.Frame):
 
         def run():
             try:
-                for pid in target_plant_ids:
-                    annual_targets_manager.save_annual_targets(year, pid, data_map)
-                self.app.after(0, lambda: messagebox.showinfo("Success", "Targets saved successfully."))
+                result = annual_targets_manager.save_annual_targets(year, target_plant_ids, data_map)
+                msg = f"Targets saved successfully.\n{result['changed_kpis']} KPIs changed, {result['repartitioned_series']} periodic series regenerated."
+                self.app.after(0, lambda: messagebox.showinfo("Success", msg))
             except Exception as e:
                 self.app.after(0, lambda: messagebox.showerror("Error", f"Failed to save: {e}"))
 
@@ -5,3 +5,4 @@ from .specs import *
 from .templates import *
 from .visibility import *
 from .splits import *
+from .dependency_index import *
@@ -0,0 +1,180 @@
+# src/kpi_management/dependency_index.py
+import sqlite3
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from src.config import settings as app_config
+from src.data_access.connections import db_connection
+from src.core.dependency_graph import _parse_formula_dependencies
+
+# Persistent KPI -> input KPI edges of every calculated spec (table kpi_formula_dependencies
+# in db_kpis.db), mirrored in memory once loaded. Spec saves update both incrementally,
+# so checking a formula for cycles only walks the KPIs reachable from its new inputs.
+_index_lock = threading.RLock()
+_index_state = {"db_path": None, "dependencies": None}  # dependencies: kpi_id -> set of input kpi_ids
+
+
+def formula_dependencies(spec: dict) -> List[int]:
+    """Input KPI ids of a spec's formula (empty for non-calculated specs)."""
+    if not spec.get("is_calculated"):
+        return []
+    return list(dict.fromkeys(_parse_formula_dependencies(spec)))
+
+
+def _scan_specs(conn, kpi_ids: Optional[Set[int]] = None) -> Dict[int, Set[int]]:
+    rows = conn.execute("SELECT id, formula_json, formula_string, is_calculated FROM kpis WHERE is_calculated = 1").fetchall()
+    dependencies = {}
+    for kpi_id, formula_json, formula_string, is_calculated in rows:
+        if kpi_ids is not None and kpi_id not in kpi_ids:
+            continue
+        deps = formula_dependencies({"formula_json": formula_json, "formula_string": formula_string, "is_calculated": is_calculated})
+        if deps:
+            dependencies[kpi_id] = set(deps)
+    return dependencies
+
+
+def _store_dependencies(conn, dependencies: Dict[int, Set[int]], replace_kpi_ids=None):
+    """Writes index rows within the caller's transaction; replace_kpi_ids=None rewrites the whole table."""
+    try:
+        if replace_kpi_ids is None:
+            conn.execute("DELETE FROM kpi_formula_dependencies")
+        else:
+            conn.executemany("DELETE FROM kpi_formula_dependencies WHERE kpi_id = ?", [(kpi_id,) for kpi_id in replace_kpi_ids])
+        conn.executemany(
+            "INSERT INTO kpi_formula_dependencies (kpi_id, depends_on_kpi_id) VALUES (?, ?)",
+            [(kpi_id, dep) for kpi_id, deps in dependencies.items() for dep in deps],
+        )
+    except sqlite3.OperationalError as e:
+        print(f"WARNING: Could not store the KPI dependency index ({e}); it is kept in memory only.")
+
+
+def _load_dependencies(conn) -> Dict[int, Set[int]]:
+    """
+    Reads the stored index and completes it from the specs: calculated KPIs without
+    rows (e.g. specs saved before the index existed) are parsed and stored, and rows
+    of KPIs that are no longer calculated are dropped.
+    """
+    try:
+        rows = conn.execute("SELECT kpi_id, depends_on_kpi_id FROM kpi_formula_dependencies").fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    dependencies: Dict[int, Set[int]] = {}
+    for kpi_id, dep in rows:
+        dependencies.setdefault(kpi_id, set()).add(dep)
+    calculated = {kpi_id for (kpi_id,) in conn.execute("SELECT id FROM kpis WHERE is_calculated = 1")}
+    stale = set(dependencies) - calculated
+    missing = calculated - set(dependencies)
+    if not stale and not missing:
+        return dependencies
+    for kpi_id in stale:
+        del dependencies[kpi_id]
+    found = _scan_specs(conn, missing) if missing else {}
+    dependencies.update(found)
+    if stale or found:
+        _store_dependencies(conn, found, stale | set(found))
+    return dependencies
+
+
+def rebuild_dependency_index() -> Dict[int, Set[int]]:
+    """Re-parses every calculated spec and rewrites the stored index from scratch."""
+    db_path = str(app_config.get_database_path("db_kpis.db"))
+    with _index_lock:
+        with db_connection(db_path) as conn:
+            dependencies = _scan_specs(conn)
+            _store_dependencies(conn, dependencies)
+        _index_state.update(db_path=db_path, dependencies=dependencies)
+        return dependencies
+
+
+def get_dependency_index(conn=None) -> Dict[int, Set[int]]:
+    """
+    The kpi_id -> input kpi_ids index, loaded from db_kpis.db on first use and
+    completed from the specs it does not cover yet. Do not modify it.
+
+    Spec saves pass their own connection so that loading happens on it before
+    their write; otherwise a connection of its own is used and committed.
+    """
+    db_path = str(app_config.get_database_path("db_kpis.db"))
+    with _index_lock:
+        if _index_state["db_path"] == db_path and _index_state["dependencies"] is not None:
+            return _index_state["dependencies"]
+        if conn is not None:
+            dependencies = _load_dependencies(conn)
+        else:
+            with db_connection(db_path) as own_conn:
+                dependencies = _load_dependencies(own_conn)
+        _index_state.update(db_path=db_path, dependencies=dependencies)
+        return dependencies
+
+
+def invalidate_dependency_index():
+    """Forgets the in-memory index; it is reloaded from the database on next use."""
+    with _index_lock:
+        _index_state.update(db_path=None, dependencies=None)
+
+
+def find_dependency_cycle(kpi_id: int, depends_on: List[int]) -> Optional[List[int]]:
+    """
+    Checks whether giving kpi_id the inputs depends_on would close a cycle, by
+    searching only the KPIs reachable from those inputs. Returns the cycle as
+    [kpi_id, ..., kpi_id], or None.
+    """
+    dependencies = get_dependency_index()
+    parent = {}
+    queue = deque()
+    for dep in dict.fromkeys(depends_on):
+        if dep == kpi_id:
+            return [kpi_id, kpi_id]
+        parent[dep] = kpi_id
+        queue.append(dep)
+    while queue:
+        current = queue.popleft()
+        for dep in dependencies.get(current, ()):
+            if dep == kpi_id:
+                cycle = [kpi_id, current]
+                while cycle[-1] != kpi_id:
+                    cycle.append(parent[cycle[-1]])
+                return cycle[::-1]
+            if dep not in parent:
+                parent[dep] = current
+                queue.append(dep)
+    return None
+
+
+def check_kpi_dependencies(kpi_id: int, spec: dict) -> List[int]:
+    """
+    Returns the input KPI ids of spec's formula for kpi_id, raising ValueError if
+    saving it would create a circular dependency.
+    """
+    deps = formula_dependencies(spec)
+    cycle = find_dependency_cycle(kpi_id, deps)
+    if cycle:
+        msg = f"Formula of KPI {kpi_id} would create a circular dependency: {' -> '.join(map(str, cycle))}."
+        print(f"ERROR: {msg}")
+        raise ValueError(msg)
+    return deps
+
+
+def write_kpi_dependencies(conn, kpi_id: int, deps: List[int]):
+    """Replaces the stored inputs of kpi_id within the caller's transaction on db_kpis.db."""
+    try:
+        conn.execute("DELETE FROM kpi_formula_dependencies WHERE kpi_id = ?", (kpi_id,))
+        conn.executemany(
+            "INSERT INTO kpi_formula_dependencies (kpi_id, depends_on_kpi_id) VALUES (?, ?)",
+            [(kpi_id, dep) for dep in deps],
+        )
+    except sqlite3.OperationalError as e:
+        print(f"WARNING: Could not update the KPI dependency index for KPI {kpi_id} ({e}).")
+        invalidate_dependency_index()
+
+
+def cache_kpi_dependencies(kpi_id: int, deps: List[int]):
+    """Mirrors a committed write_kpi_dependencies in the loaded index, if any."""
+    with _index_lock:
+        dependencies = _index_state["dependencies"]
+        if dependencies is None: return
+        if deps:
+            dependencies[kpi_id] = set(deps)
+        else:
+            dependencies.pop(kpi_id, None)
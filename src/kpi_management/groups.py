@@ -2,6 +2,7 @@
 import sqlite3
 import traceback
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from pathlib import Path
 
 # Function imports from other modules
@@ -55,7 +56,7 @@ def add_kpi_group(name: str) -> int:
             f"DB_KPIS is not properly configured ({db_kpis_path}). Cannot add group."
         )
 
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute("INSERT INTO kpi_groups (name) VALUES (?)", (name,))
@@ -96,7 +97,7 @@ def update_kpi_group(group_id: int, new_name: str):
             f"DB_KPIS is not properly configured ({db_kpis_path}). Cannot update group."
         )
 
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -171,7 +172,7 @@ def delete_kpi_group(group_id: int):
             )
 
         # Collect all indicator IDs from these subgroups
-        with sqlite3.connect(db_kpis_path) as conn_read:
+        with db_connection(db_kpis_path) as conn_read:
             conn_read.row_factory = sqlite3.Row
             for sg_dict in subgroups_in_group:
                 print(
@@ -227,7 +228,7 @@ def delete_kpi_group(group_id: int):
     # delete the kpi_group itself. SQLite's `ON DELETE CASCADE` from kpi_groups
     # to kpi_subgroups will clean up the (now empty of indicators) subgroups.
     print(f"INFO: Proceeding to delete the kpi_groups entry for ID {group_id}.")
-    with sqlite3.connect(db_kpis_path) as conn_delete_group:
+    with db_connection(db_kpis_path) as conn_delete_group:
         try:
             conn_delete_group.execute("PRAGMA foreign_keys = ON;")
             cursor = conn_delete_group.cursor()
@@ -268,7 +269,7 @@ def get_kpi_groups() -> list[dict]:
             f"DB_KPIS is not properly configured ({db_kpis_path}). Cannot retrieve groups."
         )
 
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         conn.row_factory = sqlite3.Row  # This allows accessing columns by name
         try:
             cursor = conn.cursor()
@@ -375,7 +376,7 @@ CREATE TABLE kpi_indicators (
         print(f"\nTest 4: Update group ID {g_id} ('Finance') to 'Financial Planning'")
         update_kpi_group(g_id, "Financial Planning")
         # Verification (manual query)
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
             name = conn.execute(
                 "SELECT name FROM kpi_groups WHERE id = ?", (g_id,)
             ).fetchone()[0]
@@ -387,7 +388,7 @@ CREATE TABLE kpi_indicators (
             "\nTest 5: Update group 'Operations' to 'Financial Planning' (expecting IntegrityError)"
         )
         ops_id = None
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:  # Get ID for "Operations"
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:  # Get ID for "Operations"
             ops_id_row = conn.execute(
                 "SELECT id FROM kpi_groups WHERE name = 'Operations'"
             ).fetchone()
@@ -413,7 +414,7 @@ CREATE TABLE kpi_indicators (
         print(f"\nTest 6: Delete group ID {g_id} ('Financial Planning')")
         delete_kpi_group(g_id)
         # Verification (manual query)
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
             row = conn.execute(
                 "SELECT name FROM kpi_groups WHERE id = ?", (g_id,)
             ).fetchone()
@@ -2,15 +2,66 @@
 import sqlite3
 import traceback
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from pathlib import Path
 
+# kpi_node_paths holds the "Root > Child > Node" path of every node reachable from a
+# root, so spec lookups join one row per KPI instead of walking kpi_nodes recursively.
+# The functions below keep it current in the same transaction as their kpi_nodes change.
+# The DDL and the full rebuild are shared with setup_databases and migration 8.
+NODE_PATHS_DDL = """CREATE TABLE IF NOT EXISTS kpi_node_paths (
+    node_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    FOREIGN KEY (node_id) REFERENCES kpi_nodes(id) ON DELETE CASCADE
+)"""
+
+NODE_PATHS_REBUILD = [
+    "DELETE FROM kpi_node_paths",
+    """INSERT INTO kpi_node_paths (node_id, path)
+    WITH RECURSIVE NodePaths AS (
+        SELECT id, name AS path FROM kpi_nodes WHERE parent_id IS NULL
+        UNION ALL
+        SELECT n.id, np.path || ' > ' || n.name
+        FROM kpi_nodes n
+        JOIN NodePaths np ON n.parent_id = np.id
+    )
+    SELECT id, path FROM NodePaths""",
+]
+
+def rebuild_node_paths(conn):
+    """Recomputes kpi_node_paths for the whole hierarchy within the caller's transaction on db_kpis.db."""
+    for statement in NODE_PATHS_REBUILD:
+        conn.execute(statement)
+
+def _refresh_subtree_paths(conn, node_id: int):
+    """
+    Recomputes the paths of node_id and its descendants from the stored path of its
+    parent. Only valid when the node's parent did not change (add and rename).
+    """
+    conn.execute(
+        """INSERT OR REPLACE INTO kpi_node_paths (node_id, path)
+        WITH RECURSIVE SubPaths AS (
+            SELECT n.id, CASE WHEN n.parent_id IS NULL THEN n.name ELSE p.path || ' > ' || n.name END AS path
+            FROM kpi_nodes n
+            LEFT JOIN kpi_node_paths p ON p.node_id = n.parent_id
+            WHERE n.id = ? AND (n.parent_id IS NULL OR p.path IS NOT NULL)
+            UNION ALL
+            SELECT c.id, sp.path || ' > ' || c.name
+            FROM kpi_nodes c
+            JOIN SubPaths sp ON c.parent_id = sp.id
+        )
+        SELECT id, path FROM SubPaths""",
+        (node_id,),
+    )
+
 def add_node(name: str, parent_id: int = None, node_type: str = 'folder') -> int:
     """Adds a new node to the recursive hierarchy."""
     db_path = app_config.get_database_path("db_kpis.db")
-    with sqlite3.connect(db_path) as conn:
+    with db_connection(db_path) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute("INSERT INTO kpi_nodes (name, parent_id, node_type) VALUES (?, ?, ?)", (name, parent_id, node_type))
+            _refresh_subtree_paths(conn, cursor.lastrowid)
             conn.commit()
             return cursor.lastrowid
         except sqlite3.Error as e:
@@ -20,12 +71,16 @@ def add_node(name: str, parent_id: int = None, node_type: str = 'folder') -> int
 def update_node(node_id: int, name: str = None, parent_id = -999):
     """Updates node properties. Use parent_id=None for root."""
     db_path = app_config.get_database_path("db_kpis.db")
-    with sqlite3.connect(db_path) as conn:
+    with db_connection(db_path) as conn:
         try:
             if name:
                 conn.execute("UPDATE kpi_nodes SET name = ? WHERE id = ?", (name, node_id))
             if parent_id != -999:
                 conn.execute("UPDATE kpi_nodes SET parent_id = ? WHERE id = ?", (parent_id, node_id))
+                # A move can detach or re-attach whole subtrees (or form a cycle): recompute everything
+                rebuild_node_paths(conn)
+            elif name:
+                _refresh_subtree_paths(conn, node_id)
             conn.commit()
         except sqlite3.Error as e:
             print(f"ERROR (update_node): {e}")
@@ -34,9 +89,10 @@ def update_node(node_id: int, name: str = None, parent_id = -999):
 def delete_node(node_id: int):
     """Deletes a node and all its children (recursive due to FK ON DELETE CASCADE)."""
     db_path = app_config.get_database_path("db_kpis.db")
-    with sqlite3.connect(db_path) as conn:
+    with db_connection(db_path) as conn:
         try:
             conn.execute("PRAGMA foreign_keys = ON")
+            # kpi_node_paths rows of the subtree go with it (ON DELETE CASCADE)
             conn.execute("DELETE FROM kpi_nodes WHERE id = ?", (node_id,))
             conn.commit()
         except sqlite3.Error as e:
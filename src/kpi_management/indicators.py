@@ -2,8 +2,11 @@
 import sqlite3
 import traceback
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from pathlib import Path
 
+from src.kpi_management.dependency_index import invalidate_dependency_index
+
 # --- KPI Indicator CRUD Operations ---
 
 def add_kpi_indicator(name: str, node_id: int) -> int:
@@ -11,7 +14,7 @@ def add_kpi_indicator(name: str, node_id: int) -> int:
     Adds a new KPI indicator to a specific node in the recursive hierarchy.
     """
     db_kpis_path = app_config.get_database_path("db_kpis.db")
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -31,7 +34,7 @@ def update_kpi_indicator(indicator_id: int, new_name: str, node_id: int):
     Updates the name and/or parent node of an existing KPI indicator.
     """
     db_kpis_path = app_config.get_database_path("db_kpis.db")
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         try:
             conn.execute(
                 "UPDATE kpi_indicators SET name = ?, node_id = ? WHERE id = ?",
@@ -77,7 +80,7 @@ def delete_kpi_indicator(indicator_id: int):
     kpi_spec_id_to_delete = None
     try:
         # Step 1: Find the kpis.id (kpi_spec_id) associated with this kpi_indicators.id
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn_kpis_read:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn_kpis_read:
             # conn_kpis_read.row_factory = sqlite3.Row # Not strictly needed if only fetching one column
             kpi_spec_row = conn_kpis_read.execute(
                 "SELECT id FROM kpis WHERE indicator_id = ?", (indicator_id,)
@@ -100,7 +103,7 @@ def delete_kpi_indicator(indicator_id: int):
 
         # Delete from annual_targets (db_kpi_targets.db)
         try:
-            with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn_targets:
+            with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn_targets:
                 cursor_targets = conn_targets.cursor()
                 cursor_targets.execute(
                     "DELETE FROM annual_targets WHERE kpi_id = ?", (kpi_spec_id_to_delete,)
@@ -121,12 +124,17 @@ def delete_kpi_indicator(indicator_id: int):
         ]
         for db_file_name_del, table_name_del in periodic_dbs_info:
             try:
-                with sqlite3.connect(app_config.get_database_path(db_file_name_del)) as conn_periodic:
+                with db_connection(app_config.get_database_path(db_file_name_del)) as conn_periodic:
                     cursor_periodic = conn_periodic.cursor()
                     cursor_periodic.execute(
                         f"DELETE FROM {table_name_del} WHERE kpi_id = ?",
                         (kpi_spec_id_to_delete,),
                     )
+                    if table_name_del == "daily_targets":
+                        cursor_periodic.execute(
+                            "DELETE FROM repartition_fingerprints WHERE kpi_id = ?",
+                            (kpi_spec_id_to_delete,),
+                        )
                     conn_periodic.commit()
                     print(f"    Deleted {cursor_periodic.rowcount} rows from {table_name_del} for kpi_id {kpi_spec_id_to_delete}.")
             except sqlite3.Error as e:
@@ -140,7 +148,7 @@ def delete_kpi_indicator(indicator_id: int):
     # Step 3: Delete the kpi_indicator itself.
     # This will also trigger ON DELETE CASCADE for the associated kpis record (if any was left or found).
     print(f"  Proceeding to delete kpi_indicators entry for ID {indicator_id}.")
-    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn_kpis_delete:
+    with db_connection(app_config.get_database_path("db_kpis.db")) as conn_kpis_delete:
         try:
             conn_kpis_delete.execute("PRAGMA foreign_keys = ON;") # Ensure FKs are active
             cursor_delete_indicator = conn_kpis_delete.cursor()
@@ -148,6 +156,7 @@ def delete_kpi_indicator(indicator_id: int):
                 "DELETE FROM kpi_indicators WHERE id = ?", (indicator_id,)
             )
             conn_kpis_delete.commit()
+            invalidate_dependency_index()  # the spec's index rows went with the cascade
             if cursor_delete_indicator.rowcount == 0:
                 print(f"WARNING: No kpi_indicator with ID {indicator_id} found during the final delete step. It might have been deleted already.")
             else:
@@ -165,7 +174,7 @@ def get_kpi_indicators_by_node(node_id: int) -> list[dict]:
     Retrieves all KPI indicators for a given node ID in the recursive hierarchy.
     """
     db_kpis_path = app_config.get_database_path("db_kpis.db")
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         conn.row_factory = sqlite3.Row
         try:
             cursor = conn.cursor()
@@ -203,7 +212,7 @@ if __name__ == "__main__":
 
     # Helper to set up a minimal kpi_nodes for testing
     def setup_minimal_parent_tables_for_indicators(db_path, node_id_to_ensure):
-        with sqlite3.connect(db_path) as conn:
+        with db_connection(db_path) as conn:
             cur = conn.cursor()
             cur.execute("CREATE TABLE IF NOT EXISTS kpi_nodes (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, parent_id INTEGER, node_type TEXT, FOREIGN KEY (parent_id) REFERENCES kpi_nodes(id) ON DELETE CASCADE, UNIQUE (name, parent_id));")
             cur.execute("INSERT OR IGNORE INTO kpi_nodes (id, name, node_type) VALUES (?, ?, ?)", (node_id_to_ensure, f"Test Node {node_id_to_ensure}", "subgroup"))
@@ -255,7 +264,7 @@ if __name__ == "__main__":
         print(f"  SUCCESS: Added 'Revenue' with ID {indicator_id_test}")
 
         # Add a corresponding kpis spec for deletion test
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
             cur = conn.cursor()
             cur.execute(
                 "INSERT INTO kpis (indicator_id, calculation_type, unit_of_measure) VALUES (?, ?, ?)",
@@ -272,7 +281,7 @@ if __name__ == "__main__":
 
         print(f"\nTest 3: Update indicator ID {indicator_id_test} to 'Net Revenue' in node {TEST_SUBGROUP_ID}")
         update_kpi_indicator(indicator_id_test, "Net Revenue", TEST_SUBGROUP_ID)
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
             name = conn.execute("SELECT name FROM kpi_indicators WHERE id = ?", (indicator_id_test,)).fetchone()[0]
             assert name == "Net Revenue", "Indicator name was not updated."
         print(f"  SUCCESS: Indicator ID {indicator_id_test} updated.")
@@ -282,15 +291,15 @@ if __name__ == "__main__":
         print(f"\nTest 4: Delete indicator ID {indicator_id_test} ('Net Revenue')")
         # Add some dummy data to related tables to check deletion
         if kpi_spec_id_for_test_indicator:
-            with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn_t:
+            with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn_t:
                 conn_t.execute("INSERT OR IGNORE INTO annual_targets (kpi_id, year) VALUES (?, ?)", (kpi_spec_id_for_test_indicator, 2023))
                 conn_t.commit()
-            with sqlite3.connect(app_config.get_database_path("db_kpi_days.db")) as conn_d:
+            with db_connection(app_config.get_database_path("db_kpi_days.db")) as conn_d:
                 conn_d.execute("INSERT OR IGNORE INTO daily_targets (kpi_id, date_value) VALUES (?, ?)", (kpi_spec_id_for_test_indicator, "2023-01-01"))
                 conn_d.commit()
 
         delete_kpi_indicator(indicator_id_test)
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
             row = conn.execute("SELECT name FROM kpi_indicators WHERE id = ?", (indicator_id_test,)).fetchone()
             assert row is None, "Indicator was not deleted from kpi_indicators."
             if kpi_spec_id_for_test_indicator:
@@ -298,10 +307,10 @@ if __name__ == "__main__":
                 assert spec_row is None, "Associated kpis spec was not deleted by cascade."
         # Check other DBs
         if kpi_spec_id_for_test_indicator:
-            with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn_t:
+            with db_connection(app_config.get_database_path("db_kpi_targets.db")) as conn_t:
                 target_row = conn_t.execute("SELECT id FROM annual_targets WHERE kpi_id = ?", (kpi_spec_id_for_test_indicator,)).fetchone()
                 assert target_row is None, "Annual target was not deleted."
-            with sqlite3.connect(app_config.get_database_path("db_kpi_days.db")) as conn_d:
+            with db_connection(app_config.get_database_path("db_kpi_days.db")) as conn_d:
                 day_row = conn_d.execute("SELECT id FROM daily_targets WHERE kpi_id = ?", (kpi_spec_id_for_test_indicator,)).fetchone()
                 assert day_row is None, "Daily target was not deleted."
 
@@ -2,9 +2,12 @@
 import sqlite3
 import traceback
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from pathlib import Path # Ensure Path is imported
 
 from src.config.settings import CALC_TYPE_INCREMENTAL, CALC_TYPE_AVERAGE
+from src.core.node_engine import invalidate_compiled_dag
+from src.kpi_management.dependency_index import check_kpi_dependencies, write_kpi_dependencies, cache_kpi_dependencies, get_dependency_index
 
 # --- KPI Specification (kpis table) CRUD Operations ---
 
@@ -23,6 +26,7 @@ def add_kpi_spec(
     """
     Adds a new KPI specification (a record in the 'kpis' table).
     If a spec for the given indicator_id already exists, it attempts to update it.
+    Raises ValueError if the formula would create a circular KPI dependency.
     """
     db_kpis_path = app_config.get_database_path("db_kpis.db")
     if not isinstance(db_kpis_path, Path) or not db_kpis_path.parent.exists():
@@ -36,7 +40,9 @@ def add_kpi_spec(
         print(f"ERROR: {msg}")
         raise ValueError(msg)
 
-    with sqlite3.connect(db_kpis_path) as conn:
+    formula_spec = {"formula_json": formula_json, "formula_string": formula_string, "is_calculated": is_calculated}
+    with db_connection(db_kpis_path) as conn:
+        get_dependency_index(conn)  # loaded before the INSERT takes the write lock
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -54,8 +60,11 @@ def add_kpi_spec(
                     default_distribution_profile,
                 ),
             )
-            conn.commit()
             kpi_spec_id = cursor.lastrowid
+            deps = check_kpi_dependencies(kpi_spec_id, formula_spec)
+            write_kpi_dependencies(conn, kpi_spec_id, deps)
+            conn.commit()
+            cache_kpi_dependencies(kpi_spec_id, deps)
             return kpi_spec_id
         except sqlite3.IntegrityError as e:
             if "UNIQUE constraint failed: kpis.indicator_id" in str(e):
@@ -65,6 +74,7 @@ def add_kpi_spec(
                 existing_kpi_row = cursor.fetchone()
                 if existing_kpi_row:
                     existing_kpi_spec_id = existing_kpi_row[0]
+                    deps = check_kpi_dependencies(existing_kpi_spec_id, formula_spec)
                     cursor.execute(
                         """UPDATE kpis SET description=?, calculation_type=?,
                            unit_of_measure=?, visible=?, formula_json=?, formula_string=?, is_calculated=?, default_distribution_profile=? WHERE id=?""",
@@ -80,7 +90,9 @@ def add_kpi_spec(
                             existing_kpi_spec_id,
                         ),
                     )
+                    write_kpi_dependencies(conn, existing_kpi_spec_id, deps)
                     conn.commit()
+                    cache_kpi_dependencies(existing_kpi_spec_id, deps)
                     return existing_kpi_spec_id
                 raise
             raise
@@ -97,17 +109,21 @@ def update_kpi_spec(
     is_calculated: bool = None,
     default_distribution_profile: str = None,
 ):
-    """Updates an existing KPI specification. Only provided fields (not None) will be updated."""
+    """
+    Updates an existing KPI specification. Only provided fields (not None) will be updated.
+    Raises ValueError if the formula would create a circular KPI dependency.
+    """
     db_kpis_path = app_config.get_database_path("db_kpis.db")
     
     # 1. Fetch existing record to merge
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         conn.row_factory = sqlite3.Row
         existing = conn.execute("SELECT * FROM kpis WHERE id = ?", (kpi_spec_id,)).fetchone()
         if not existing:
             raise ValueError(f"KPI Spec with ID {kpi_spec_id} not found.")
         
         data = dict(existing)
+        old_formula_json = data.get('formula_json')
         
         # 2. Update with provided values
         if indicator_id is not None: data['indicator_id'] = indicator_id
@@ -120,6 +136,14 @@ def update_kpi_spec(
         if is_calculated is not None: data['is_calculated'] = 1 if is_calculated else 0
         if default_distribution_profile is not None: data['default_distribution_profile'] = default_distribution_profile
 
+        # Only a formula whose inputs changed needs the (targeted) cycle check and an index update
+        deps = None
+        if (data['formula_json'], data['formula_string'], data['is_calculated']) != (existing['formula_json'], existing['formula_string'], existing['is_calculated']):
+            get_dependency_index(conn)
+            deps = check_kpi_dependencies(kpi_spec_id, data)
+            if set(deps) == get_dependency_index().get(kpi_spec_id, set()):
+                deps = None
+
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -139,15 +163,22 @@ def update_kpi_spec(
                     kpi_spec_id,
                 ),
             )
+            if deps is not None:
+                write_kpi_dependencies(conn, kpi_spec_id, deps)
             conn.commit()
         except sqlite3.Error as e:
             print(f"ERROR: Database error while updating KPI Spec {kpi_spec_id}: {e}")
             raise
 
+    if deps is not None:
+        cache_kpi_dependencies(kpi_spec_id, deps)
+    if old_formula_json and old_formula_json != data['formula_json']:
+        invalidate_compiled_dag(old_formula_json)
+
 def get_kpi_spec_by_indicator_id(indicator_id: int) -> dict | None:
     """Retrieves a KPI specification by its associated indicator ID."""
     db_kpis_path = app_config.get_database_path("db_kpis.db")
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         conn.row_factory = sqlite3.Row
         try:
             cursor = conn.cursor()
@@ -187,7 +218,7 @@ if __name__ == "__main__":
 
     # Helper to setup minimal tables for specs testing
     def setup_minimal_tables_for_specs(db_path, indicator_id_to_ensure):
-        with sqlite3.connect(db_path) as conn:
+        with db_connection(db_path) as conn:
             cur = conn.cursor()
             # Dependencies: kpi_nodes
             cur.execute("CREATE TABLE IF NOT EXISTS kpi_nodes (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, parent_id INTEGER, node_type TEXT, FOREIGN KEY (parent_id) REFERENCES kpi_nodes(id) ON DELETE CASCADE, UNIQUE (name, parent_id));")
@@ -275,7 +306,7 @@ if __name__ == "__main__":
             updated_kpi_spec_id == kpi_spec_id_created
         ), "Adding spec for existing indicator_id should return the existing kpis.id."
         # Verify update
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
             row = conn.execute(
                 "SELECT description, unit_of_measure FROM kpis WHERE id = ?",
                 (kpi_spec_id_created,),
@@ -298,7 +329,7 @@ if __name__ == "__main__":
             unit_of_measure="GBP",
             visible=False,
         )
-        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
             row = conn.execute(
                 "SELECT description, calculation_type, unit_of_measure, visible FROM kpis WHERE id = ?",
                 (kpi_spec_id_created,),
@@ -3,12 +3,13 @@ import sqlite3
 import json
 import traceback
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from pathlib import Path
 
 def add_global_split(name: str, years: list[int], repartition_logic: str, repartition_values: dict, distribution_profile: str, profile_params: dict, afflicted_indicators: list[dict] = None) -> int:
     """Adds a new global KPI split template and optionally links indicators."""
     db_templates_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         try:
             cursor = conn.cursor()
             # We still keep 'year' in the main table for backward compatibility (first year)
@@ -56,7 +57,7 @@ def update_global_split(split_id: int, **kwargs):
             set_clauses.append(f"{key} = ?")
             params.append(value)
     
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         try:
             cursor = conn.cursor()
             if set_clauses:
@@ -85,7 +86,7 @@ def update_global_split(split_id: int, **kwargs):
 def delete_global_split(split_id: int):
     """Deletes a global KPI split template and its afflicted indicators."""
     db_templates_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         try:
             conn.execute("PRAGMA foreign_keys = ON")
             cursor = conn.cursor()
@@ -99,7 +100,7 @@ def delete_global_split(split_id: int):
 def get_indicators_for_global_split(split_id: int) -> list[dict]:
     """Retrieves all indicators afflicted by a global split."""
     db_templates_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         conn.row_factory = sqlite3.Row
         try:
             return [dict(r) for r in conn.execute("SELECT * FROM global_split_indicators WHERE global_split_id = ?", (split_id,)).fetchall()]
@@ -113,7 +114,7 @@ def update_global_split_indicators(split_id: int, indicators_data: list[dict]):
     indicators_data: list of {'indicator_id': int, 'override_distribution_profile': str|None}
     """
     db_templates_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         try:
             cursor = conn.cursor()
             # Clear existing
@@ -132,7 +133,7 @@ def update_global_split_indicators(split_id: int, indicators_data: list[dict]):
 def get_global_split(split_id: int) -> dict:
     """Retrieves a single global KPI split template."""
     db_templates_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         conn.row_factory = sqlite3.Row
         try:
             row = conn.execute("SELECT * FROM global_kpi_splits WHERE id = ?", (split_id,)).fetchone()
@@ -150,10 +151,36 @@ def get_global_split(split_id: int) -> dict:
             print(f"ERROR: Database error while retrieving global split ID {split_id}. Details: {e}")
             return None
 
+def get_global_splits_by_ids(split_ids) -> dict[int, dict]:
+    """
+    Retrieves several global KPI split templates at once, keyed by ID.
+    Each split carries its 'afflicted_indicators' (with profile overrides).
+    """
+    split_ids = [sid for sid in set(split_ids) if sid is not None]
+    if not split_ids: return {}
+    db_templates_path = app_config.get_database_path("db_kpi_templates.db")
+    placeholders = ",".join("?" for _ in split_ids)
+    with db_connection(db_templates_path) as conn:
+        conn.row_factory = sqlite3.Row
+        try:
+            results = {}
+            for row in conn.execute(f"SELECT * FROM global_kpi_splits WHERE id IN ({placeholders})", split_ids).fetchall():
+                res = dict(row)
+                res['repartition_values'] = json.loads(res['repartition_values'])
+                res['profile_params'] = json.loads(res['profile_params'])
+                res['afflicted_indicators'] = []
+                results[res['id']] = res
+            for ind in conn.execute(f"SELECT * FROM global_split_indicators WHERE global_split_id IN ({placeholders})", split_ids).fetchall():
+                results[ind['global_split_id']]['afflicted_indicators'].append(dict(ind))
+            return results
+        except sqlite3.Error as e:
+            print(f"ERROR: Database error while retrieving global splits {split_ids}. Details: {e}")
+            return {}
+
 def get_global_splits_for_indicator(indicator_id: int) -> list[dict]:
     """Retrieves all global splits that affect a specific indicator."""
     db_templates_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         conn.row_factory = sqlite3.Row
         try:
             rows = conn.execute("""
@@ -191,7 +218,7 @@ def get_all_global_splits(year: int = None) -> list[dict]:
     
     query += " ORDER BY name"
 
-    with sqlite3.connect(db_templates_path) as conn:
+    with db_connection(db_templates_path) as conn:
         conn.row_factory = sqlite3.Row
         try:
             rows = conn.execute(query, params).fetchall()
@@ -2,6 +2,7 @@
 import sqlite3
 import traceback
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from pathlib import Path
 
 # CALC_TYPE constants might be needed by _apply_template_indicator_to_new_subgroup
@@ -137,7 +138,7 @@ def add_kpi_subgroup(name: str, group_id: int, indicator_template_id: int = None
 
 
     subgroup_id = None
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -221,7 +222,7 @@ def update_kpi_subgroup(subgroup_id: int, new_name: str, group_id: int, new_temp
     else: # If data_retriever is mocked, we can't get current state easily. Proceed with caution.
         print(f"WARNING: Cannot fetch current subgroup info for ID {subgroup_id} due to missing data_retriever.")
         # We need at least the old template ID for comparison. We'll have to query it directly if possible.
-        with sqlite3.connect(db_kpis_path) as conn_read_old_tpl:
+        with db_connection(db_kpis_path) as conn_read_old_tpl:
             row = conn_read_old_tpl.execute("SELECT indicator_template_id, name FROM kpi_subgroups WHERE id = ?", (subgroup_id,)).fetchone()
             if not row:
                 print(f"ERROR: KPI Subgroup with ID {subgroup_id} not found (direct query). Cannot update.")
@@ -231,7 +232,7 @@ def update_kpi_subgroup(subgroup_id: int, new_name: str, group_id: int, new_temp
 
     old_template_id = current_subgroup_info_dict.get("indicator_template_id") if current_subgroup_info_dict else None
 
-    with sqlite3.connect(db_kpis_path) as conn_update:
+    with db_connection(db_kpis_path) as conn_update:
         try:
             cursor = conn_update.cursor()
             cursor.execute(
@@ -334,7 +335,7 @@ def delete_kpi_subgroup(subgroup_id: int):
 
     indicators_in_subgroup_ids = []
     try:
-        with sqlite3.connect(db_kpis_path) as conn_read:
+        with db_connection(db_kpis_path) as conn_read:
             conn_read.row_factory = sqlite3.Row
             indicators_rows = conn_read.execute(
                 "SELECT id FROM kpi_indicators WHERE subgroup_id = ?", (subgroup_id,)
@@ -359,7 +360,7 @@ def delete_kpi_subgroup(subgroup_id: int):
 
     # After all indicators are deleted, delete the subgroup itself.
     print(f"  Proceeding to delete the kpi_subgroups entry for ID {subgroup_id}.")
-    with sqlite3.connect(db_kpis_path) as conn_delete_sg:
+    with db_connection(db_kpis_path) as conn_delete_sg:
         try:
             conn_delete_sg.execute("PRAGMA foreign_keys = ON;") # Good practice
             cursor = conn_delete_sg.cursor()
@@ -401,7 +402,7 @@ def get_kpi_subgroups_by_group_revised(group_id: int) -> list[dict]:
         db_kpi_templates_path = None # Mark as unavailable
 
     subgroups_data = []
-    with sqlite3.connect(db_kpis_path) as conn_kpis:
+    with db_connection(db_kpis_path) as conn_kpis:
         conn_kpis.row_factory = sqlite3.Row
         try:
             cursor_kpis = conn_kpis.cursor()
@@ -413,7 +414,7 @@ def get_kpi_subgroups_by_group_revised(group_id: int) -> list[dict]:
 
             template_names_map = {}
             if db_kpi_templates_path:
-                with sqlite3.connect(db_kpi_templates_path) as conn_templates:
+                with db_connection(db_kpi_templates_path) as conn_templates:
                     conn_templates.row_factory = sqlite3.Row
                     cursor_templates = conn_templates.cursor()
                     # Fetch all template names once for efficiency
@@ -445,7 +446,7 @@ if __name__ == "__main__":
 
     def setup_minimal_tables_for_subgroups(db_kpis_path, db_templates_path, group_id, template_id):
         # Setup in DB_KPIS
-        with sqlite3.connect(db_kpis_path) as conn:
+        with db_connection(db_kpis_path) as conn:
             cur = conn.cursor()
             cur.execute("CREATE TABLE IF NOT EXISTS kpi_nodes (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, parent_id INTEGER, node_type TEXT, FOREIGN KEY (parent_id) REFERENCES kpi_nodes(id) ON DELETE CASCADE, UNIQUE (name, parent_id));")
             cur.execute("INSERT OR IGNORE INTO kpi_nodes (id, name, node_type) VALUES (?, 'Test Group for Subgroups', 'group')", (group_id,))
@@ -460,7 +461,7 @@ if __name__ == "__main__":
             conn.commit()
 
         # Setup in DB_KPI_TEMPLATES
-        with sqlite3.connect(db_templates_path) as conn_tpl:
+        with db_connection(db_templates_path) as conn_tpl:
             cur_tpl = conn_tpl.cursor()
             cur_tpl.execute("CREATE TABLE IF NOT EXISTS kpi_indicator_templates (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE, description TEXT);")
             cur_tpl.execute("INSERT OR IGNORE INTO kpi_indicator_templates (id, name, description) VALUES (?, 'Test Template for Subgroups', 'Desc')", (template_id,))
@@ -513,7 +514,7 @@ if __name__ == "__main__":
             assert isinstance(subgroup_id_with_template, int)
             print(f"  SUCCESS: Added 'Support Team B' with ID {subgroup_id_with_template} and applied template.")
             # Verification: Check if indicators from template were created in DB_KPIS
-            with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+            with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
                 indicators_from_tpl = conn.execute("SELECT name FROM kpi_indicators WHERE subgroup_id = ?", (subgroup_id_with_template,)).fetchall()
                 indicator_names_from_tpl = {row[0] for row in indicators_from_tpl}
                 assert "Tpl Ind 1" in indicator_names_from_tpl and "Tpl Ind 2" in indicator_names_from_tpl
@@ -526,7 +527,7 @@ if __name__ == "__main__":
         else:
             update_kpi_subgroup(subgroup_id_created, "Sales Team Alpha", TEST_GROUP_ID, new_template_id=TEST_TEMPLATE_ID)
             # Verification
-            with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+            with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
                 row = conn.execute("SELECT name, indicator_template_id FROM kpi_subgroups WHERE id = ?", (subgroup_id_created,)).fetchone()
                 assert row and row[0] == "Sales Team Alpha" and row[1] == TEST_TEMPLATE_ID
                 indicators_after_update = conn.execute("SELECT name FROM kpi_indicators WHERE subgroup_id = ?", (subgroup_id_created,)).fetchall()
@@ -542,7 +543,7 @@ if __name__ == "__main__":
         else:
             # If indicators were created (e.g. from template in Test 3), they should be deleted.
             delete_kpi_subgroup(subgroup_id_created)
-            with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+            with db_connection(app_config.get_database_path("db_kpis.db")) as conn:
                 row = conn.execute("SELECT id FROM kpi_subgroups WHERE id = ?", (subgroup_id_created,)).fetchone()
                 assert row is None, "Subgroup was not deleted."
                 indicators_left = conn.execute("SELECT id FROM kpi_indicators WHERE subgroup_id = ?", (subgroup_id_created,)).fetchall()
@@ -2,6 +2,7 @@
 import sqlite3
 import traceback
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from pathlib import Path
 
 from src.config.settings import CALC_TYPE_INCREMENTAL, CALC_TYPE_AVERAGE
@@ -47,7 +48,7 @@ def _propagate_template_indicator_change(
     
     nodes_to_update = []
     try:
-        with sqlite3.connect(db_kpis_path) as conn:
+        with db_connection(db_kpis_path) as conn:
             conn.row_factory = sqlite3.Row
             if specific_node_ids:
                 placeholders = ",".join("?" for _ in specific_node_ids)
@@ -59,7 +60,7 @@ def _propagate_template_indicator_change(
         print(f"ERROR: {e}")
         return
 
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         conn.row_factory = sqlite3.Row
         for node_row in nodes_to_update:
             node_id = node_row["id"]
@@ -86,7 +87,7 @@ def _propagate_template_indicator_change(
 def add_kpi_indicator_template(name: str, description: str = "") -> int:
     """Adds a new KPI indicator template to DB_KPI_TEMPLATES."""
     db_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_path) as conn:
+    with db_connection(db_path) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -105,7 +106,7 @@ def delete_kpi_indicator_template(template_id: int):
     db_kpis_path = app_config.get_database_path("db_kpis.db")
 
     linked_nodes = []
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         conn.row_factory = sqlite3.Row
         rows = conn.execute("SELECT id FROM kpi_nodes WHERE indicator_template_id = ?", (template_id,)).fetchall()
         linked_nodes = [r["id"] for r in rows]
@@ -116,19 +117,19 @@ def delete_kpi_indicator_template(template_id: int):
             _propagate_template_indicator_change(template_id, d, "remove", linked_nodes)
 
     # Unlink
-    with sqlite3.connect(db_kpis_path) as conn:
+    with db_connection(db_kpis_path) as conn:
         conn.execute("UPDATE kpi_nodes SET indicator_template_id = NULL WHERE indicator_template_id = ?", (template_id,))
         conn.commit()
 
     # Delete Template
-    with sqlite3.connect(db_tpl_path) as conn:
+    with db_connection(db_tpl_path) as conn:
         conn.execute("PRAGMA foreign_keys = ON")
         conn.execute("DELETE FROM kpi_indicator_templates WHERE id = ?", (template_id,))
         conn.commit()
 
 def add_indicator_definition_to_template(template_id, indicator_name_in_template, default_calculation_type, default_unit_of_measure, default_visible=True, default_description=""):
     db_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_path) as conn:
+    with db_connection(db_path) as conn:
         conn.execute("""INSERT INTO template_defined_indicators 
                      (template_id, indicator_name_in_template, default_description, default_calculation_type, default_unit_of_measure, default_visible)
                      VALUES (?,?,?,?,?,?)""", (template_id, indicator_name_in_template, default_description, default_calculation_type, default_unit_of_measure, 1 if default_visible else 0))
@@ -145,7 +146,7 @@ def add_indicator_definition_to_template(template_id, indicator_name_in_template
 
 def update_indicator_definition_in_template(definition_id, template_id, name, calc_type, unit, visible, description):
     db_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_path) as conn:
+    with db_connection(db_path) as conn:
         conn.execute("""UPDATE template_defined_indicators SET
                      indicator_name_in_template=?, default_description=?, default_calculation_type=?, default_unit_of_measure=?, default_visible=?
                      WHERE id=?""", (name, description, calc_type, unit, 1 if visible else 0, definition_id))
@@ -161,7 +162,7 @@ def update_indicator_definition_in_template(definition_id, template_id, name, ca
 
 def remove_indicator_definition_from_template(definition_id):
     db_path = app_config.get_database_path("db_kpi_templates.db")
-    with sqlite3.connect(db_path) as conn:
+    with db_connection(db_path) as conn:
         conn.row_factory = sqlite3.Row
         row = conn.execute("SELECT * FROM template_defined_indicators WHERE id=?", (definition_id,)).fetchone()
         if not row: return
@@ -2,6 +2,7 @@ import sqlite3
 import traceback
 
 from src.config import settings as app_config
+from src.data_access.connections import db_connection
 from src.config.settings import get_database_path
 
 def _get_db_kpis_path():
@@ -17,7 +18,7 @@ def set_kpi_plant_visibility(kpi_id: int, plant_id: int, is_enabled: bool):
     If the entry does not exist, it will be created.
     """
     _validate_db_path(_get_db_kpis_path(), "DB_KPIS")
-    with sqlite3.connect(_get_db_kpis_path()) as conn:
+    with db_connection(_get_db_kpis_path()) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -33,7 +34,7 @@ def update_plant_visibility(kpi_id: int, visibility_data: list):
     visibility_data is a list of dicts: [{'plant_id': int, 'is_enabled': bool}]
     """
     _validate_db_path(_get_db_kpis_path(), "DB_KPIS")
-    with sqlite3.connect(_get_db_kpis_path()) as conn:
+    with db_connection(_get_db_kpis_path()) as conn:
         try:
             cursor = conn.cursor()
             for entry in visibility_data:
@@ -50,7 +51,7 @@ def get_kpi_plant_visibility(kpi_id: int, plant_id: int) -> bool:
     Returns True if enabled, False if disabled, and True if no specific entry exists (default).
     """
     _validate_db_path(_get_db_kpis_path(), "DB_KPIS")
-    with sqlite3.connect(_get_db_kpis_path()) as conn:
+    with db_connection(_get_db_kpis_path()) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute(
@@ -67,7 +68,7 @@ def get_plant_visibility_for_kpi(kpi_id: int) -> list:
     Each item in the list is a dictionary with 'plant_id' and 'is_enabled'.
     """
     _validate_db_path(_get_db_kpis_path(), "DB_KPIS")
-    with sqlite3.connect(_get_db_kpis_path()) as conn:
+    with db_connection(_get_db_kpis_path()) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute(
@@ -85,7 +86,7 @@ def get_kpis_for_plant(plant_id: int) -> list:
     Each item in the list is a dictionary with 'kpi_id' and 'is_enabled'.
     """
     _validate_db_path(_get_db_kpis_path(), "DB_KPIS")
-    with sqlite3.connect(_get_db_kpis_path()) as conn:
+    with db_connection(_get_db_kpis_path()) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute(
@@ -99,7 +100,7 @@ def delete_kpi_plant_visibility(kpi_id: int, plant_id: int):
     This effectively reverts to the default visibility (True) for that pair.
     """
     _validate_db_path(_get_db_kpis_path(), "DB_KPIS")
-    with sqlite3.connect(_get_db_kpis_path()) as conn:
+    with db_connection(_get_db_kpis_path()) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -4,6 +4,7 @@ import traceback
 from pathlib import Path
 
 from src.config.settings import get_database_path
+from src.data_access.connections import db_connection
 
 # --- Configuration Imports ---
 DB_PLANTS = get_database_path('db_plants.db')
@@ -23,7 +24,7 @@ def _validate_db_path(db_path_obj, db_name_str):
 def add_plant(name: str, description: str = "", visible: bool = True, color: str = "#000000") -> int:
     """Adds a new plant to the database."""
     _validate_db_path(DB_PLANTS, "DB_PLANTS")
-    with sqlite3.connect(DB_PLANTS) as conn:
+    with db_connection(DB_PLANTS) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -45,7 +46,7 @@ def update_plant(
 ):
     """Updates an existing plant's details."""
     _validate_db_path(DB_PLANTS, "DB_PLANTS")
-    with sqlite3.connect(DB_PLANTS) as conn:
+    with db_connection(DB_PLANTS) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -70,7 +71,7 @@ def update_plant(
 def update_plant_color(plant_id: int, color: str):
     """Updates the color of an existing plant."""
     _validate_db_path(DB_PLANTS, "DB_PLANTS")
-    with sqlite3.connect(DB_PLANTS) as conn:
+    with db_connection(DB_PLANTS) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute(
@@ -92,7 +93,7 @@ def is_plant_referenced(plant_id: int) -> bool:
     """Checks if a plant is referenced in the annual_targets table."""
     _validate_db_path(DB_TARGETS, "DB_TARGETS")
     try:
-        with sqlite3.connect(DB_TARGETS) as conn_targets:
+        with db_connection(DB_TARGETS) as conn_targets:
             cursor = conn_targets.cursor()
             cursor.execute(
                 "SELECT 1 FROM annual_targets WHERE plant_id = ? LIMIT 1",
@@ -108,7 +109,7 @@ def is_plant_referenced(plant_id: int) -> bool:
 def get_plant_by_id(plant_id: int) -> dict | None:
     """Retrieves a single plant by its ID."""
     _validate_db_path(DB_PLANTS, "DB_PLANTS")
-    with sqlite3.connect(DB_PLANTS) as conn:
+    with db_connection(DB_PLANTS) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute("SELECT id, name, description, visible, color FROM plants WHERE id = ?", (plant_id,))
@@ -126,7 +127,7 @@ def delete_plant(plant_id: int, force_delete_if_referenced: bool = False):
                 f"Plant ID {plant_id} is referenced in targets and cannot be deleted."
             )
 
-    with sqlite3.connect(DB_PLANTS) as conn:
+    with db_connection(DB_PLANTS) as conn:
         try:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plants WHERE id = ?", (plant_id,))
@@ -147,7 +148,7 @@ if __name__ == "__main__":
     plant_id_created = None
 
     def setup_minimal_tables_for_plants(db_plants_path, db_targets_path):
-        with sqlite3.connect(db_plants_path) as conn_s:
+        with db_connection(db_plants_path) as conn_s:
             cur_s = conn_s.cursor()
             cur_s.execute(
                 """
@@ -160,7 +161,7 @@ if __name__ == "__main__":
             """
             )
             conn_s.commit()
-        with sqlite3.connect(db_targets_path) as conn_t:
+        with db_connection(db_targets_path) as conn_t:
             cur_t = conn_t.cursor()
             cur_t.execute(
                 """
@@ -226,7 +227,7 @@ if __name__ == "__main__":
             False,
             "#0000FF"
         )
-        with sqlite3.connect(DB_PLANTS) as conn:
+        with db_connection(DB_PLANTS) as conn:
             row = conn.execute(
                 "SELECT name, description, visible, color FROM plants WHERE id = ?",
                 (plant_id_created,),
@@ -242,7 +243,7 @@ if __name__ == "__main__":
 
         print(f"\nTest 4: Update plant color for ID {plant_id_created}")
         update_plant_color(plant_id_created, "#FFFF00")
-        with sqlite3.connect(DB_PLANTS) as conn:
+        with db_connection(DB_PLANTS) as conn:
             row = conn.execute(
                 "SELECT color FROM plants WHERE id = ?",
                 (plant_id_created,),
@@ -254,7 +255,7 @@ if __name__ == "__main__":
             f"\nTest 5: Delete plant ID {plant_id_created} (no references)"
         )
         delete_plant(plant_id_created)
-        with sqlite3.connect(DB_PLANTS) as conn:
+        with db_connection(DB_PLANTS) as conn:
             row = conn.execute(
                 "SELECT id FROM plants WHERE id = ?", (plant_id_created,)
             ).fetchone()
@@ -266,7 +267,7 @@ if __name__ == "__main__":
             "\nTest 6: Attempt to delete plant referenced in targets (expecting ValueError)"
         )
         ref_plant_id = add_plant("Referenced Plant", "Test for delete constraint", True, "#CCCCCC")
-        with sqlite3.connect(DB_TARGETS) as conn_t:
+        with db_connection(DB_TARGETS) as conn_t:
             conn_t.execute(
                 "INSERT INTO annual_targets (year, plant_id, kpi_id) VALUES (?,?,?)",
                 (2023, ref_plant_id, 1),
@@ -284,12 +285,12 @@ if __name__ == "__main__":
 
         print(f"\nTest 7: Force delete plant ID {ref_plant_id} (referenced)")
         delete_plant(ref_plant_id, force_delete_if_referenced=True)
-        with sqlite3.connect(DB_PLANTS) as conn:
+        with db_connection(DB_PLANTS) as conn:
             row = conn.execute(
                 "SELECT id FROM plants WHERE id = ?", (ref_plant_id,)
             ).fetchone()
             assert row is None, "Plant was not force deleted."
-        with sqlite3.connect(DB_TARGETS) as conn_t:
+        with db_connection(DB_TARGETS) as conn_t:
             target_row = conn_t.execute(
                 "SELECT id FROM annual_targets WHERE plant_id = ?",
                 (ref_plant_id,),
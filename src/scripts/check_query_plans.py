@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+# Add project root to sys.path to allow imports from src
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from src.data_access.migrations import HOT_QUERIES, check_query_plans
+
+
+def main():
+    """Asserts that every hot retriever query is answered through an index on the configured databases."""
+    problems = check_query_plans()
+    for db_name, sql, plan in problems:
+        print(f"NO INDEX ({db_name}): {sql}")
+        for step in plan:
+            print(f"    {step}")
+    assert not problems, f"{len(problems)} of {len(HOT_QUERIES)} hot queries do not use an index."
+    print(f"All {len(HOT_QUERIES)} hot queries use an index.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+# test_bulk_repartition.py
+import sys
+import json
+import sqlite3
+import calendar
+import datetime
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+# Add project root to sys.path to allow imports from src
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from src.config import settings as app_config
+
+# Work on scratch databases: some modules resolve their database paths on import
+scratch_dir = tempfile.mkdtemp(prefix="kpi_bulk_repartition_")
+app_config.SETTINGS["database_base_dir"] = scratch_dir
+app_config.SETTINGS["csv_export_base_dir"] = str(Path(scratch_dir) / "csv_exports")
+
+from src.data_access.setup import setup_databases
+from src.plants_management.crud import add_plant
+from src.kpi_management.hierarchy import add_node
+from src.kpi_management.indicators import add_kpi_indicator
+from src.kpi_management.specs import add_kpi_spec
+from src.kpi_management.splits import add_global_split
+from src.core.node_engine import KpiDAG
+from src.core.formula_evaluator import evaluate_formula
+from src.utils.repartition_utils import (
+    get_weighted_proportions,
+    get_sinusoidal_proportions,
+    get_date_ranges_for_quarters,
+)
+from src.target_management.annual import save_annual_targets
+from src.target_management.repartition import (
+    _get_period_allocations,
+    _aggregate_periodic_targets,
+    calculate_and_save_repartitions_bulk,
+    preview_repartition,
+)
+
+C = app_config.CALCULATION_CONSTANTS
+INC, AVG = app_config.CALC_TYPE_INCREMENTAL, app_config.CALC_TYPE_AVERAGE
+YEAR_LOGIC, MONTH_LOGIC = C["REPARTITION_LOGIC_YEAR"], C["REPARTITION_LOGIC_MONTH"]
+QUARTER_LOGIC, WEEK_LOGIC = C["REPARTITION_LOGIC_QUARTER"], C["REPARTITION_LOGIC_WEEK"]
+EVEN, PROGRESSIVE, SINUSOIDAL = C["PROFILE_EVEN"], C["PROFILE_ANNUAL_PROGRESSIVE"], C["PROFILE_TRUE_ANNUAL_SINUSOIDAL"]
+MONTHS = list(calendar.month_name[1:])
+TOLERANCE = 1e-6
+
+# name -> (calculation type, repartition logic, repartition values, profile, profile params, annual target)
+RULE_BASED_KPIS = {
+    "Year even": (INC, YEAR_LOGIC, {}, EVEN, {}, 3650.0),
+    "Month weights": (INC, MONTH_LOGIC, {m: i + 1 for i, m in enumerate(MONTHS)}, EVEN, {}, 1200.0),
+    "Quarter weights": (INC, QUARTER_LOGIC, {"Q1": 10, "Q2": 20, "Q3": 30, "Q4": 40}, EVEN, {}, 400.0),
+    "Week weights": (INC, WEEK_LOGIC, {"2025-W01": 5, "2024-W10": 10, "2025-W20": 3}, EVEN, {}, 520.0),
+    "Progressive": (INC, YEAR_LOGIC, {}, PROGRESSIVE, {}, 730.0),
+    "Sinusoidal events": (INC, YEAR_LOGIC, {}, SINUSOIDAL, {"sine_amplitude": 0.3, "sine_phase": 1.0, "events": [
+        {"start_date": "2024-06-01", "end_date": "2024-06-30", "multiplier": 1.5, "addition": 2},
+        {"start_date": "2025-06-15", "end_date": "2025-07-10", "multiplier": 0.5, "addition": 0},
+    ]}, 999.0),
+    "Month events": (INC, MONTH_LOGIC, {m: 6 + (i % 3) for i, m in enumerate(MONTHS)}, EVEN, {"events": [
+        {"start_date": "2023-12-20", "end_date": "2024-01-05", "multiplier": 0.5, "addition": 1.0},
+        {"start_date": "2025-03-01", "end_date": "2025-03-10", "multiplier": 2.0, "addition": 1.0},
+        {"start_date": "2025-03-05", "end_date": "2025-03-20", "multiplier": 1.2, "addition": 0.5},
+    ]}, 800.0),
+    "Average months": (AVG, MONTH_LOGIC, {m: 90 + i for i, m in enumerate(MONTHS)}, PROGRESSIVE, {}, 50.0),
+    "Average weeks": (AVG, WEEK_LOGIC, {"2025-W03": 120, "2024-W52": 80}, EVEN, {"events": [
+        {"start_date": "2025-01-01", "end_date": "2025-01-31", "multiplier": 1.1, "addition": 0.0},
+    ]}, 75.0),
+    "Average quarters": (AVG, QUARTER_LOGIC, {"Q1": 110, "Q3": 90}, EVEN, {}, 20.0),
+}
+
+
+def _week_key(d: datetime.date) -> str:
+    iso = d.isocalendar()
+    return f"{iso[0]:04d}-W{iso[1]:02d}"
+
+
+def _dates_of(year: int) -> list:
+    return [datetime.date(year, 1, 1) + datetime.timedelta(days=i) for i in range(366 if calendar.isleap(year) else 365)]
+
+
+def _reconcile(daily: np.ndarray, annual: float, calc_type: str) -> np.ndarray:
+    current = np.sum(daily) if calc_type == INC else np.mean(daily)
+    diff = annual - current
+    if abs(diff) >= 1e-9:
+        daily += diff / daily.size
+    return daily
+
+
+def _reference_daily_values(year: int, annual: float, calc_type: str, logic: str, values: dict, profile: str, params: dict) -> np.ndarray:
+    """Daily values of a rule-based series computed day by day, as the repartition did before the calendar engine."""
+    dates = _dates_of(year)
+    n = len(dates)
+    allocations = _get_period_allocations(annual, logic, values, year, calc_type, dates)
+    daily = np.zeros(n)
+
+    if calc_type == INC:
+        if profile == EVEN:
+            if logic == YEAR_LOGIC or not allocations:
+                daily.fill(annual / n)
+            else:
+                days_per_week = Counter(_week_key(d) for d in dates)
+                quarter_ranges = get_date_ranges_for_quarters(year)
+                for i, d in enumerate(dates):
+                    if logic == MONTH_LOGIC:
+                        daily[i] = allocations.get(d.month - 1, 0.0) / calendar.monthrange(year, d.month)[1]
+                    elif logic == QUARTER_LOGIC:
+                        q_idx = (d.month - 1) // 3
+                        start, end = quarter_ranges[q_idx + 1]
+                        daily[i] = allocations.get(q_idx, 0.0) / ((end - start).days + 1)
+                    elif logic == WEEK_LOGIC:
+                        daily[i] = allocations.get(_week_key(d), 0.0) / days_per_week[_week_key(d)]
+        elif profile == PROGRESSIVE:
+            if logic == YEAR_LOGIC:
+                daily = np.array([annual * p for p in get_weighted_proportions(n, 0.8, 1.2, decreasing=True)])
+            else:
+                daily.fill(annual / n)
+        elif profile == SINUSOIDAL:
+            props = get_sinusoidal_proportions(n, float(params.get("sine_amplitude", 0.1)), float(params.get("sine_phase", 0.0)))
+            daily = np.array([annual * p for p in props])
+        else:
+            daily.fill(annual / n)
+    else:
+        factors = np.linspace(0.8, 1.2, n)
+        for i, d in enumerate(dates):
+            base_avg = annual
+            if logic == MONTH_LOGIC:
+                base_avg *= allocations.get(d.month - 1, 1.0)
+            elif logic == WEEK_LOGIC:
+                base_avg *= allocations.get(_week_key(d), 1.0)
+            daily[i] = base_avg * (1 + (factors[i] - 1.0) * 0.2) if profile == PROGRESSIVE else base_avg
+
+    events = params.get("events", [])
+    for ev in events:
+        start = datetime.datetime.strptime(ev["start_date"], "%Y-%m-%d").date()
+        end = datetime.datetime.strptime(ev["end_date"], "%Y-%m-%d").date()
+        for i, d in enumerate(dates):
+            if start <= d <= end:
+                daily[i] = daily[i] * float(ev.get("multiplier", 1.0)) + float(ev.get("addition", 0.0))
+    if events and calc_type == INC and abs(annual) > 1e-9:
+        current = np.sum(daily)
+        if abs(current) > 1e-9:
+            daily *= annual / current
+
+    return _reconcile(daily, annual, calc_type)
+
+
+def _reference_aggregates(year: int, daily: np.ndarray, calc_type: str) -> dict:
+    """Weekly/monthly/quarterly values of a daily series, grouped day by day: {period: {label: value}}."""
+    groups = {"weekly": {}, "monthly": {}, "quarterly": {}}
+    for d, v in zip(_dates_of(year), daily):
+        groups["weekly"].setdefault(_week_key(d), []).append(v)
+        groups["monthly"].setdefault(calendar.month_name[d.month], []).append(v)
+        groups["quarterly"].setdefault(f"Q{(d.month - 1) // 3 + 1}", []).append(v)
+    return {period: {label: (sum(vals) if calc_type == INC else float(np.mean(vals))) for label, vals in by_label.items()}
+            for period, by_label in groups.items()}
+
+
+def _assert_close(actual, expected, what: str):
+    actual, expected = np.asarray(actual, dtype=float), np.asarray(expected, dtype=float)
+    assert actual.shape == expected.shape, f"{what}: shape {actual.shape} != {expected.shape}"
+    worst = float(np.max(np.abs(actual - expected) / np.maximum(1.0, np.abs(expected)))) if actual.size else 0.0
+    assert worst <= TOLERANCE, f"{what}: differs by up to {worst:.3g}"
+
+
+def _read_series(db_name: str, table: str, label_col: str, year: int, plant_id: int, kpi_id: int, target_number: int = 1) -> dict:
+    with sqlite3.connect(app_config.get_database_path(db_name)) as conn:
+        rows = conn.execute(
+            f"SELECT {label_col}, target_value FROM {table} WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?",
+            (year, plant_id, kpi_id, target_number),
+        ).fetchall()
+    return dict(rows)
+
+
+def _read_annual_value(year: int, plant_id: int, kpi_id: int, target_number: int = 1):
+    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+        row = conn.execute(
+            """SELECT v.target_value FROM kpi_annual_target_values v JOIN annual_targets t ON t.id = v.annual_target_id
+               WHERE t.year=? AND t.plant_id=? AND t.kpi_id=? AND v.target_number=?""",
+            (year, plant_id, kpi_id, target_number),
+        ).fetchone()
+    return row[0] if row else None
+
+
+def _entry(annual: float, logic: str = YEAR_LOGIC, values: dict = None, profile: str = EVEN, params: dict = None, calculated: bool = False) -> dict:
+    return {
+        "targets": [{"target_number": 1, "target_value": annual, "is_manual": not calculated, "is_formula_based": calculated}],
+        "repartition_logic": logic,
+        "repartition_values": json.dumps(values or {}),
+        "distribution_profile": profile,
+        "profile_params": json.dumps(params or {}),
+        "global_split_id": None,
+    }
+
+
+def _create_kpis() -> dict:
+    """Creates the rule-based KPIs and two calculated ones; returns name -> kpi spec id."""
+    node_id = add_node("Repartition checks", None, "group")
+    kpi_ids = {}
+    for name, (calc_type, *_) in RULE_BASED_KPIS.items():
+        kpi_ids[name] = add_kpi_spec(add_kpi_indicator(name, node_id), name, calc_type, "u", True)
+    graph = KpiDAG.from_formula(f"[{kpi_ids['Month weights']}] * 2 + [{kpi_ids['Week weights']}] / [{kpi_ids['Average months']}]")
+    kpi_ids["Graph formula"] = add_kpi_spec(
+        add_kpi_indicator("Graph formula", node_id), "Graph formula", INC, "u", True,
+        formula_json=graph.to_json(), is_calculated=True,
+    )
+    kpi_ids["String formula"] = add_kpi_spec(
+        add_kpi_indicator("String formula", node_id), "String formula", INC, "u", True,
+        formula_string=f"[{kpi_ids['Quarter weights']}] * 100 / ([{kpi_ids['Average weeks']}] + 1)", is_calculated=True,
+    )
+    return kpi_ids
+
+
+def _data_map(kpi_ids: dict, scale: float) -> dict:
+    data_map = {
+        str(kpi_ids[name]): _entry(annual * scale, logic, values, profile, params)
+        for name, (_, logic, values, profile, params, annual) in RULE_BASED_KPIS.items()
+    }
+    data_map[str(kpi_ids["Graph formula"])] = _entry(0.0, calculated=True)
+    data_map[str(kpi_ids["String formula"])] = _entry(0.0, calculated=True)
+    return data_map
+
+
+def _check_stored_series(year: int, plant_id: int, kpi_ids: dict, scale: float):
+    """Compares the saved periodic rows of one plant/year with the per-day references."""
+    expected_daily = {}
+    for name, (calc_type, logic, values, profile, params, annual) in RULE_BASED_KPIS.items():
+        expected_daily[name] = _reference_daily_values(year, annual * scale, calc_type, logic, values, profile, params)
+
+    # Calculated KPIs: the formula evaluated day by day over the stored inputs
+    inputs = {
+        kpi_id: np.array(list(_read_series("db_kpi_days.db", "daily_targets", "date_value", year, plant_id, kpi_id).values()))
+        for kpi_id in kpi_ids.values()
+    }
+    for name in ("Graph formula", "String formula"):
+        kpi_id = kpi_ids[name]
+        with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+            formula_json, formula_string = conn.execute("SELECT formula_json, formula_string FROM kpis WHERE id=?", (kpi_id,)).fetchone()
+        days = len(_dates_of(year))
+        if formula_json:
+            graph = KpiDAG.from_json(formula_json)
+            daily = np.array([graph.evaluate(lambda kid, tn: inputs[kid][i]) for i in range(days)])
+        else:
+            daily = np.array([evaluate_formula(formula_string, {f"kpi_{kid}": arr[i] for kid, arr in inputs.items()}) for i in range(days)])
+        expected_daily[name] = _reconcile(daily, _read_annual_value(year, plant_id, kpi_id), INC)
+
+    for name, daily in expected_daily.items():
+        kpi_id = kpi_ids[name]
+        calc_type = RULE_BASED_KPIS[name][0] if name in RULE_BASED_KPIS else INC
+        stored = _read_series("db_kpi_days.db", "daily_targets", "date_value", year, plant_id, kpi_id)
+        assert list(stored) == [d.isoformat() for d in _dates_of(year)], f"{name} {year}: wrong daily rows"
+        _assert_close(list(stored.values()), daily, f"{name} {year} daily")
+        for period, (db_name, table, col) in {
+            "weekly": ("db_kpi_weeks.db", "weekly_targets", "week_value"),
+            "monthly": ("db_kpi_months.db", "monthly_targets", "month_value"),
+            "quarterly": ("db_kpi_quarters.db", "quarterly_targets", "quarter_value"),
+        }.items():
+            expected = _reference_aggregates(year, daily, calc_type)[period]
+            stored = _read_series(db_name, table, col, year, plant_id, kpi_id)
+            assert sorted(stored) == sorted(expected), f"{name} {year}: wrong {period} labels"
+            _assert_close([stored[label] for label in expected], list(expected.values()), f"{name} {year} {period}")
+
+
+def test_reduceat_aggregation():
+    print("Testing reduceat aggregation against per-day grouping...")
+    rng = np.random.default_rng(7)
+    for year in (2024, 2025, 2026):
+        matrix = rng.uniform(-5, 50, size=(3, len(_dates_of(year))))
+        for calc_type in (INC, AVG):
+            aggregates = _aggregate_periodic_targets(matrix, year, calc_type)
+            for row, daily in enumerate(matrix):
+                expected = _reference_aggregates(year, daily, calc_type)
+                for period, by_label in expected.items():
+                    _assert_close(aggregates[period][row], list(by_label.values()), f"{year} {calc_type} {period}")
+    print("reduceat aggregation verified!")
+
+
+def test_bulk_repartition():
+    print("Testing bulk repartition against per-day results...")
+    setup_databases()
+    plants = [add_plant("Bulk plant 1"), add_plant("Bulk plant 2")]
+    kpi_ids = _create_kpis()
+
+    save_annual_targets(2024, plants[0], _data_map(kpi_ids, 1.0))
+    # Two plants in one call, computed by a worker pool
+    save_annual_targets(2025, plants, _data_map(kpi_ids, 2.0), max_workers=2, executor_kind="thread")
+    for year, plant_id, scale in ((2024, plants[0], 1.0), (2025, plants[0], 2.0), (2025, plants[1], 2.0)):
+        _check_stored_series(year, plant_id, kpi_ids, scale)
+    print("Bulk repartition matches the per-day results!")
+
+    # --- Fingerprints ---
+    series = [(plant_id, kpi_id, 1) for plant_id in plants for kpi_id in kpi_ids.values()]
+    stats = calculate_and_save_repartitions_bulk(2025, series)
+    assert stats == {"repartitioned": 0, "unchanged": len(series)}, stats
+    stats = calculate_and_save_repartitions_bulk(2025, series, force=True)
+    assert stats == {"repartitioned": len(series), "unchanged": 0}, stats
+
+    # An input change regenerates the input and the formula reading it, not its neighbours
+    def read_days(name):
+        return _read_series("db_kpi_days.db", "daily_targets", "date_value", 2025, plants[0], kpi_ids[name])
+
+    formula_days = read_days("Graph formula")
+    changed = dict(_data_map(kpi_ids, 2.0))
+    changed[str(kpi_ids["Month weights"])] = _entry(3000.0, *RULE_BASED_KPIS["Month weights"][1:5])
+    summary = save_annual_targets(2025, plants[0], changed)
+    assert summary["repartitioned_series"] == 2, summary
+    assert summary["unchanged_series"] == len(kpi_ids) - 2, summary
+    _assert_close(sum(read_days("Month weights").values()), 3000.0, "Month weights after change")
+    assert read_days("Graph formula") != formula_days, "the formula over the changed input was skipped"
+    stats = calculate_and_save_repartitions_bulk(2025, series)
+    assert stats == {"repartitioned": 0, "unchanged": len(series)}, stats
+    print("Fingerprint skipping verified!")
+
+
+def test_formula_chain_fingerprints():
+    print("Testing fingerprints of formulas over formulas...")
+    plant_id = add_plant("Chain plant")
+    node_id = add_node("Formula chain checks", None, "group")
+    source = add_kpi_spec(add_kpi_indicator("Chain input", node_id), "Chain input", INC, "u", True)
+    first = add_kpi_spec(add_kpi_indicator("Chain first", node_id), "Chain first", INC, "u", True,
+                         formula_string=f"[{source}] * 2", is_calculated=True)
+    second = add_kpi_spec(add_kpi_indicator("Chain second", node_id), "Chain second", INC, "u", True,
+                          formula_json=KpiDAG.from_formula(f"[{first}] + 1").to_json(), is_calculated=True)
+    month_weights = RULE_BASED_KPIS["Month weights"][1:5]
+    save_annual_targets(2025, plant_id, {
+        str(source): _entry(1200.0, *month_weights),
+        str(first): _entry(0.0, calculated=True),
+        str(second): _entry(0.0, calculated=True),
+    })
+
+    # Change the input behind the stored fingerprints and pass the formulas before their inputs
+    with sqlite3.connect(app_config.get_database_path("db_kpi_targets.db")) as conn:
+        conn.execute(
+            """UPDATE kpi_annual_target_values SET target_value = 2400.0 WHERE target_number = 1 AND annual_target_id =
+               (SELECT id FROM annual_targets WHERE year = 2025 AND plant_id = ? AND kpi_id = ?)""",
+            (plant_id, source),
+        )
+    series = [(plant_id, second, 1), (plant_id, first, 1), (plant_id, source, 1)]
+    stats = calculate_and_save_repartitions_bulk(2025, series)
+    assert stats == {"repartitioned": 3, "unchanged": 0}, stats
+    stats = calculate_and_save_repartitions_bulk(2025, series)
+    assert stats == {"repartitioned": 0, "unchanged": 3}, stats
+    print("Formula chain fingerprints verified!")
+
+def test_universal_global_split():
+    print("Testing a universal Global Split on the save path...")
+    plant_id = add_plant("Split plant")
+    node_id = add_node("Global split checks", None, "group")
+    kpi_id = add_kpi_spec(add_kpi_indicator("Split KPI", node_id), "Split KPI", INC, "u", True)
+    values = {"mode": "universal", "monthly": {m: i + 1 for i, m in enumerate(MONTHS)}}
+    split_id = add_global_split("Monthly weights", [2025], "universal", values, EVEN, {})
+    entry = _entry(1200.0)
+    entry["global_split_id"] = split_id
+    save_annual_targets(2025, plant_id, {str(kpi_id): entry})
+
+    # The monthly weights shape the stored days, and the editor preview shows the same split
+    stored = _read_series("db_kpi_months.db", "monthly_targets", "month_value", 2025, plant_id, kpi_id)
+    expected = {m: 1200.0 * (i + 1) / 78 for i, m in enumerate(MONTHS)}
+    _assert_close([stored[m] for m in MONTHS], [expected[m] for m in MONTHS], "universal split months")
+    preview = preview_repartition(2025, 1200.0, INC, "universal", values, EVEN)
+    _assert_close([stored[m] for m in MONTHS], list(preview["monthly"]), "universal split preview")
+    print("Universal Global Split verified!")
+
+def test_snapshot_save():
+    print("Testing the annual target snapshot flush...")
+    plant_id = add_plant("Snapshot plant")
+    kpi_ids = _create_kpis()
+    data_map = _data_map(kpi_ids, 1.0)
+
+    summary = save_annual_targets(2025, plant_id, data_map)
+    assert summary["changed_kpis"] == len(data_map), summary
+    for name, (*_, annual) in RULE_BASED_KPIS.items():
+        assert _read_annual_value(2025, plant_id, kpi_ids[name]) == annual, name
+    formula_value = _read_annual_value(2025, plant_id, kpi_ids["Graph formula"])
+    assert formula_value is not None
+
+    # Saving the same values again writes nothing and regenerates nothing
+    summary = save_annual_targets(2025, plant_id, data_map)
+    assert summary["changed_kpis"] == 0 and summary["repartitioned_series"] == 0, summary
+
+    # Only the new value and the formula reading it are written
+    data_map[str(kpi_ids["Month weights"])] = _entry(2400.0, *RULE_BASED_KPIS["Month weights"][1:5])
+    summary = save_annual_targets(2025, plant_id, data_map)
+    assert summary["changed_kpis"] == 2, summary
+    assert _read_annual_value(2025, plant_id, kpi_ids["Month weights"]) == 2400.0
+    assert _read_annual_value(2025, plant_id, kpi_ids["Year even"]) == RULE_BASED_KPIS["Year even"][-1]
+    assert _read_annual_value(2025, plant_id, kpi_ids["Graph formula"]) != formula_value
+    print("Snapshot flush verified!")
+
+
+if __name__ == "__main__":
+    test_reduceat_aggregation()
+    test_bulk_repartition()
+    test_formula_chain_fingerprints()
+    test_universal_global_split()
+    test_snapshot_save()
+    print(f"All checks passed (scratch databases in {scratch_dir}).")
@@ -0,0 +1,221 @@
+# test_formula_engine.py
+import sys
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Add project root to sys.path to allow imports from src
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from src.config import settings as app_config
+
+# Work on scratch databases: some modules resolve their database paths on import
+scratch_dir = tempfile.mkdtemp(prefix="kpi_formula_engine_")
+app_config.SETTINGS["database_base_dir"] = scratch_dir
+app_config.SETTINGS["csv_export_base_dir"] = str(Path(scratch_dir) / "csv_exports")
+
+from src.data_access.setup import setup_databases
+from src.kpi_management.hierarchy import add_node
+from src.kpi_management.indicators import add_kpi_indicator
+from src.kpi_management.specs import add_kpi_spec, update_kpi_spec
+from src.kpi_management.dependency_index import (
+    check_kpi_dependencies,
+    get_dependency_index,
+    invalidate_dependency_index,
+    rebuild_dependency_index,
+)
+from src.core.node_engine import (
+    DagPlan,
+    KpiDAG,
+    KpiEdge,
+    KpiNode,
+    NodeType,
+    check_for_global_circular_dependencies,
+    get_compiled_dag,
+    invalidate_compiled_dag,
+)
+
+FORMULAS = [
+    "[1] + [2] * 2 + [1]",
+    "([1] + [2]) * ([1] + [2]) - 2 * 3",
+    "max([3], [1]) / [2]",
+    "avg([1], [2], [3]) + min([1], 4 - 1)",
+    "[1] / ([2] - [2]) + [3]",
+    "([1] - [3]) / ([2] + 1) * (10 / 4) - ([1] - [3])",
+]
+
+
+def _recursive_evaluate(dag: KpiDAG, resolver, default_target_num: int = 1) -> float:
+    """Evaluates a DAG node by node from its output, as KpiDAG.evaluate did before plans were compiled."""
+    output_node = next((n for n in dag.nodes.values() if n.type == NodeType.OUTPUT), None)
+    if not output_node:
+        return 0.0
+    memo = {}
+
+    def visit(node_id):
+        if node_id in memo:
+            return memo[node_id]
+        node = dag.nodes.get(node_id)
+        if not node:
+            return 0.0
+        result = 0.0
+        if node.type == NodeType.CONSTANT:
+            result = float(node.data.get("value", 0.0))
+        elif node.type == NodeType.KPI_INPUT:
+            result = resolver(node.data.get("kpi_id"), node.data.get("target_num", default_target_num))
+        elif node.type in (NodeType.OPERATOR, NodeType.OUTPUT):
+            edges = sorted((e for e in dag.edges if e.target == node_id), key=lambda e: e.target_handle)
+            inputs = [visit(e.source) for e in edges]
+            if node.type == NodeType.OUTPUT:
+                result = inputs[0] if inputs else 0.0
+            else:
+                result = KpiDAG._apply_operator(node.data.get("op", "+"), inputs)
+        memo[node_id] = result
+        return result
+
+    return visit(output_node.id)
+
+
+def test_compiled_plans():
+    print("Testing compiled DAG plans against recursive evaluation...")
+    rng = np.random.default_rng(11)
+    for formula in FORMULAS:
+        dag = KpiDAG.from_formula(formula)
+        plan = dag.compile()
+        input_steps = [arg for kind, arg, _ in plan.steps if kind == DagPlan.INPUT]
+        assert len(input_steps) == len(set(input_steps)), f"{formula}: an input is read more than once"
+        assert len(plan.steps) <= len(dag.nodes), f"{formula}: plan has more steps than the graph has nodes"
+        for _ in range(20):
+            values = {kid: float(v) for kid, v in zip((1, 2, 3), rng.uniform(-10, 10, 3))}
+            resolver = lambda kid, tn: values.get(kid, 0.0)
+            expected = _recursive_evaluate(dag, resolver)
+            actual = dag.evaluate(resolver)
+            assert abs(actual - expected) <= 1e-9 * max(1.0, abs(expected)), f"{formula}: {actual} != {expected}"
+
+    # Common subexpressions share a slot and constant-only operators are folded
+    plan = KpiDAG.from_formula("([1] + [2]) * ([1] + [2]) - 2 * 3").compile()
+    operators = [arg for kind, arg, _ in plan.steps if kind == DagPlan.OPERATOR]
+    assert sorted(operators) == ["*", "+", "-"], operators
+    assert any(kind == DagPlan.CONST and arg == 6.0 for kind, arg, _ in plan.steps)
+    print("Compiled plans verified!")
+
+
+def test_vectorized_evaluation():
+    print("Testing whole-year DAG evaluation against day-by-day evaluation...")
+    rng = np.random.default_rng(5)
+    shape = (3, 365)  # plants x days
+    series = {kid: rng.uniform(-10, 10, shape) for kid in (1, 2, 3)}
+    series[2][:, ::7] = 0.0  # divisions by zero on every seventh day
+    for formula in FORMULAS:
+        dag = KpiDAG.from_formula(formula)
+        actual = dag.evaluate_array(lambda kid, tn: series[kid], shape)
+        expected = np.zeros(shape)
+        for p in range(shape[0]):
+            for d in range(shape[1]):
+                expected[p, d] = dag.evaluate(lambda kid, tn: float(series[kid][p, d]))
+        assert np.allclose(actual, expected, rtol=1e-9, atol=1e-9), f"{formula}: array evaluation differs"
+
+    # Non-finite results (here a negative base to a fractional power) become 0
+    dag = KpiDAG.from_formula("[1] ** 0.5")
+    result = dag.evaluate_array(lambda kid, tn: np.array([4.0, -4.0, 9.0]), 3)
+    assert result.tolist() == [2.0, 0.0, 3.0], result
+    print("Whole-year evaluation verified!")
+
+
+def test_plan_caching():
+    print("Testing compiled plan caching...")
+    dag = KpiDAG.from_formula("[1] + [2]")
+    plan = dag.plan
+    assert dag.plan is plan, "the plan is recompiled on every access"
+    assert dag.evaluate(lambda kid, tn: float(kid)) == 3.0
+
+    # Editing the graph drops the cached plan
+    output_node = next(n for n in dag.nodes.values() if n.type == NodeType.OUTPUT)
+    old_edge = next(e for e in dag.edges if e.target == output_node.id)
+    dag.edges.remove(old_edge)
+    dag.add_node(KpiNode("const_10", NodeType.CONSTANT, {"value": 10.0}))
+    dag.add_edge(KpiEdge("edge_10", "const_10", output_node.id, "in"))
+    assert dag.plan is not plan
+    assert dag.evaluate(lambda kid, tn: float(kid)) == 10.0
+
+    formula_json = KpiDAG.from_formula("[1] * [2]").to_json()
+    compiled = get_compiled_dag(formula_json)
+    assert get_compiled_dag(formula_json) is compiled
+    assert [d["kpi_id"] for d in compiled.dependencies] == [1, 2]
+    assert compiled.plan.evaluate(lambda kid, tn: float(kid + 1)) == 6.0
+    invalidate_compiled_dag(formula_json)
+    assert get_compiled_dag(formula_json) is not compiled
+    print("Plan caching verified!")
+
+
+def test_dependency_cycles():
+    print("Testing the KPI dependency index...")
+    setup_databases()
+    node_id = add_node("Formula checks", None, "group")
+
+    def spec(name, **kwargs):
+        return add_kpi_spec(add_kpi_indicator(name, node_id), name, app_config.CALC_TYPE_INCREMENTAL, "u", True, **kwargs)
+
+    a = spec("A")
+    b = spec("B")
+    c = spec("C", formula_json=KpiDAG.from_formula(f"[{a}] + [{b}]").to_json(), is_calculated=True)
+    d = spec("D", formula_string=f"[{c}] * 2", is_calculated=True)
+
+    index = {kpi_id: set(deps) for kpi_id, deps in get_dependency_index().items()}
+    assert index == {c: {a, b}, d: {c}}, index
+    invalidate_dependency_index()
+    assert rebuild_dependency_index() == index
+
+    # Giving A a formula over D would close A -> D -> C -> A
+    cyclic = {"is_calculated": True, "formula_string": f"[{d}] + 1"}
+    try:
+        check_kpi_dependencies(a, cyclic)
+    except ValueError as e:
+        assert f"{a} -> {d} -> {c} -> {a}" in str(e), e
+    else:
+        raise AssertionError("cycle through the index was not detected")
+    try:
+        update_kpi_spec(a, formula_string=cyclic["formula_string"], is_calculated=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a cyclic formula was saved")
+    assert {kpi_id: set(deps) for kpi_id, deps in get_dependency_index().items()} == index
+
+    # A database upgraded from before the index has formula specs but no index rows;
+    # the first formula save completes the index instead of storing only its own row
+    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        conn.execute("DELETE FROM kpi_formula_dependencies")
+    invalidate_dependency_index()
+    started = time.perf_counter()
+    e = spec("E", formula_string=f"[{b}] / 2", is_calculated=True)
+    assert time.perf_counter() - started < 2.0, "the first formula save waited on a lock"
+    index[e] = {b}
+    invalidate_dependency_index()
+    assert {kpi_id: set(deps) for kpi_id, deps in get_dependency_index().items()} == index
+    try:
+        update_kpi_spec(a, formula_string=cyclic["formula_string"], is_calculated=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a cyclic formula was saved over a partial index")
+
+    # The full scan finds the same kind of cycle, and formulas over unrelated inputs pass
+    specs = {c: {"formula_json": KpiDAG.from_formula(f"[{a}] + [{b}]").to_json()},
+             a: {"formula_json": KpiDAG.from_formula(f"[{c}] - 1").to_json()}}
+    assert check_for_global_circular_dependencies(specs), "full scan missed the cycle"
+    assert check_kpi_dependencies(b, {"is_calculated": True, "formula_string": f"[{a}] * 3"}) == [a]
+    print("Dependency cycle detection verified!")
+
+
+if __name__ == "__main__":
+    test_compiled_plans()
+    test_vectorized_evaluation()
+    test_plan_caching()
+    test_dependency_cycles()
+    print(f"All checks passed (scratch databases in {scratch_dir}).")
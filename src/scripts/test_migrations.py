@@ -0,0 +1,84 @@
+# test_migrations.py
+import sys
+import sqlite3
+import tempfile
+from pathlib import Path
+
+# Add project root to sys.path to allow imports from src
+project_root = Path(__file__).resolve().parents[2]
+if str(project_root) not in sys.path:
+    sys.path.insert(0, str(project_root))
+
+from src.config import settings as app_config
+
+# Work on scratch databases: some modules resolve their database paths on import
+scratch_dir = tempfile.mkdtemp(prefix="kpi_migrations_")
+app_config.SETTINGS["database_base_dir"] = scratch_dir
+app_config.SETTINGS["csv_export_base_dir"] = str(Path(scratch_dir) / "csv_exports")
+
+from src.data_access.setup import setup_databases
+from src.data_access.migrations import (
+    MIGRATIONS,
+    SCHEMA_VERSION,
+    check_query_plans,
+    get_schema_version,
+    run_migrations,
+    schema_is_current,
+)
+from src.kpi_management.hierarchy import add_node, update_node
+
+
+def _node_paths() -> dict:
+    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        return dict(conn.execute("SELECT node_id, path FROM kpi_node_paths").fetchall())
+
+
+def test_fresh_setup():
+    print("Testing setup and migrations on empty databases...")
+    assert not schema_is_current()
+    setup_databases()
+    assert schema_is_current(), "a clean setup did not stamp the schema version"
+    assert run_migrations(), "migrations failed on an up-to-date schema"
+    problems = check_query_plans()
+    assert not problems, f"hot queries without an index: {[sql for _, sql, _ in problems]}"
+    print("Fresh setup verified!")
+
+
+def test_node_paths_migration():
+    print("Testing that migration 8 alone builds kpi_node_paths...")
+    root = add_node("Root", None, "group")
+    child = add_node("Child", root, "subgroup")
+    leaf = add_node("Leaf", child, "folder")
+    update_node(child, name="Renamed")
+    expected = {root: "Root", child: "Root > Renamed", leaf: "Root > Renamed > Leaf"}
+    assert _node_paths() == expected, _node_paths()
+
+    # A db_kpis.db from before migration 8: no path table, versions up to 7 only
+    previous_version = max(v for v, db, _, _ in MIGRATIONS if db == "db_kpis.db" and v < 8)
+    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        conn.execute("DROP TABLE kpi_node_paths")
+        conn.execute("DELETE FROM schema_version WHERE version > ?", (previous_version,))
+    assert not schema_is_current()
+
+    assert run_migrations()
+    assert _node_paths() == expected, _node_paths()
+    with sqlite3.connect(app_config.get_database_path("db_kpis.db")) as conn:
+        assert get_schema_version(conn) == 8
+    print("Node paths migration verified!")
+
+
+def test_stamp_after_setup():
+    print("Testing the fast-path schema stamp...")
+    setup_databases()
+    assert schema_is_current()
+    for db_name in {db for _, db, _, _ in MIGRATIONS}:
+        with sqlite3.connect(app_config.get_database_path(db_name)) as conn:
+            assert get_schema_version(conn) == SCHEMA_VERSION, db_name
+    print("Schema stamp verified!")
+
+
+if __name__ == "__main__":
+    test_fresh_setup()
+    test_node_paths_migration()
+    test_stamp_after_setup()
+    print(f"All checks passed (scratch databases in {scratch_dir}).")
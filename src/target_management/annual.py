@@ -1,12 +1,11 @@
 # your_project_root/target_management/annual.py
-import sqlite3
 import json
 import traceback
-import numpy # For _placeholder_safe_evaluate_formula if it uses numpy functions directly
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from src.config import settings as app_config
 from pathlib import Path
 from src import data_retriever as db_retriever
-from src.data_retriever import get_annual_target_entry
 
 
 # Configuration imports
@@ -16,30 +15,20 @@ from src.interfaces.common_ui.constants import (
 )
 
 from src.target_management import repartition as repartition_module
-from src.core.node_engine import KpiDAG
+from src.target_management.periodic_writer import PeriodicTargetWriter
+from src.target_management.snapshot import AnnualTargetSnapshot
+from src.core.node_engine import get_compiled_dag
+from src.core.dependency_graph import KpiDependencyGraph, topological_order
+from src.core.formula_evaluator import evaluate_formula
 
 
-# --- Formula Evaluation (Placeholder - Needs Secure Implementation) ---
-def _placeholder_safe_evaluate_formula(formula_str: str, context_vars: dict):
+# --- Formula Evaluation ---
+def _evaluate_legacy_formula(formula_str: str, context_vars: dict):
     """
     Evaluates a formula string. Supports [ID] syntax which is mapped to context_vars['kpi_ID'].
     """
-    import re
     try:
-        pattern = r'\[(\d+)\]'
-        
-        def replacer(match):
-            kpi_id = match.group(1)
-            var_name = f"kpi_{kpi_id}"
-            val = context_vars.get(var_name, 0.0)
-            return str(val)
-            
-        processed_formula = re.sub(pattern, replacer, formula_str)
-        
-        allowed_names = {"abs": abs, "min": min, "max": max, "round": round}
-        allowed_names.update({k: v for k, v in context_vars.items() if not k.startswith("kpi_")})
-        
-        return float(eval(processed_formula, {"__builtins__": None}, allowed_names))
+        return evaluate_formula(formula_str, context_vars)
     except Exception as e:
         print(f"ERROR: Formula evaluation failed: {e}")
         return 0.0
@@ -51,123 +40,185 @@ def save_annual_targets(
     plant_id: int | list[int],
     targets_data_map: dict,
     initiator_kpi_spec_id: int = None,
-):
+    max_workers: int = 1,
+    executor_kind: str = "thread",
+) -> dict:
     """
     Saves annual targets for one or more plants.
-    """
-    db_targets_path = app_config.get_database_path("db_kpi_targets.db")
 
-    if not targets_data_map: return
+    Only KPIs whose values, manual/formula flags or split settings differ from the
+    stored ones are written; formula dependents of those are recomputed too. Every
+    submitted series is then checked against its repartition fingerprint (annual
+    value, spec, split settings, formula inputs), so unchanged series are skipped
+    while spec or Global Split edits still regenerate the periodic targets.
+    Returns {"changed_kpis", "skipped_kpis" (submitted KPIs with unchanged annual
+    values), "repartitioned_series", "unchanged_series"}, counted over all plants.
+
+    By default the periodic repartitions of all plants are computed as one batch. With
+    max_workers > 1 and several plants, the plants are split into up to max_workers
+    batches computed in a thread pool; executor_kind="process" opts into a process
+    pool (not from GUI worker threads: fork() from a threaded process is unsafe, and
+    each worker re-imports settings). Workers only compute; all rows are written by
+    this process through a single writer.
+    """
+    summary = {"changed_kpis": 0, "skipped_kpis": 0, "repartitioned_series": 0, "unchanged_series": 0}
+    if not targets_data_map: return summary
 
     plant_ids = [plant_id] if isinstance(plant_id, int) else plant_id
     
+    # Annual values are saved plant by plant; the periodic repartitions of every
+    # plant are then computed and written in a single batch.
+    dep_graph = KpiDependencyGraph(db_retriever.get_all_kpis_detailed())
+    series_by_plant = {}
     for pid in plant_ids:
         print(f"INFO: Saving annual targets for Year: {year}, Plant: {pid}...")
-        _save_single_plant_annual_targets(year, pid, targets_data_map, initiator_kpi_spec_id)
+        series_by_plant[pid], changed, skipped = _save_single_plant_annual_targets(year, pid, targets_data_map, initiator_kpi_spec_id, dep_graph)
+        summary["changed_kpis"] += changed
+        summary["skipped_kpis"] += skipped
+
+    total_series = sum(len(s) for s in series_by_plant.values())
+    print(f"  Phase 4: Calculating periodic repartitions for {total_series} series...")
+    writer = PeriodicTargetWriter()
+    plant_batches = [series for series in series_by_plant.values() if series]
+    if max_workers and max_workers > 1 and len(plant_batches) > 1:
+        results = _run_repartitions_in_pool(year, plant_batches, max_workers, executor_kind)
+    else:
+        results = [_repartition_plant_worker(year, [s for batch in plant_batches for s in batch], writer)]
+    for plant_writer, stats in results:
+        if plant_writer is not writer: writer.merge(plant_writer)
+        summary["repartitioned_series"] += stats["repartitioned"]
+        summary["unchanged_series"] += stats["unchanged"]
+    writer.flush()
+    print(f"INFO: Finished save_annual_targets for Year: {year}, Plants: {plant_ids}. "
+          f"{summary['changed_kpis']} KPIs changed, {summary['skipped_kpis']} unchanged, "
+          f"{summary['unchanged_series']} series skipped by fingerprint.")
+    return summary
+
+
+def _init_save_worker(settings: dict, calculation_constants: dict):
+    """Gives pool processes the same database location and constants as the parent."""
+    app_config.SETTINGS = settings
+    app_config.CALCULATION_CONSTANTS = calculation_constants
+
+
+def _repartition_plant_worker(year: int, series: list, writer: PeriodicTargetWriter = None) -> tuple:
+    """Computes the repartitions of one plant without writing them. Returns (writer, stats)."""
+    writer = writer or PeriodicTargetWriter()
+    stats = repartition_module.calculate_and_save_repartitions_bulk(year, series, writer)
+    return writer, stats
+
+
+def _run_repartitions_in_pool(year: int, plant_batches: list, max_workers: int, executor_kind: str) -> list:
+    """
+    Merges the plant batches into at most max_workers multi-plant batches (keeping
+    the all-plants batching within each), runs them in a process or thread pool and
+    returns their (writer, stats).
+    """
+    workers = min(max_workers, len(plant_batches))
+    plant_batches = [[s for batch in plant_batches[i::workers] for s in batch] for i in range(workers)]
+    if executor_kind == "thread":
+        executor = ThreadPoolExecutor(max_workers=workers)
+    elif executor_kind == "process":
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_save_worker,
+            initargs=(app_config.SETTINGS, app_config.CALCULATION_CONSTANTS),
+        )
+    else:
+        raise ValueError(f"Invalid executor_kind: '{executor_kind}'. Must be 'process' or 'thread'.")
+
+    print(f"    Using a {executor_kind} pool with {workers} workers.")
+    try:
+        with executor:
+            return list(executor.map(_repartition_plant_worker, [year] * len(plant_batches), plant_batches))
+    except (BrokenProcessPool, OSError) as e:
+        print(f"WARNING: Worker pool unavailable ({e}). Computing repartitions sequentially.")
+        return [_repartition_plant_worker(year, series) for series in plant_batches]
 
-def _save_single_plant_annual_targets(year, plant_id, targets_data_map, initiator_kpi_spec_id):
-    db_targets_path = app_config.get_database_path("db_kpi_targets.db")
-    
+def _save_single_plant_annual_targets(year, plant_id, targets_data_map, initiator_kpi_spec_id, dep_graph: KpiDependencyGraph = None):
+    """
+    Saves the annual values of one plant and recomputes its formula-based targets.
+    Returns (series, changed, unchanged): the (plant_id, kpi_id, target_number) series
+    to check for repartition in dependency order, and how many KPIs of
+    targets_data_map changed or kept their annual values. dep_graph can be shared
+    across plants.
+    """
+    if dep_graph is None:
+        dep_graph = KpiDependencyGraph(db_retriever.get_all_kpis_detailed())
     kpis_needing_repartition_update = set()
+    submitted_kpi_ids = set()
     # Map of target_number -> list of kpi_ids
     kpis_with_formula = {} 
 
-    # Phase 1: Save definitions
-    with sqlite3.connect(db_targets_path) as conn:
-        cursor = conn.cursor()
-        for kpi_spec_id_str, data_dict_from_ui in targets_data_map.items():
-            # ... (existing Phase 1 logic for saving UI inputs) ...
-            try:
-                current_kpi_spec_id = int(kpi_spec_id_str)
-            except: continue
-
-            record_row = get_annual_target_entry(year, plant_id, current_kpi_spec_id)
-            record_dict = record_row if record_row else None
-
-            # 1a. Update/Insert annual_targets (metadata)
-            if record_dict:
-                at_id = record_dict['id']
-                if "repartition_logic" in data_dict_from_ui:
-                    cursor.execute(
-                        "UPDATE annual_targets SET repartition_logic=?, repartition_values=?, distribution_profile=?, profile_params=?, global_split_id=? WHERE id=?",
-                        (data_dict_from_ui.get("repartition_logic"),
-                         data_dict_from_ui.get("repartition_values", "{}"),
-                         data_dict_from_ui.get("distribution_profile"),
-                         data_dict_from_ui.get("profile_params", "{}"),
-                         data_dict_from_ui.get("global_split_id"),
-                         at_id)
-                    )
-            else:
-                cursor.execute(
-                    "INSERT INTO annual_targets (year, plant_id, kpi_id, repartition_logic, repartition_values, distribution_profile, profile_params, global_split_id) VALUES (?,?,?,?,?,?,?,?)",
-                    (year, plant_id, current_kpi_spec_id, 
-                     data_dict_from_ui.get("repartition_logic", REPARTITION_LOGIC_YEAR),
-                     data_dict_from_ui.get("repartition_values", "{}"),
-                     data_dict_from_ui.get("distribution_profile", PROFILE_ANNUAL_PROGRESSIVE),
-                     data_dict_from_ui.get("profile_params", "{}"),
-                     data_dict_from_ui.get("global_split_id"))
-                )
-                at_id = cursor.lastrowid
-
-            # 1b. Save target values
-            targets_to_process = data_dict_from_ui.get('targets')
-            if not targets_to_process:
-                # Map legacy fields to target list
-                targets_to_process = []
-                for tn in [1, 2]:
-                    if f'annual_target{tn}' in data_dict_from_ui or f'target{tn}_is_formula_based' in data_dict_from_ui:
-                        targets_to_process.append({
-                            'target_number': tn,
-                            'target_value': data_dict_from_ui.get(f'annual_target{tn}'),
-                            'is_manual': data_dict_from_ui.get(f'is_target{tn}_manual', True),
-                            'is_formula_based': data_dict_from_ui.get(f'target{tn}_is_formula_based', False),
-                            'formula': data_dict_from_ui.get(f'target{tn}_formula'),
-                            'formula_inputs': data_dict_from_ui.get(f'target{tn}_formula_inputs', '[]')
-                        })
-
-            for t_data in targets_to_process:
-                tn = t_data['target_number']
-                t_val_raw = t_data.get('target_value', 0.0)
-                t_val = float(t_val_raw) if t_val_raw is not None else 0.0
-                is_man = 1 if t_data.get('is_manual', True) else 0
-                is_form = 1 if t_data.get('is_formula_based', False) else 0
-                form_str = t_data.get('formula')
-                form_in_raw = t_data.get('formula_inputs', '[]')
-                form_in = json.dumps(form_in_raw) if isinstance(form_in_raw, (list, dict)) else (form_in_raw or '[]')
-
-                cursor.execute("""
-                    INSERT INTO kpi_annual_target_values 
-                    (annual_target_id, target_number, target_value, is_manual, is_formula_based, formula, formula_inputs)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(annual_target_id, target_number) DO UPDATE SET
-                    target_value=excluded.target_value,
-                    is_manual=excluded.is_manual,
-                    is_formula_based=excluded.is_formula_based,
-                    formula=excluded.formula,
-                    formula_inputs=excluded.formula_inputs
-                """, (at_id, tn, t_val, is_man, is_form, form_str, form_in))
-
-                # Also update legacy columns for backward compatibility
-                if tn in [1, 2]:
-                    cursor.execute(f"UPDATE annual_targets SET annual_target{tn}=?, is_target{tn}_manual=?, target{tn}_is_formula_based=?, target{tn}_formula=?, target{tn}_formula_inputs=? WHERE id=?",
-                                   (t_val, is_man, is_form, form_str, form_in, at_id))
-
-                kpis_needing_repartition_update.add(current_kpi_spec_id)
-                if is_form:
-                    if tn not in kpis_with_formula: kpis_with_formula[tn] = []
-                    kpis_with_formula[tn].append(current_kpi_spec_id)
-
-        conn.commit()
+    # The plant's targets are loaded once; Phase 1 inputs and Phase 2 results are
+    # staged in this snapshot and written together at the end of Phase 2.
+    snapshot = AnnualTargetSnapshot.load(year, plant_id)
+
+    # Phase 1: Stage definitions
+    for kpi_spec_id_str, data_dict_from_ui in targets_data_map.items():
+        try:
+            current_kpi_spec_id = int(kpi_spec_id_str)
+        except: continue
+
+        # 1a. Update/Insert annual_targets (metadata)
+        if snapshot.entry(current_kpi_spec_id) is None:
+            snapshot.stage_entry(current_kpi_spec_id, {
+                "repartition_logic": data_dict_from_ui.get("repartition_logic", REPARTITION_LOGIC_YEAR),
+                "repartition_values": data_dict_from_ui.get("repartition_values", "{}"),
+                "distribution_profile": data_dict_from_ui.get("distribution_profile", PROFILE_ANNUAL_PROGRESSIVE),
+                "profile_params": data_dict_from_ui.get("profile_params", "{}"),
+                "global_split_id": data_dict_from_ui.get("global_split_id"),
+            })
+        elif "repartition_logic" in data_dict_from_ui:
+            snapshot.stage_entry(current_kpi_spec_id, {
+                "repartition_logic": data_dict_from_ui.get("repartition_logic"),
+                "repartition_values": data_dict_from_ui.get("repartition_values", "{}"),
+                "distribution_profile": data_dict_from_ui.get("distribution_profile"),
+                "profile_params": data_dict_from_ui.get("profile_params", "{}"),
+                "global_split_id": data_dict_from_ui.get("global_split_id"),
+            })
+
+        # 1b. Stage target values
+        targets_to_process = data_dict_from_ui.get('targets')
+        if not targets_to_process:
+            # Map legacy fields to target list
+            targets_to_process = []
+            for tn in [1, 2]:
+                if f'annual_target{tn}' in data_dict_from_ui or f'target{tn}_is_formula_based' in data_dict_from_ui:
+                    targets_to_process.append({
+                        'target_number': tn,
+                        'target_value': data_dict_from_ui.get(f'annual_target{tn}'),
+                        'is_manual': data_dict_from_ui.get(f'is_target{tn}_manual', True),
+                        'is_formula_based': data_dict_from_ui.get(f'target{tn}_is_formula_based', False),
+                        'formula': data_dict_from_ui.get(f'target{tn}_formula'),
+                        'formula_inputs': data_dict_from_ui.get(f'target{tn}_formula_inputs', '[]')
+                    })
+
+        for t_data in targets_to_process:
+            tn = t_data['target_number']
+            t_val_raw = t_data.get('target_value', 0.0)
+            t_val = float(t_val_raw) if t_val_raw is not None else 0.0
+            is_man = 1 if t_data.get('is_manual', True) else 0
+            is_form = 1 if t_data.get('is_formula_based', False) else 0
+            form_str = t_data.get('formula')
+            form_in_raw = t_data.get('formula_inputs', '[]')
+            form_in = json.dumps(form_in_raw) if isinstance(form_in_raw, (list, dict)) else (form_in_raw or '[]')
+
+            snapshot.stage_target_value(current_kpi_spec_id, tn, t_val, is_man, is_form, form_str, form_in)
+            if is_form:
+                if tn not in kpis_with_formula: kpis_with_formula[tn] = []
+                kpis_with_formula[tn].append(current_kpi_spec_id)
+
+        submitted_kpi_ids.add(current_kpi_spec_id)
 
     # Phase 1.5: Identify all other calculated KPIs in the system
     # This ensures that if we update KPI A, and KPI B = A * 2, KPI B also gets updated.
-    all_specs = db_retriever.get_all_kpis_detailed()
-    for spec in all_specs:
+    for spec in dep_graph.specs.values():
         spec_id = spec['id']
         # If this spec has a formula (JSON or String) or is marked as calculated
         if spec.get('is_calculated'):
             # Check for existing target entry to see which target numbers are active
-            target_entry = get_annual_target_entry(year, plant_id, spec_id)
+            target_entry = snapshot.entry(spec_id)
             if target_entry:
                 for tv in target_entry['target_values']:
                     if tv['is_formula_based']:
@@ -177,185 +228,123 @@ def _save_single_plant_annual_targets(year, plant_id, targets_data_map, initiato
                             kpis_with_formula[tn].append(spec_id)
 
     # Phase 2: Calculate formula-based targets
+    # Each target number is computed in one pass, in dependency order.
     print("  Phase 2: Calculating formula-based targets...")
-    MAX_ITERATIONS_FORMULA = len(targets_data_map) + 5
-    
     for target_num_to_calculate in sorted(kpis_with_formula.keys()):
         kpi_list_for_formula_calc = kpis_with_formula[target_num_to_calculate]
         print(f"    Calculating formulas for Target {target_num_to_calculate}. KPIs: {kpi_list_for_formula_calc}")
-        
-        kpis_pending_formula = list(kpi_list_for_formula_calc)
-        calculated_this_pass_successfully = set()
-
-        for iteration in range(MAX_ITERATIONS_FORMULA):
-            if not kpis_pending_formula: break
-            made_progress_in_iteration = False
-            next_pending_list = []
-
-            for kpi_id_to_calc in kpis_pending_formula:
-                target_entry = get_annual_target_entry(year, plant_id, kpi_id_to_calc)
-                if not target_entry: continue
-                
-                t_val_rec = next((tv for tv in target_entry['target_values'] if tv['target_number'] == target_num_to_calculate), None)
-                if not t_val_rec: continue
 
-                kpi_details_row = db_retriever.get_kpi_detailed_by_id(kpi_id_to_calc)
-                kpi_details = dict(kpi_details_row) if kpi_details_row else {}
-                
-                formula_to_use = kpi_details.get("formula_json") or kpi_details.get("formula_string") or t_val_rec.get('formula')
-                formula_inputs_json_db = t_val_rec.get('formula_inputs', '[]') or '[]'
-
-                if not (t_val_rec['is_formula_based'] and formula_to_use): continue
-
-                is_node_dag = False
-                try:
-                    dag_data = json.loads(formula_to_use)
-                    if isinstance(dag_data, dict) and "nodes" in dag_data: is_node_dag = True
-                except: pass
-
-                try:
-                    if is_node_dag:
-                        dag = KpiDAG.from_json(formula_to_use)
-                        deps = dag.find_all_kpi_dependencies()
-                        formula_inputs_def_py = [
-                            {"kpi_id": d["kpi_id"], "target_num": d["target_num"], "variable_name": f"kpi_{d['kpi_id']}_t{d['target_num']}"}
-                            for d in deps
-                        ]
-                    else:
-                        formula_inputs_def_py = json.loads(formula_inputs_json_db)
-                except: continue
-
-                context_vars = {}
-                all_inputs_ready = True
-                for f_input in formula_inputs_def_py:
-                    input_kpi_id = f_input.get("kpi_id")
-                    input_target_num = f_input.get("target_num") or int(f_input.get("target_source", "annual_target1")[-1])
-                    var_name = f_input.get("variable_name")
-
-                    if not all([input_kpi_id, input_target_num, var_name]):
-                        all_inputs_ready = False; break
+        prepared = {}
+        for kpi_id_to_calc in kpi_list_for_formula_calc:
+            target_entry = snapshot.entry(kpi_id_to_calc)
+            if not target_entry: continue
+            
+            t_val_rec = snapshot.target_value_record(kpi_id_to_calc, target_num_to_calculate)
+            if not t_val_rec: continue
 
-                    if input_kpi_id in kpis_pending_formula and input_kpi_id not in calculated_this_pass_successfully:
-                        if input_target_num == target_num_to_calculate:
-                            all_inputs_ready = False; break
+            kpi_details = dep_graph.specs.get(kpi_id_to_calc, {})
+            
+            formula_to_use = kpi_details.get("formula_json") or kpi_details.get("formula_string") or t_val_rec.get('formula')
+            formula_inputs_json_db = t_val_rec.get('formula_inputs', '[]') or '[]'
 
-                    input_entry = get_annual_target_entry(year, plant_id, input_kpi_id)
-                    if not input_entry:
-                        all_inputs_ready = False; break
-                    
-                    input_val_rec = next((v for v in input_entry['target_values'] if v['target_number'] == input_target_num), None)
-                    if input_val_rec is None or input_val_rec['target_value'] is None:
-                        all_inputs_ready = False; break
-                    
-                    context_vars[var_name] = float(input_val_rec['target_value'])
-
-                if not all_inputs_ready:
-                    next_pending_list.append(kpi_id_to_calc); continue
-
-                try:
-                    if is_node_dag:
-                        def kpi_resolver(k_id, t_n):
-                            res = get_annual_target_entry(year, plant_id, k_id)
-                            if not res: return 0.0
-                            val_rec = next((v for v in res['target_values'] if v['target_number'] == t_n), None)
-                            return float(val_rec['target_value']) if val_rec else 0.0
-                        calculated_value = dag.evaluate(kpi_resolver, default_target_num=target_num_to_calculate)
-                    else:
-                        calculated_value = _placeholder_safe_evaluate_formula(formula_to_use, context_vars)
-
-                    with sqlite3.connect(db_targets_path) as conn_upd:
-                        conn_upd.execute(
-                            "UPDATE kpi_annual_target_values SET target_value=?, is_manual=0 WHERE annual_target_id=? AND target_number=?",
-                            (calculated_value, target_entry['id'], target_num_to_calculate)
-                        )
-                        if target_num_to_calculate in [1, 2]:
-                            conn_upd.execute(
-                                f"UPDATE annual_targets SET annual_target{target_num_to_calculate}=?, is_target{target_num_to_calculate}_manual=0 WHERE id=?",
-                                (calculated_value, target_entry['id'])
-                            )
-                        conn_upd.commit()
-                    
-                    calculated_this_pass_successfully.add(kpi_id_to_calc)
-                    kpis_needing_repartition_update.add(kpi_id_to_calc)
-                    made_progress_in_iteration = True
-                except Exception as e_eval:
-                    print(f"      ERROR: Formula failed for KPI {kpi_id_to_calc} T{target_num_to_calculate}: {e_eval}")
-                    next_pending_list.append(kpi_id_to_calc)
-
-            kpis_pending_formula = [k for k in next_pending_list if k not in calculated_this_pass_successfully]
-            if not made_progress_in_iteration and kpis_pending_formula: break
+            if not (t_val_rec['is_formula_based'] and formula_to_use): continue
 
-    # Phase 3: (Removed) Master/Sub distribution
+            is_node_dag = False
+            try:
+                dag_data = json.loads(formula_to_use)
+                if isinstance(dag_data, dict) and "nodes" in dag_data: is_node_dag = True
+            except: pass
 
-    # Phase 4: Repartitions (Processed in dependency order)
-    print("  Phase 4: Calculating periodic repartitions...")
-    
-    # Identify all KPIs that might be affected by the ones we've already marked
-    # We need to expand kpis_needing_repartition_update to include anyone who depends on them
-    full_update_set = set(kpis_needing_repartition_update)
-    
-    # Simple propagation: if A changes, and B depends on A, B must change.
-    # We'll do this iteratively until no more are added.
-    all_calculated_specs = [s for s in all_specs if s.get('is_calculated')]
-    
-    for _ in range(5): # Limit propagation depth
-        added = False
-        for spec in all_calculated_specs:
-            sid = spec['id']
-            if sid in full_update_set: continue
-            
-            # Check dependencies
             try:
-                formula = spec.get('formula_json') or spec.get('formula_string')
-                if not formula: continue
-                
-                deps = []
-                if spec.get('formula_json'):
-                    dag = KpiDAG.from_json(spec['formula_json'])
-                    deps = [d['kpi_id'] for d in dag.find_all_kpi_dependencies()]
+                plan = None
+                if is_node_dag:
+                    compiled = get_compiled_dag(formula_to_use)
+                    plan, deps = compiled.plan, compiled.dependencies
+                    formula_inputs_def_py = [
+                        {"kpi_id": d["kpi_id"], "target_num": d["target_num"], "variable_name": f"kpi_{d['kpi_id']}_t{d['target_num']}"}
+                        for d in deps
+                    ]
                 else:
-                    deps = [int(mid) for mid in re.findall(r'\[(\d+)\]', formula)]
+                    formula_inputs_def_py = json.loads(formula_inputs_json_db)
+            except: continue
+            prepared[kpi_id_to_calc] = (target_entry, formula_to_use, plan, formula_inputs_def_py)
+
+        def same_target_inputs(kid):
+            return [f.get("kpi_id") for f in prepared[kid][3]
+                    if (f.get("target_num") or target_num_to_calculate) == target_num_to_calculate]
+        calc_order, cyclic = topological_order(prepared, same_target_inputs)
+        if cyclic:
+            print(f"      WARNING: Circular formula dependencies for Target {target_num_to_calculate}, skipping KPIs {cyclic}")
+
+        calculated_successfully = set()
+        for kpi_id_to_calc in calc_order:
+            target_entry, formula_to_use, plan, formula_inputs_def_py = prepared[kpi_id_to_calc]
+
+            context_vars = {}
+            all_inputs_ready = True
+            for f_input in formula_inputs_def_py:
+                input_kpi_id = f_input.get("kpi_id")
+                input_target_num = f_input.get("target_num") or int(f_input.get("target_source", "annual_target1")[-1])
+                var_name = f_input.get("variable_name")
+
+                if not all([input_kpi_id, input_target_num, var_name]):
+                    all_inputs_ready = False; break
+
+                # Inputs recomputed in this pass must have succeeded first
+                if input_kpi_id in prepared and input_kpi_id not in calculated_successfully:
+                    if input_target_num == target_num_to_calculate:
+                        all_inputs_ready = False; break
+
+                if not snapshot.entry(input_kpi_id):
+                    all_inputs_ready = False; break
                 
-                if any(d in full_update_set for d in deps):
-                    full_update_set.add(sid)
-                    added = True
-            except: pass
-        if not added: break
+                input_val_rec = snapshot.target_value_record(input_kpi_id, input_target_num)
+                if input_val_rec is None or input_val_rec['target_value'] is None:
+                    all_inputs_ready = False; break
+                
+                context_vars[var_name] = float(input_val_rec['target_value'])
+
+            if not all_inputs_ready:
+                print(f"      WARNING: Inputs not ready for KPI {kpi_id_to_calc} T{target_num_to_calculate}, keeping its stored value.")
+                continue
 
-    # Now topological sort for repartitioning
-    sorted_kpis = []
-    visited_kpis = set()
-    
-    def visit_kpi_topo(kid):
-        if kid in visited_kpis: return
-        visited_kpis.add(kid)
-        
-        spec = next((s for s in all_specs if s['id'] == kid), None)
-        if spec and spec.get('is_calculated'):
             try:
-                formula = spec.get('formula_json') or spec.get('formula_string')
-                deps = []
-                if spec.get('formula_json'):
-                    dag = KpiDAG.from_json(spec['formula_json'])
-                    deps = [d['kpi_id'] for d in dag.find_all_kpi_dependencies()]
+                if plan is not None:
+                    def kpi_resolver(k_id, t_n):
+                        val_rec = snapshot.target_value_record(k_id, t_n)
+                        return float(val_rec['target_value']) if val_rec else 0.0
+                    calculated_value = plan.evaluate(kpi_resolver, default_target_num=target_num_to_calculate)
                 else:
-                    deps = [int(mid) for mid in re.findall(r'\[(\d+)\]', formula)]
-                
-                for d in deps:
-                    if d in full_update_set:
-                        visit_kpi_topo(d)
-            except: pass
-        sorted_kpis.append(kid)
+                    calculated_value = _evaluate_legacy_formula(formula_to_use, context_vars)
+
+                snapshot.set_computed_value(kpi_id_to_calc, target_num_to_calculate, calculated_value)
+                calculated_successfully.add(kpi_id_to_calc)
+            except Exception as e_eval:
+                print(f"      ERROR: Formula failed for KPI {kpi_id_to_calc} T{target_num_to_calculate}: {e_eval}")
+
+    # Change detection only decides what is written here. The spec, its Global Split or
+    # a formula may have changed without the annual values moving, so every submitted
+    # KPI (plus dependents of changed ones) goes to the repartition step, whose
+    # fingerprints skip the series whose inputs are unchanged.
+    changed_kpi_ids = snapshot.changed_kpi_ids
+    kpis_needing_repartition_update.update(changed_kpi_ids)
+    kpis_needing_repartition_update.update(submitted_kpi_ids)
+    snapshot.flush()
 
-    for kid in list(full_update_set):
-        visit_kpi_topo(kid)
+    # Phase 3: (Removed) Master/Sub distribution
 
+    # Phase 4: Repartitions (Processed in dependency order)
+    # Everything depending, directly or transitively, on a changed KPI is repartitioned too.
+    sorted_kpis = dep_graph.topological_order(dep_graph.dirty_set(kpis_needing_repartition_update))
+
+    repartition_series = []
     for kid in sorted_kpis:
-        entry = get_annual_target_entry(year, plant_id, kid)
+        entry = snapshot.entry(kid)
         if entry:
             for tv in entry['target_values']:
                 if tv['target_value'] is not None:
-                    print(f"    Repartitioning KPI {kid} Target {tv['target_number']}...")
-                    repartition_module.calculate_and_save_all_repartitions(year, plant_id, kid, tv['target_number'])
-
-    print(f"INFO: Finished save_annual_targets for Year: {year}, Plant: {plant_id}")
+                    repartition_series.append((plant_id, kid, tv['target_number']))
+    unchanged = len(submitted_kpi_ids - set(changed_kpi_ids))
+    if unchanged:
+        print(f"  INFO: {unchanged} of {len(submitted_kpi_ids)} submitted KPIs have unchanged annual values.")
+    return repartition_series, len(changed_kpi_ids), unchanged
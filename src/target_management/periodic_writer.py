@@ -0,0 +1,117 @@
+# src/target_management/periodic_writer.py
+import sqlite3
+
+import numpy as np
+
+from src.data_access.connections import attached_session
+
+# period -> (attached_session() schema, database file, table, period column)
+PERIOD_TABLES = {
+    "days": ("main", "db_kpi_days.db", "daily_targets", "date_value"),
+    "weeks": ("weeks", "db_kpi_weeks.db", "weekly_targets", "week_value"),
+    "months": ("months", "db_kpi_months.db", "monthly_targets", "month_value"),
+    "quarters": ("quarters", "db_kpi_quarters.db", "quarterly_targets", "quarter_value"),
+}
+
+
+class PeriodicTargetWriter:
+    """
+    Collects daily/weekly/monthly/quarterly target rows for a whole save operation
+    and writes them in one transaction over the attached-database session, which
+    covers the four period databases (and commits them atomically with the default
+    rollback journal).
+
+    Values are buffered as (series x periods) arrays and only expanded to rows while
+    flushing, so large multi-plant saves stay cheap to hold in memory.
+    """
+
+    def __init__(self):
+        self._series_keys = {}  # (year, plant_id, kpi_id, target_number) -> None, an ordered set
+        self._batches = []  # (period alias, year, series_keys, labels, values)
+        self._fingerprints = {}  # (year, plant_id, kpi_id, target_number) -> fingerprint
+
+    def add(self, period: str, year: int, series_keys: list, labels: list, values: np.ndarray):
+        """
+        Buffers one period's values for a batch of series.
+        series_keys: [(plant_id, kpi_id, target_number), ...] aligned with the rows of values;
+        labels: the period value stored for each column (date, week, month or quarter).
+        """
+        if period not in PERIOD_TABLES:
+            raise ValueError(f"Unknown period '{period}'. Must be one of {list(PERIOD_TABLES)}.")
+        series_keys = list(series_keys)
+        for plant_id, kpi_id, target_number in series_keys:
+            self._series_keys[(year, plant_id, kpi_id, target_number)] = None
+        self._batches.append((period, year, series_keys, list(labels), np.atleast_2d(values)))
+
+    def set_fingerprint(self, year: int, plant_id: int, kpi_id: int, target_number: int, fingerprint: str):
+        """Records the content fingerprint stored alongside a series' rows."""
+        self._fingerprints[(year, plant_id, kpi_id, target_number)] = fingerprint
+
+    def merge(self, other: "PeriodicTargetWriter"):
+        """Takes over the pending rows of another writer (e.g. one filled by a worker)."""
+        self._series_keys.update(other._series_keys)
+        self._batches.extend(other._batches)
+        self._fingerprints.update(other._fingerprints)
+
+    @property
+    def series_count(self) -> int:
+        return len(self._series_keys)
+
+    def flush(self):
+        """Replaces the stored rows (and fingerprints) of every buffered series in a single transaction."""
+        if not self._batches: return
+
+        delete_keys = list(self._series_keys)
+        with attached_session() as conn:
+            try:
+                with conn:
+                    for schema, _, table_name, _ in PERIOD_TABLES.values():
+                        conn.executemany(
+                            f"DELETE FROM {schema}.{table_name} WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?",
+                            delete_keys,
+                        )
+                    for period, year, series_keys, labels, values in self._batches:
+                        schema, _, table_name, period_col = PERIOD_TABLES[period]
+                        conn.executemany(
+                            f"INSERT INTO {schema}.{table_name} (year,plant_id,kpi_id,target_number,{period_col},target_value) VALUES (?,?,?,?,?,?)",
+                            _iter_records(year, series_keys, labels, values),
+                        )
+                    conn.executemany(
+                        """INSERT INTO main.repartition_fingerprints (year, plant_id, kpi_id, target_number, fingerprint)
+                           VALUES (?,?,?,?,?)
+                           ON CONFLICT(year, plant_id, kpi_id, target_number) DO UPDATE SET fingerprint=excluded.fingerprint""",
+                        [(*key, fp) for key, fp in self._fingerprints.items()],
+                    )
+            except sqlite3.Error as e:
+                print(f"ERROR: Failed to write periodic targets for {len(delete_keys)} series: {e}")
+                raise
+
+        self._series_keys = {}
+        self._batches = []
+        self._fingerprints = {}
+
+
+def clear_repartition_fingerprints(keys=None):
+    """
+    Forgets the stored fingerprints of the given (year, plant_id, kpi_id) keys, or of
+    every series when keys is None, so their next save repartitions them again. Call
+    after target or spec data changed outside a save (imports, raw deletes).
+    """
+    with attached_session() as conn:
+        try:
+            if keys is None:
+                conn.execute("DELETE FROM main.repartition_fingerprints")
+            else:
+                conn.executemany(
+                    "DELETE FROM main.repartition_fingerprints WHERE year=? AND plant_id=? AND kpi_id=?",
+                    list(dict.fromkeys(keys)),
+                )
+        except sqlite3.Error as e:
+            print(f"ERROR: Failed to clear repartition fingerprints: {e}")
+            raise
+
+
+def _iter_records(year, series_keys, labels, values):
+    for (plant_id, kpi_id, target_number), row in zip(series_keys, values.tolist()):
+        for label, val in zip(labels, row):
+            yield (year, plant_id, kpi_id, target_number, label, val)
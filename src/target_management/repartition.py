@@ -6,66 +6,76 @@ import calendar
 import numpy as np
 import pandas as pd
 import traceback
+import hashlib
+import re
+from functools import lru_cache
 from src.config import settings as app_config
 
 from src.data_retriever import (
-    get_annual_target_entry, 
-    get_kpi_detailed_by_id,
-    get_daily_targets_for_kpi
+    get_annual_target_entries_for_plants,
+    get_all_kpis_detailed,
+    get_daily_target_rows_for_kpis,
+    get_repartition_fingerprints,
 )
-from src.kpi_management.splits import get_global_split
+from src.kpi_management.splits import get_global_splits_by_ids
 from src.utils.repartition_utils import (
     get_weighted_proportions,
     get_parabolic_proportions,
     get_sinusoidal_proportions,
     get_date_ranges_for_quarters,
+    get_year_calendar,
 )
 from src.interfaces.common_ui.helpers import get_kpi_display_name
-from src.core.node_engine import KpiDAG
+from src.core.node_engine import get_compiled_dag
+from src.core.dependency_graph import topological_order
+from src.core.formula_evaluator import evaluate_formula_vectorized
+from src.target_management.periodic_writer import PeriodicTargetWriter
 
 # --- Formula Evaluation Helper ---
-def _evaluate_daily_formula(formula_to_use, context_vars, is_node_dag=False, kpi_resolver=None, default_tn=1):
-    """Evaluates a formula for a specific day context."""
-    if is_node_dag and kpi_resolver:
-        dag = KpiDAG.from_json(formula_to_use)
-        return dag.evaluate(kpi_resolver, default_target_num=default_tn)
-    
-    # Legacy string formula
-    import re
+def _evaluate_formula_over_days(formula_to_use: str, dep_daily_data: dict, n_days) -> np.ndarray:
+    """
+    Evaluates a legacy [ID] string formula once over whole daily series.
+    dep_daily_data maps kpi_id -> daily array; unknown ids read as 0. Days where the
+    result is not finite (e.g. a division by zero) are 0, as are all days when the
+    formula itself cannot be evaluated.
+    """
     try:
-        pattern = r'\[(\d+)\]'
-        def replacer(match):
-            kpi_id = match.group(1)
-            val = context_vars.get(f"kpi_{kpi_id}", 0.0)
-            return str(val)
-        processed = re.sub(pattern, replacer, formula_to_use)
-        allowed = {"abs": abs, "min": min, "max": max, "round": round}
-        return float(eval(processed, {"__builtins__": None}, allowed))
+        return evaluate_formula_vectorized(formula_to_use, {f"kpi_{kid}": arr for kid, arr in dep_daily_data.items()}, n_days)
     except:
-        return 0.0
+        return np.zeros(n_days)
 
-def _reconcile_and_adjust_daily_values(daily_values: np.ndarray, target_annual: float, kpi_calc_type: str):
-    """Ensures sum/mean matches target_annual by distributing the difference."""
+def _reconcile_and_adjust_daily_values(daily_values: np.ndarray, target_annual, kpi_calc_type: str):
+    """
+    Ensures sum/mean matches target_annual by distributing the difference.
+    Works on a single daily vector or on a (series x days) matrix with one target per row.
+    """
     if daily_values.size == 0: return daily_values
     
-    current_val = np.sum(daily_values) if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL else np.mean(daily_values)
-    diff = target_annual - current_val
-    
-    if abs(diff) < 1e-9: return daily_values
+    current_val = np.sum(daily_values, axis=-1) if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL else np.mean(daily_values, axis=-1)
+    diff = np.asarray(target_annual, dtype=float) - current_val
+    diff = np.where(np.abs(diff) < 1e-9, 0.0, diff)
     
-    # Split the difference across all days
-    adjustment = diff / daily_values.size
-    if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL:
-        # For incremental, we add the adjustment so the sum matches
-        daily_values += adjustment
-    else:
-        # For average, adding the same adjustment to every day shifts the mean by exactly that adjustment
-        daily_values += adjustment
-        
+    # Split the difference across all days: for incremental this fixes the sum,
+    # for average adding the same adjustment to every day shifts the mean by exactly that amount
+    daily_values += (diff / daily_values.shape[-1])[..., None]
     return daily_values
 
 # --- Repartition Logic and Calculation ---
 
+def _resolve_universal_logic(repartition_logic: str, repartition_values: dict):
+    """
+    Maps the multi-level "universal" logic of Global Splits to the level the engine
+    distributes by (monthly if present, else quarterly), returning (logic, values).
+    """
+    if repartition_logic == "universal":
+        # We determine which level to use based on the context.
+        # However, for the current engine, we'll map to Monthly as the primary driver if present.
+        if "monthly" in repartition_values:
+            return app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_MONTH"], repartition_values["monthly"]
+        if "quarterly" in repartition_values:
+            return app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_QUARTER"], repartition_values["quarterly"]
+    return repartition_logic, repartition_values
+
 def _get_period_allocations(
     annual_target: float,
     user_repartition_logic: str,
@@ -77,15 +87,7 @@ def _get_period_allocations(
     period_allocations = {}
 
     # Handle Universal Mode from Global Splits
-    if user_repartition_logic == "universal":
-        # We determine which level to use based on the context. 
-        # However, for the current engine, we'll map to Monthly as the primary driver if present.
-        if "monthly" in user_repartition_values:
-            user_repartition_logic = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_MONTH"]
-            user_repartition_values = user_repartition_values["monthly"]
-        elif "quarterly" in user_repartition_values:
-            user_repartition_logic = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_QUARTER"]
-            user_repartition_values = user_repartition_values["quarterly"]
+    user_repartition_logic, user_repartition_values = _resolve_universal_logic(user_repartition_logic, user_repartition_values)
 
     if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL:
         if user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_MONTH"]:
@@ -129,7 +131,7 @@ def _get_period_allocations(
                     sum_of_week_percentages += prop_val
                 except: continue
 
-            unique_iso_weeks = sorted(list(set(f"{d.isocalendar()[0]:04d}-W{d.isocalendar()[1]:02d}" for d in all_dates_in_year)))
+            unique_iso_weeks = get_year_calendar(year).week_keys
             if not valid_week_props or abs(sum_of_week_percentages) < 1e-9:
                 prop = 1.0 / len(unique_iso_weeks) if unique_iso_weeks else 0
                 for wk in unique_iso_weeks: period_allocations[wk] = annual_target * prop
@@ -149,8 +151,7 @@ def _get_period_allocations(
                 val = float(user_repartition_values.get(f"Q{q+1}", 100.0) or 100.0) / 100.0
                 for m in range(q*3, (q+1)*3): period_allocations[m] = val
         elif user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_WEEK"]:
-            unique_iso_weeks = sorted(list(set(f"{d.isocalendar()[0]:04d}-W{d.isocalendar()[1]:02d}" for d in all_dates_in_year)))
-            for wk in unique_iso_weeks: period_allocations[wk] = 1.0
+            for wk in get_year_calendar(year).week_keys: period_allocations[wk] = 1.0
             for wk, mult in user_repartition_values.items():
                 try: period_allocations[wk] = float(mult or 100.0) / 100.0
                 except: pass
@@ -169,255 +170,461 @@ def _get_raw_daily_values_for_repartition(
 ) -> np.ndarray:
     days_in_year = len(all_dates_in_year)
     if days_in_year == 0: return np.array([])
+    cal = get_year_calendar(year)
     raw_daily_values = np.zeros(days_in_year)
 
+    LOGIC_YEAR = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_YEAR"]
+    LOGIC_MONTH = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_MONTH"]
+    LOGIC_QUARTER = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_QUARTER"]
+    LOGIC_WEEK = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_WEEK"]
+
     if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL:
         if distribution_profile == app_config.CALCULATION_CONSTANTS["PROFILE_EVEN"]:
-            if user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_YEAR"] or not period_allocations_map:
+            if user_repartition_logic == LOGIC_YEAR or not period_allocations_map:
                 raw_daily_values.fill(annual_target / days_in_year)
-            else:
-                for d_idx, date_val in enumerate(all_dates_in_year):
-                    if user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_MONTH"]:
-                        month_sum = period_allocations_map.get(date_val.month - 1, 0.0)
-                        _, days_in_month = calendar.monthrange(year, date_val.month)
-                        raw_daily_values[d_idx] = month_sum / days_in_month
-                    elif user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_QUARTER"]:
-                        q_idx = (date_val.month - 1) // 3
-                        q_sum = period_allocations_map.get(q_idx, 0.0)
-                        q_ranges = get_date_ranges_for_quarters(year)
-                        q_days = (q_ranges[q_idx+1][1] - q_ranges[q_idx+1][0]).days + 1
-                        raw_daily_values[d_idx] = q_sum / q_days
-                    elif user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_WEEK"]:
-                        wk_key = f"{date_val.isocalendar()[0]:04d}-W{date_val.isocalendar()[1]:02d}"
-                        wk_sum = period_allocations_map.get(wk_key, 0.0)
-                        wk_days = sum(1 for d in all_dates_in_year if f"{d.isocalendar()[0]:04d}-W{d.isocalendar()[1]:02d}" == wk_key)
-                        raw_daily_values[d_idx] = wk_sum / wk_days
+            elif user_repartition_logic == LOGIC_MONTH:
+                raw_daily_values = cal.per_month(period_allocations_map) / cal.days_per_month[cal.month_index]
+            elif user_repartition_logic == LOGIC_QUARTER:
+                raw_daily_values = cal.per_quarter(period_allocations_map) / cal.days_per_quarter[cal.quarter_index]
+            elif user_repartition_logic == LOGIC_WEEK:
+                raw_daily_values = cal.per_week(period_allocations_map) / cal.days_per_week[cal.week_index]
 
         elif distribution_profile == app_config.CALCULATION_CONSTANTS["PROFILE_ANNUAL_PROGRESSIVE"]:
-            if user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_YEAR"]:
+            if user_repartition_logic == LOGIC_YEAR:
                 props = get_weighted_proportions(days_in_year, 0.8, 1.2, decreasing=True)
-                raw_daily_values = np.array([annual_target * p for p in props])
+                raw_daily_values = annual_target * np.asarray(props)
             else: raw_daily_values.fill(annual_target / days_in_year)
 
         elif distribution_profile == app_config.CALCULATION_CONSTANTS["PROFILE_TRUE_ANNUAL_SINUSOIDAL"]:
             amp = float(profile_params.get("sine_amplitude", 0.1))
             phase = float(profile_params.get("sine_phase", 0.0))
             props = get_sinusoidal_proportions(days_in_year, amp, phase)
-            raw_daily_values = np.array([annual_target * p for p in props])
+            raw_daily_values = annual_target * np.asarray(props)
         
         else: # Default
             raw_daily_values.fill(annual_target / days_in_year)
 
     elif kpi_calc_type == app_config.CALC_TYPE_AVERAGE:
-        for d_idx, date_val in enumerate(all_dates_in_year):
-            base_avg = annual_target
-            if user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_MONTH"]:
-                base_avg *= period_allocations_map.get(date_val.month - 1, 1.0)
-            elif user_repartition_logic == app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_WEEK"]:
-                wk_key = f"{date_val.isocalendar()[0]:04d}-W{date_val.isocalendar()[1]:02d}"
-                base_avg *= period_allocations_map.get(wk_key, 1.0)
-            
-            if distribution_profile == app_config.CALCULATION_CONSTANTS["PROFILE_EVEN"]:
-                raw_daily_values[d_idx] = base_avg
-            elif distribution_profile == app_config.CALCULATION_CONSTANTS["PROFILE_ANNUAL_PROGRESSIVE"]:
-                factor = np.linspace(0.8, 1.2, days_in_year)[d_idx]
-                raw_daily_values[d_idx] = base_avg * (1 + (factor - 1.0) * 0.2)
-            else:
-                raw_daily_values[d_idx] = base_avg
+        base_avg = np.full(days_in_year, float(annual_target))
+        if user_repartition_logic == LOGIC_MONTH:
+            base_avg *= cal.per_month(period_allocations_map, default=1.0)
+        elif user_repartition_logic == LOGIC_WEEK:
+            base_avg *= cal.per_week(period_allocations_map, default=1.0)
+
+        if distribution_profile == app_config.CALCULATION_CONSTANTS["PROFILE_ANNUAL_PROGRESSIVE"]:
+            factor = np.linspace(0.8, 1.2, days_in_year)
+            raw_daily_values = base_avg * (1 + (factor - 1.0) * 0.2)
+        else:
+            raw_daily_values = base_avg
 
     return raw_daily_values
 
 
-def _apply_event_adjustments_to_daily_values(
-    raw_daily_values_input: np.ndarray,
-    event_data_list: list,
-    kpi_calc_type: str,
-    annual_target_for_normalization: float,
-    all_dates_in_year: list,
-) -> np.ndarray:
-    if not event_data_list: return raw_daily_values_input
-    adj = np.copy(raw_daily_values_input)
-    for ev in event_data_list:
+@lru_cache(maxsize=256)
+def _compile_event_adjustments(year: int, events_key: str):
+    """
+    Compiles a JSON list of events into day-indexed (multiplier, addition) arrays such
+    that ``raw * multiplier + addition`` equals applying every event in order.
+    Invalid events are skipped; date ranges are inclusive and clipped to the year.
+    """
+    n_days = get_year_calendar(year).days_in_year
+    multiplier = np.ones(n_days)
+    addition = np.zeros(n_days)
+    start_of_year = datetime.date(year, 1, 1)
+    for ev in json.loads(events_key):
         try:
             start = datetime.datetime.strptime(ev["start_date"], "%Y-%m-%d").date()
             end = datetime.datetime.strptime(ev["end_date"], "%Y-%m-%d").date()
             mult = float(ev.get("multiplier", 1.0))
             add = float(ev.get("addition", 0.0))
-            for d_idx, d_val in enumerate(all_dates_in_year):
-                if start <= d_val <= end:
-                    if kpi_calc_type == app_config.CALC_TYPE_AVERAGE:
-                        adj[d_idx] = (adj[d_idx] * mult) + add
-                    else:
-                        adj[d_idx] = (adj[d_idx] * mult) + add
         except: continue
+        s_idx = max((start - start_of_year).days, 0)
+        e_idx = min((end - start_of_year).days, n_days - 1)
+        if s_idx > e_idx: continue
+        multiplier[s_idx:e_idx + 1] *= mult
+        addition[s_idx:e_idx + 1] = addition[s_idx:e_idx + 1] * mult + add
+    multiplier.setflags(write=False)
+    addition.setflags(write=False)
+    return multiplier, addition
+
+
+def _apply_event_adjustments_to_daily_values(
+    raw_daily_values_input: np.ndarray,
+    event_data_list: list,
+    kpi_calc_type: str,
+    annual_target_for_normalization,
+    year: int,
+) -> np.ndarray:
+    """
+    Applies event multipliers/additions to a daily vector, or to a (series x days)
+    matrix sharing the same events (with one normalization target per row).
+    """
+    if not event_data_list: return raw_daily_values_input
+    multiplier, addition = _compile_event_adjustments(year, json.dumps(event_data_list, sort_keys=True))
+    adj = raw_daily_values_input * multiplier + addition
     
-    if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL and abs(annual_target_for_normalization) > 1e-9:
-        curr = np.sum(adj)
-        if abs(curr) > 1e-9: adj *= (annual_target_for_normalization / curr)
+    if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL:
+        targets = np.asarray(annual_target_for_normalization, dtype=float)
+        curr = np.sum(adj, axis=-1)
+        rescale = (np.abs(targets) > 1e-9) & (np.abs(curr) > 1e-9)
+        adj *= np.where(rescale, targets / np.where(rescale, curr, 1.0), 1.0)[..., None]
     return adj
 
 
+def _aggregate_periodic_targets(daily_values: np.ndarray, year: int, kpi_calc_type: str) -> dict:
+    """
+    Rolls daily values up to weeks, months and quarters.
+    daily_values is a daily vector or a (series x days) matrix; each result keeps the
+    leading series axis and has one column per period (sum for incremental, mean otherwise).
+    """
+    cal = get_year_calendar(year)
+    periods = {
+        "weekly": (cal.week_starts, cal.days_per_week),
+        "monthly": (cal.month_starts, cal.days_per_month),
+        "quarterly": (cal.quarter_starts, cal.days_per_quarter),
+    }
+    aggregates = {}
+    for period, (starts, counts) in periods.items():
+        totals = np.add.reduceat(daily_values, starts, axis=-1)
+        aggregates[period] = totals if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL else totals / counts
+    return aggregates
+
+
 def _aggregate_and_save_periodic_targets(
-    daily_targets_with_dates: list,
+    daily_values: np.ndarray,
     year: int,
-    plant_id: int,
-    kpi_spec_id: int,
-    target_number: int,
+    series_keys: list,
     kpi_calc_type: str,
+    writer: PeriodicTargetWriter = None,
 ):
-    if not daily_targets_with_dates: return
-
-    # --- Save Daily ---
-    recs = [(year, plant_id, kpi_spec_id, target_number, d.isoformat(), float(v)) for d, v in daily_targets_with_dates]
-    with sqlite3.connect(app_config.get_database_path("db_kpi_days.db")) as conn:
-        conn.execute("DELETE FROM daily_targets WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?", (year, plant_id, kpi_spec_id, target_number))
-        conn.executemany("INSERT INTO daily_targets (year,plant_id,kpi_id,target_number,date_value,target_value) VALUES (?,?,?,?,?,?)", recs)
-        conn.commit()
-
-    # --- Aggregate Weekly ---
-    weeks = {}
-    for d, v in daily_targets_with_dates:
-        wk = f"{d.isocalendar()[0]:04d}-W{d.isocalendar()[1]:02d}"
-        if wk not in weeks: weeks[wk] = []
-        weeks[wk].append(v)
-    
-    w_recs = []
-    for wk, vals in weeks.items():
-        val = sum(vals) if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL else np.mean(vals)
-        w_recs.append((year, plant_id, kpi_spec_id, target_number, wk, float(val)))
-    
-    with sqlite3.connect(app_config.get_database_path("db_kpi_weeks.db")) as conn:
-        conn.execute("DELETE FROM weekly_targets WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?", (year, plant_id, kpi_spec_id, target_number))
-        conn.executemany("INSERT INTO weekly_targets (year,plant_id,kpi_id,target_number,week_value,target_value) VALUES (?,?,?,?,?,?)", w_recs)
-        conn.commit()
-
-    # --- Aggregate Monthly ---
-    months = {i: [] for i in range(1, 13)}
-    for d, v in daily_targets_with_dates: months[d.month].append(v)
-    
-    m_recs = []
-    for m, vals in months.items():
-        if not vals: continue
-        val = sum(vals) if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL else np.mean(vals)
-        m_recs.append((year, plant_id, kpi_spec_id, target_number, calendar.month_name[m], float(val)))
-    
-    with sqlite3.connect(app_config.get_database_path("db_kpi_months.db")) as conn:
-        conn.execute("DELETE FROM monthly_targets WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?", (year, plant_id, kpi_spec_id, target_number))
-        conn.executemany("INSERT INTO monthly_targets (year,plant_id,kpi_id,target_number,month_value,target_value) VALUES (?,?,?,?,?,?)", m_recs)
-        conn.commit()
-
-    # --- Aggregate Quarterly ---
-    quarters = {1: [], 2: [], 3: [], 4: []}
-    for d, v in daily_targets_with_dates: quarters[((d.month-1)//3)+1].append(v)
-    
-    q_recs = []
-    for q, vals in quarters.items():
-        if not vals: continue
-        val = sum(vals) if kpi_calc_type == app_config.CALC_TYPE_INCREMENTAL else np.mean(vals)
-        q_recs.append((year, plant_id, kpi_spec_id, target_number, f"Q{q}", float(val)))
-    
-    with sqlite3.connect(app_config.get_database_path("db_kpi_quarters.db")) as conn:
-        conn.execute("DELETE FROM quarterly_targets WHERE year=? AND plant_id=? AND kpi_id=? AND target_number=?", (year, plant_id, kpi_spec_id, target_number))
-        conn.executemany("INSERT INTO quarterly_targets (year,plant_id,kpi_id,target_number,quarter_value,target_value) VALUES (?,?,?,?,?,?)", q_recs)
-        conn.commit()
-
-
-def calculate_and_save_all_repartitions(year: int, plant_id: int, kpi_spec_id: int, target_number: int):
-    """Orchestrates periodic repartition with support for On-the-fly formula logic."""
-    target_info = get_annual_target_entry(year, plant_id, kpi_spec_id)
-    if not target_info: return
-
-    kpi_details = dict(get_kpi_detailed_by_id(kpi_spec_id) or {})
-    kpi_calc_type = kpi_details.get("calculation_type", app_config.CALC_TYPE_INCREMENTAL)
-    
-    t_val_rec = next((tv for tv in target_info.get('target_values', []) if tv['target_number'] == target_number), None)
-    annual_target_to_use = float(t_val_rec['target_value']) if t_val_rec and t_val_rec['target_value'] is not None else None
-    
-    if annual_target_to_use is None: return
+    """
+    Queues daily values and their weekly/monthly/quarterly aggregates for a batch of
+    series sharing one calculation type. daily_values is (series x days), aligned
+    with series_keys = [(plant_id, kpi_spec_id, target_number), ...].
+    Without a writer the rows are written immediately.
+    """
+    if not series_keys: return
+    cal = get_year_calendar(year)
+    daily_values = np.atleast_2d(daily_values)
+    aggregates = _aggregate_periodic_targets(daily_values, year, kpi_calc_type)
+
+    own_writer = writer is None
+    if own_writer: writer = PeriodicTargetWriter()
+    writer.add("days", year, series_keys, cal.iso_dates, daily_values)
+    writer.add("weeks", year, series_keys, cal.week_keys, aggregates["weekly"])
+    writer.add("months", year, series_keys, calendar.month_name[1:], aggregates["monthly"])
+    writer.add("quarters", year, series_keys, [f"Q{q}" for q in range(1, 5)], aggregates["quarterly"])
+    if own_writer: writer.flush()
+
+
+def _resolve_repartition_settings(kpi_spec_id: int, target_info: dict, kpi_details: dict, gs: dict):
+    """Returns (logic, profile, values, params) for a rule-based series, honouring Global Split overrides."""
+    if gs:
+        logic, profile, vals, params = gs['repartition_logic'], gs['distribution_profile'], gs['repartition_values'], gs['profile_params']
+        # The daily profile must see the level the allocations were computed for; with the
+        # raw "universal" logic it ignored the allocations and spread the target evenly
+        logic, vals = _resolve_universal_logic(logic, vals)
+        
+        # Check for per-indicator profile override within this global split
+        ind_id = kpi_details.get('indicator_id')
+        override = next((a for a in gs.get('afflicted_indicators', []) if a['indicator_id'] == ind_id), None)
+        if override and override.get('override_distribution_profile'):
+            profile = override['override_distribution_profile']
+            print(f"      INFO: Using override profile '{profile}' for KPI {kpi_spec_id} in Global Split {gs['id']}")
+    else:
+        REPARTITION_LOGIC_YEAR = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_YEAR"]
+        PROFILE_ANNUAL_PROGRESSIVE = app_config.CALCULATION_CONSTANTS["PROFILE_ANNUAL_PROGRESSIVE"]
+        
+        logic = target_info.get("repartition_logic", REPARTITION_LOGIC_YEAR)
+        profile = target_info.get("distribution_profile") or kpi_details.get("default_distribution_profile") or PROFILE_ANNUAL_PROGRESSIVE
+        vals = json.loads(target_info.get("repartition_values", "{}") or "{}")
+        params = json.loads(target_info.get("profile_params", "{}") or "{}")
+    return logic, profile, vals, params
 
-    # --- Date Generation ---
-    start_of_year = datetime.date(year, 1, 1)
-    all_dates = [start_of_year + datetime.timedelta(days=i) for i in range((datetime.date(year, 12, 31) - start_of_year).days + 1)]
 
-    final_daily_values = None
-    
-    # --- ON-THE-FLY FORMULA LOGIC ---
+def preview_repartition(
+    year: int,
+    annual_target: float,
+    kpi_calc_type: str,
+    repartition_logic: str,
+    repartition_values: dict,
+    distribution_profile: str,
+    profile_params: dict = None,
+) -> dict:
+    """
+    Computes the periodic split of an annual value without touching any database, for
+    editors that want to show the resulting curve before saving.
+
+    Global Split "universal" values are resolved like a save does.
+
+    Returns {"dates", "daily", "weeks", "weekly", "monthly", "quarterly"}; the arrays are
+    read-only and the labels tuples because results are memoised and shared between callers.
+    """
+    repartition_logic, repartition_values = _resolve_universal_logic(repartition_logic, repartition_values or {})
+    return _preview_repartition_cached(
+        int(year), float(annual_target), kpi_calc_type, repartition_logic,
+        json.dumps(repartition_values, sort_keys=True), distribution_profile,
+        json.dumps(profile_params or {}, sort_keys=True),
+    )
+
+
+@lru_cache(maxsize=128)
+def _preview_repartition_cached(year, annual_target, kpi_calc_type, logic, values_key, profile, params_key):
+    cal = get_year_calendar(year)
+    vals, params = json.loads(values_key), json.loads(params_key)
+
+    allocs = _get_period_allocations(annual_target, logic, vals, year, kpi_calc_type, cal.dates)
+    daily = _get_raw_daily_values_for_repartition(year, annual_target, kpi_calc_type, profile, params, logic, allocs, cal.dates)
+    if params.get("events"):
+        daily = _apply_event_adjustments_to_daily_values(daily, params["events"], kpi_calc_type, annual_target, year)
+    daily = _reconcile_and_adjust_daily_values(np.array(daily, dtype=float), annual_target, kpi_calc_type)
+
+    result = {"daily": daily, **_aggregate_periodic_targets(daily, year, kpi_calc_type)}
+    for arr in result.values():
+        arr.setflags(write=False)
+    result.update(dates=cal.iso_dates, weeks=cal.week_keys)
+    return result
+
+
+def _get_formula_dependencies(kpi_details: dict, target_number: int):
+    """
+    Returns (plan, deps) for a calculated KPI: plan is the compiled DagPlan (None for
+    legacy string formulas) and deps the [{"kpi_id", "target_num"}] it reads.
+    """
     formula_json = kpi_details.get("formula_json")
     formula_str = kpi_details.get("formula_string")
-    is_formula = t_val_rec.get('is_formula_based', False)
-    
-    if is_formula and (formula_json or formula_str):
-        print(f"    INFO: Calculating on-the-fly periodic values for KPI {kpi_spec_id}...")
-        is_dag = False
-        try:
-            if formula_json:
-                dj = json.loads(formula_json)
-                if "nodes" in dj: is_dag = True
-        except: pass
-        
-        dag = KpiDAG.from_json(formula_json) if is_dag else None
-        deps = dag.find_all_kpi_dependencies() if is_dag else []
-        
-        if not is_dag and formula_str:
-            import re
-            dep_ids = list(set(re.findall(r'\[(\d+)\]', formula_str)))
-            deps = [{"kpi_id": int(i), "target_num": target_number} for i in dep_ids]
-
-        dep_daily_data = {}
-        for d in deps:
-            rows = get_daily_targets_for_kpi(year, plant_id, d['kpi_id'], d['target_num'])
-            arr = np.zeros(len(all_dates))
-            date_map = {r['date_value']: r['target_value'] for r in rows}
-            for idx, dt in enumerate(all_dates):
-                arr[idx] = date_map.get(dt.isoformat(), 0.0)
-            dep_daily_data[d['kpi_id']] = arr
-
-        calculated_days = np.zeros(len(all_dates))
-        for idx in range(len(all_dates)):
-            if is_dag:
-                def daily_resolver(kid, tn):
-                    return dep_daily_data.get(kid, np.zeros(len(all_dates)))[idx]
-                calculated_days[idx] = dag.evaluate(daily_resolver, default_target_num=target_number)
-            else:
-                ctx = {f"kpi_{kid}": arr[idx] for kid, arr in dep_daily_data.items()}
-                calculated_days[idx] = _evaluate_daily_formula(formula_str, ctx)
-        
-        final_daily_values = _reconcile_and_adjust_daily_values(calculated_days, annual_target_to_use, kpi_calc_type)
 
-    # --- FALLBACK: RULE-BASED SPLIT ---
-    if final_daily_values is None:
-        global_split_id = target_info.get("global_split_id")
-        gs = get_global_split(global_split_id) if global_split_id else None
-        
-        if gs:
-            logic, profile, vals, params = gs['repartition_logic'], gs['distribution_profile'], gs['repartition_values'], gs['profile_params']
-            
-            # Check for per-indicator profile override within this global split
-            try:
-                from src.kpi_management.splits import get_indicators_for_global_split
-                afflicted = get_indicators_for_global_split(global_split_id)
-                ind_id = kpi_details.get('indicator_id')
-                override = next((a for a in afflicted if a['indicator_id'] == ind_id), None)
-                if override and override.get('override_distribution_profile'):
-                    profile = override['override_distribution_profile']
-                    print(f"      INFO: Using override profile '{profile}' for KPI {kpi_spec_id} in Global Split {global_split_id}")
-            except Exception as e_gs:
-                print(f"      WARNING: Could not check for Global Split override: {e_gs}")
+    is_dag = False
+    try:
+        if formula_json:
+            dj = json.loads(formula_json)
+            if "nodes" in dj: is_dag = True
+    except: pass
+
+    if is_dag:
+        compiled = get_compiled_dag(formula_json)
+        return compiled.plan, compiled.dependencies
+    if formula_str:
+        dep_ids = list(set(re.findall(r'\[(\d+)\]', formula_str)))
+        return None, [{"kpi_id": int(i), "target_num": target_number} for i in dep_ids]
+    return None, []
+
+
+# Bump whenever the repartition maths change so stored fingerprints stop matching.
+_FINGERPRINT_VERSION = 1
+
+
+def _repartition_fingerprint(**content) -> str:
+    """
+    Content hash of everything a series' periodic rows are derived from. Callers pass
+    the calculation type, annual value and either the resolved split settings (which
+    already carry any Global Split and its per-indicator override) or the formula
+    together with its dependencies' fingerprints.
+    """
+    payload = {"version": _FINGERPRINT_VERSION, "constants": app_config.CALCULATION_CONSTANTS, **content}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _calculate_formula_daily_values(year: int, plant_ids: list, kpi_spec_id: int, target_number: int, kpi_details: dict, dep_loader) -> np.ndarray:
+    """
+    Evaluates a calculated KPI over the whole year for several plants at once from its
+    dependencies' daily series, returning a (plants x days) matrix in plant_ids order.
+    dep_loader(plant_id, kpi_id, target_number) must return a daily np.ndarray for the year.
+    """
+    shape = (len(plant_ids), get_year_calendar(year).days_in_year)
+    formula_str = kpi_details.get("formula_string")
+    plan, deps = _get_formula_dependencies(kpi_details, target_number)
+
+    dep_daily_data = {}
+    for d in deps:
+        dep_daily_data[d['kpi_id']] = np.vstack([dep_loader(plant_id, d['kpi_id'], d['target_num']) for plant_id in plant_ids])
+
+    if plan is not None:
+        zeros = np.zeros(shape)
+        return plan.evaluate_array(lambda kid, tn: dep_daily_data.get(kid, zeros), shape, default_target_num=target_number)
+    return _evaluate_formula_over_days(formula_str, dep_daily_data, shape)
+
+
+def _load_stored_daily_matrix(year: int, plant_id: int, kpi_target_pairs: list) -> np.ndarray:
+    """
+    Reads the saved daily series of several (kpi_id, target_number) pairs of one plant
+    into a (len(pairs) x days) matrix, row i matching pairs[i]; missing days are 0.
+    """
+    matrix = np.zeros((len(kpi_target_pairs), get_year_calendar(year).days_in_year))
+    rows = get_daily_target_rows_for_kpis(year, plant_id, kpi_target_pairs)
+    if rows:
+        row_of = {pair: i for i, pair in enumerate(kpi_target_pairs)}
+        kpi_ids, target_numbers, day_idx, values = zip(*rows)
+        row_idx = [row_of[pair] for pair in zip(kpi_ids, target_numbers)]
+        matrix[row_idx, list(day_idx)] = np.array(values, dtype=float)
+    return matrix
+
+
+def calculate_and_save_repartitions_bulk(year: int, series: list, writer: PeriodicTargetWriter = None, force: bool = False) -> dict:
+    """
+    Batch repartition for many (plant_id, kpi_spec_id, target_number) series of one year.
+
+    Inputs are loaded with a handful of set-based queries. Rule-based series are
+    computed together as a (series x days) matrix per calculation type; formula-based
+    series are evaluated afterwards, ordered after their input KPIs, reading dependencies
+    from the batch before falling back to the database; each formula KPI is evaluated
+    once for all plants of the batch, as a (plants x days) matrix.
+
+    Every series is fingerprinted from its inputs; series whose fingerprint matches
+    the stored one are skipped unless force is True. A formula's fingerprint includes
+    its dependencies' fingerprints, which are computed first whatever the order of
+    series, so upstream changes still propagate.
+
+    When a writer is given the periodic rows are only queued on it and the caller
+    flushes; otherwise they are written before returning.
+    Returns {"repartitioned": n, "unchanged": m}.
+    """
+    series = list(dict.fromkeys(series))
+    if not series: return {"repartitioned": 0, "unchanged": 0}
+
+    cal = get_year_calendar(year)
+    entries = get_annual_target_entries_for_plants(year, {pid for pid, _, _ in series})
+    kpi_details_map = {k['id']: k for k in get_all_kpis_detailed()}
+    global_splits = get_global_splits_by_ids(e.get("global_split_id") for e in entries.values())
+    stored_fps = get_repartition_fingerprints(year, {pid for pid, _, _ in series})
+    new_fps = {}
+    unchanged = 0
+
+    rule_based = {app_config.CALC_TYPE_INCREMENTAL: [], app_config.CALC_TYPE_AVERAGE: []}
+    formula_based = []
+    calc_types = {}
+    for plant_id, kpi_spec_id, target_number in series:
+        target_info = entries.get((plant_id, kpi_spec_id))
+        if not target_info: continue
+
+        kpi_details = dict(kpi_details_map.get(kpi_spec_id) or {})
+        kpi_calc_type = kpi_details.get("calculation_type", app_config.CALC_TYPE_INCREMENTAL)
+
+        t_val_rec = next((tv for tv in target_info.get('target_values', []) if tv['target_number'] == target_number), None)
+        annual_target_to_use = float(t_val_rec['target_value']) if t_val_rec and t_val_rec['target_value'] is not None else None
+        if annual_target_to_use is None: continue
+
+        key = (plant_id, kpi_spec_id, target_number)
+        calc_types[key] = kpi_calc_type
+        if t_val_rec.get('is_formula_based', False) and (kpi_details.get("formula_json") or kpi_details.get("formula_string")):
+            formula_based.append((key, annual_target_to_use, kpi_details))
         else:
-            REPARTITION_LOGIC_YEAR = app_config.CALCULATION_CONSTANTS["REPARTITION_LOGIC_YEAR"]
-            PROFILE_ANNUAL_PROGRESSIVE = app_config.CALCULATION_CONSTANTS["PROFILE_ANNUAL_PROGRESSIVE"]
-            
-            logic = target_info.get("repartition_logic", REPARTITION_LOGIC_YEAR)
-            profile = target_info.get("distribution_profile") or kpi_details.get("default_distribution_profile") or PROFILE_ANNUAL_PROGRESSIVE
-            vals = json.loads(target_info.get("repartition_values", "{}") or "{}")
-            params = json.loads(target_info.get("profile_params", "{}") or "{}")
-
-        allocs = _get_period_allocations(annual_target_to_use, logic, vals, year, kpi_calc_type, all_dates)
-        raw_days = _get_raw_daily_values_for_repartition(year, annual_target_to_use, kpi_calc_type, profile, params, logic, allocs, all_dates)
-        
-        events = params.get("events", [])
-        final_daily_values = _apply_event_adjustments_to_daily_values(raw_days, events, kpi_calc_type, annual_target_to_use, all_dates)
-        final_daily_values = _reconcile_and_adjust_daily_values(final_daily_values, annual_target_to_use, kpi_calc_type)
+            gs = global_splits.get(target_info.get("global_split_id"))
+            settings = _resolve_repartition_settings(kpi_spec_id, target_info, kpi_details, gs)
+            fp = _repartition_fingerprint(calc_type=kpi_calc_type, annual=annual_target_to_use, settings=settings)
+            new_fps[key] = fp
+            if not force and stored_fps.get(key) == fp:
+                unchanged += 1
+                continue
+            bucket = rule_based.setdefault(kpi_calc_type, [])
+            bucket.append((key, annual_target_to_use, settings))
+
+    computed = {}
+
+    # --- RULE-BASED SPLITS (one matrix per calculation type) ---
+    for kpi_calc_type, rows in rule_based.items():
+        if not rows: continue
+        # Raw profiles scale linearly with the annual target, so distinct settings are
+        # computed once for a unit target and broadcast over the batch.
+        profile_slots, unit_profiles, slot_idx = {}, [], []
+        for _, _, (logic, profile, vals, params) in rows:
+            pk = (logic, profile, json.dumps(vals, sort_keys=True), json.dumps(params, sort_keys=True))
+            if pk not in profile_slots:
+                profile_slots[pk] = len(unit_profiles)
+                allocs = _get_period_allocations(1.0, logic, vals, year, kpi_calc_type, cal.dates)
+                unit_profiles.append(_get_raw_daily_values_for_repartition(year, 1.0, kpi_calc_type, profile, params, logic, allocs, cal.dates))
+            slot_idx.append(profile_slots[pk])
+
+        targets = np.array([annual for _, annual, _ in rows])
+        matrix = targets[:, None] * np.vstack(unit_profiles)[slot_idx]
+
+        # Rows sharing the same event calendar are adjusted together
+        event_groups = {}
+        for i, (_, _, (_, _, _, params)) in enumerate(rows):
+            events = params.get("events", [])
+            if events:
+                event_groups.setdefault(json.dumps(events, sort_keys=True), (events, []))[1].append(i)
+        for events, idx in event_groups.values():
+            matrix[idx] = _apply_event_adjustments_to_daily_values(matrix[idx], events, kpi_calc_type, targets[idx], year)
+        matrix = _reconcile_and_adjust_daily_values(matrix, targets, kpi_calc_type)
+
+        for i, (key, _, _) in enumerate(rows):
+            computed[key] = matrix[i]
 
-    # --- Save ---
-    _aggregate_and_save_periodic_targets(list(zip(all_dates, final_daily_values)), year, plant_id, kpi_spec_id, target_number, kpi_calc_type)
+    # --- ON-THE-FLY FORMULA LOGIC ---
+    # One group per (kpi, target) over its plants, with KPIs ordered after their inputs so
+    # that both fingerprints and evaluations see this batch's upstream results first
+    formula_groups = {}
+    for key, annual_target_to_use, kpi_details in formula_based:
+        plant_id, kpi_spec_id, target_number = key
+        formula_groups.setdefault((kpi_spec_id, target_number), (kpi_details, []))[1].append((plant_id, annual_target_to_use))
+    group_deps = {gk: {(d['kpi_id'], d['target_num']) for d in _get_formula_dependencies(details, gk[1])[1]}
+                  for gk, (details, _) in formula_groups.items()}
+    group_order, cyclic = topological_order(formula_groups, lambda gk: group_deps[gk])
+
+    to_evaluate, dep_keys_needed = {}, set()
+    for gk in group_order + cyclic:
+        kpi_details, plants = formula_groups[gk]
+        kpi_spec_id, target_number = gk
+        for plant_id, annual_target_to_use in plants:
+            key = (plant_id, kpi_spec_id, target_number)
+            dep_keys = sorted((plant_id, *dep) for dep in group_deps[gk])
+            fp = _repartition_fingerprint(
+                calc_type=calc_types[key], annual=annual_target_to_use, target_number=target_number,
+                formula_json=kpi_details.get("formula_json"), formula_string=kpi_details.get("formula_string"),
+                dependencies=[(dk, new_fps.get(dk, stored_fps.get(dk))) for dk in dep_keys],
+            )
+            new_fps[key] = fp
+            if not force and stored_fps.get(key) == fp:
+                unchanged += 1
+                continue
+            to_evaluate.setdefault(gk, []).append((plant_id, annual_target_to_use))
+            dep_keys_needed.update(dep_keys)
+
+    # Dependencies not produced by this batch are read from the database, one query per plant
+    evaluated_keys = {(plant_id, *gk) for gk, plants in to_evaluate.items() for plant_id, _ in plants}
+    stored_deps = {}
+    for plant_id in {dk[0] for dk in dep_keys_needed}:
+        pairs = [dk[1:] for dk in dep_keys_needed if dk[0] == plant_id and dk not in computed and dk not in evaluated_keys]
+        if not pairs: continue
+        matrix = _load_stored_daily_matrix(year, plant_id, pairs)
+        stored_deps.update({(plant_id, *pair): matrix[i] for i, pair in enumerate(pairs)})
+
+    zeros = np.zeros(cal.days_in_year)
+    def dep_loader(plant_id, kpi_id, target_number):
+        dk = (plant_id, kpi_id, target_number)
+        arr = computed.get(dk)
+        return arr if arr is not None else stored_deps.get(dk, zeros)
+
+    # One evaluation per (kpi, target) over all its plants that need it
+    for gk in group_order + cyclic:
+        plants = to_evaluate.get(gk)
+        if not plants: continue
+        kpi_details = formula_groups[gk][0]
+        kpi_spec_id, target_number = gk
+        plant_ids = [plant_id for plant_id, _ in plants]
+        print(f"    INFO: Calculating on-the-fly periodic values for KPI {kpi_spec_id} ({len(plant_ids)} plant(s))...")
+        calculated_days = _calculate_formula_daily_values(year, plant_ids, kpi_spec_id, target_number, kpi_details, dep_loader)
+        calc_type = calc_types[(plant_ids[0], kpi_spec_id, target_number)]
+        calculated_days = _reconcile_and_adjust_daily_values(calculated_days, np.array([annual for _, annual in plants]), calc_type)
+        for i, plant_id in enumerate(plant_ids):
+            computed[(plant_id, kpi_spec_id, target_number)] = calculated_days[i]
+
+    # --- Save (one batch per calculation type, one transaction overall) ---
+    own_writer = writer is None
+    if own_writer: writer = PeriodicTargetWriter()
+    for kpi_calc_type in set(calc_types[key] for key in computed):
+        keys = [key for key in computed if calc_types[key] == kpi_calc_type]
+        _aggregate_and_save_periodic_targets(np.vstack([computed[key] for key in keys]), year, keys, kpi_calc_type, writer)
+    for key in computed:
+        writer.set_fingerprint(year, *key, new_fps[key])
+    if own_writer: writer.flush()
+
+    if unchanged:
+        print(f"    INFO: Skipped repartition of {unchanged} unchanged series for {year}.")
+    return {"repartitioned": len(computed), "unchanged": unchanged}
+
+
+def calculate_and_save_all_repartitions(year: int, plant_id: int, kpi_spec_id: int, target_number: int, force: bool = False):
+    """Orchestrates periodic repartition with support for On-the-fly formula logic."""
+    calculate_and_save_repartitions_bulk(year, [(plant_id, kpi_spec_id, target_number)], force=force)
@@ -0,0 +1,175 @@
+# src/target_management/snapshot.py
+import sqlite3
+
+from src.data_access.connections import db_connection
+from src import data_retriever as db_retriever
+
+
+def _annual_target_columns(conn) -> set:
+    """Column names of annual_targets (older databases lack the legacy target columns)."""
+    return {r[1] for r in conn.execute("PRAGMA table_info(annual_targets)")}
+
+
+# annual_targets columns a save may set, besides year/plant_id/kpi_id
+SETTING_FIELDS = ("repartition_logic", "repartition_values", "distribution_profile", "profile_params", "global_split_id")
+TARGET_VALUE_FIELDS = ("target_value", "is_manual", "is_formula_based", "formula", "formula_inputs")
+
+
+def _settings_of(entry: dict) -> tuple:
+    return tuple(entry.get(f) for f in SETTING_FIELDS)
+
+
+def _values_of(target_value: dict) -> tuple:
+    return tuple(target_value.get(f) for f in TARGET_VALUE_FIELDS)
+
+
+class AnnualTargetSnapshot:
+    """
+    In-memory, kpi-indexed copy of one plant/year's annual targets and target values,
+    loaded with two queries, that doubles as the unit of work of a save.
+
+    Saved inputs and computed formula values are staged into it (so formula resolution
+    sees them immediately) and diffed against what was loaded; flush() then writes only
+    the rows that actually changed, with executemany upserts in one transaction.
+    """
+
+    def __init__(self, year: int, plant_id: int, entries: dict):
+        self.year = year
+        self.plant_id = plant_id
+        self.entries = entries  # kpi_id -> enriched annual target entry
+        self._new_entries = {}  # kpi_id -> None, ordered set of rows to insert
+        self._changed_entries = {}  # kpi_id -> None, existing rows with new settings
+        self._dirty_values = {}  # (kpi_id, target_number) -> None
+        # Loaded state, so a value staged and later restored (e.g. a formula target
+        # recomputed to what was stored) does not count as a change
+        self._loaded_settings = {kpi_id: _settings_of(e) for kpi_id, e in entries.items()}
+        self._loaded_values = {(kpi_id, tv['target_number']): _values_of(tv)
+                               for kpi_id, e in entries.items() for tv in e['target_values']}
+
+    @classmethod
+    def load(cls, year: int, plant_id: int) -> "AnnualTargetSnapshot":
+        entries = db_retriever.get_annual_target_entries_for_plants(year, [plant_id])
+        return cls(year, plant_id, {kpi_id: entry for (_, kpi_id), entry in entries.items()})
+
+    def entry(self, kpi_id: int):
+        return self.entries.get(kpi_id)
+
+    def target_value_record(self, kpi_id: int, target_number: int):
+        entry = self.entries.get(kpi_id)
+        if not entry: return None
+        return next((tv for tv in entry['target_values'] if tv['target_number'] == target_number), None)
+
+    def _prune_unchanged(self):
+        """Drops staged rows that ended up equal to the loaded state."""
+        self._changed_entries = {k: None for k in self._changed_entries
+                                 if _settings_of(self.entries[k]) != self._loaded_settings.get(k)}
+        self._dirty_values = {key: None for key in self._dirty_values
+                              if _values_of(self.target_value_record(*key)) != self._loaded_values.get(key)}
+
+    @property
+    def changed_kpi_ids(self) -> set:
+        """KPIs whose settings or target values differ from the loaded state."""
+        self._prune_unchanged()
+        return set(self._new_entries) | set(self._changed_entries) | {kpi_id for kpi_id, _ in self._dirty_values}
+
+    def stage_entry(self, kpi_id: int, settings: dict) -> bool:
+        """
+        Creates the annual_targets row of a KPI, or updates its split settings (keys of
+        SETTING_FIELDS). Returns True if anything differs from the stored state.
+        """
+        entry = self.entries.get(kpi_id)
+        if entry is None:
+            self.entries[kpi_id] = {"id": None, "year": self.year, "plant_id": self.plant_id, "kpi_id": kpi_id,
+                                    **{f: settings.get(f) for f in SETTING_FIELDS}, "target_values": []}
+            self._new_entries[kpi_id] = None
+            return True
+        if all(entry.get(f) == v for f, v in settings.items()):
+            return False
+        entry.update(settings)
+        if kpi_id not in self._new_entries:
+            self._changed_entries[kpi_id] = None
+        return True
+
+    def stage_target_value(self, kpi_id: int, target_number: int, target_value, is_manual: int,
+                           is_formula_based: int, formula, formula_inputs) -> bool:
+        """Sets one target value of a staged KPI. Returns True if it differs from the stored state."""
+        new_values = dict(zip(TARGET_VALUE_FIELDS, (target_value, is_manual, is_formula_based, formula, formula_inputs)))
+        entry = self.entries[kpi_id]
+        rec = self.target_value_record(kpi_id, target_number)
+        if rec is None:
+            entry['target_values'].append({"target_number": target_number, **new_values})
+            entry['target_values'].sort(key=lambda tv: tv['target_number'])
+        elif all(rec.get(f) == v for f, v in new_values.items()):
+            return False
+        else:
+            rec.update(new_values)
+
+        entry[f'annual_target{target_number}'] = target_value
+        entry[f'is_target{target_number}_manual'] = is_manual
+        entry[f'target{target_number}_is_formula_based'] = is_formula_based
+        entry[f'target{target_number}_formula'] = formula
+        entry[f'target{target_number}_formula_inputs'] = formula_inputs
+        self._dirty_values[(kpi_id, target_number)] = None
+        return True
+
+    def set_computed_value(self, kpi_id: int, target_number: int, value: float) -> bool:
+        """Stores a formula result (as a non-manual value) until flush(). Returns True if it changed."""
+        rec = self.target_value_record(kpi_id, target_number)
+        if rec is None:
+            raise KeyError(f"No target {target_number} for KPI {kpi_id} (Year: {self.year}, Plant: {self.plant_id})")
+        return self.stage_target_value(kpi_id, target_number, value, 0, rec['is_formula_based'], rec['formula'], rec['formula_inputs'])
+
+    def flush(self):
+        """Writes the staged changes in a single transaction; unchanged rows are not touched."""
+        self._prune_unchanged()
+        if not (self._new_entries or self._changed_entries or self._dirty_values): return
+        settings_cols = ", ".join(SETTING_FIELDS)
+        with db_connection("db_kpi_targets.db") as conn:
+            try:
+                with conn:
+                    if self._new_entries:
+                        conn.executemany(
+                            f"INSERT INTO annual_targets (year, plant_id, kpi_id, {settings_cols}) VALUES (?,?,?,{','.join('?' for _ in SETTING_FIELDS)})",
+                            [(self.year, self.plant_id, kpi_id, *(self.entries[kpi_id][f] for f in SETTING_FIELDS)) for kpi_id in self._new_entries],
+                        )
+                        ids = dict(conn.execute("SELECT kpi_id, id FROM annual_targets WHERE year=? AND plant_id=?", (self.year, self.plant_id)))
+                        for kpi_id in self._new_entries:
+                            self.entries[kpi_id]['id'] = ids[kpi_id]
+                    if self._changed_entries:
+                        conn.executemany(
+                            f"UPDATE annual_targets SET {', '.join(f'{f}=?' for f in SETTING_FIELDS)} WHERE id=?",
+                            [(*(self.entries[kpi_id][f] for f in SETTING_FIELDS), self.entries[kpi_id]['id']) for kpi_id in self._changed_entries],
+                        )
+                    value_rows = []
+                    for kpi_id, tn in self._dirty_values:
+                        rec = self.target_value_record(kpi_id, tn)
+                        value_rows.append((self.entries[kpi_id]['id'], tn, *(rec[f] for f in TARGET_VALUE_FIELDS)))
+                    conn.executemany("""
+                        INSERT INTO kpi_annual_target_values
+                        (annual_target_id, target_number, target_value, is_manual, is_formula_based, formula, formula_inputs)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(annual_target_id, target_number) DO UPDATE SET
+                        target_value=excluded.target_value,
+                        is_manual=excluded.is_manual,
+                        is_formula_based=excluded.is_formula_based,
+                        formula=excluded.formula,
+                        formula_inputs=excluded.formula_inputs
+                    """, value_rows)
+
+                    # Keep the legacy per-target columns in sync where the table still has them
+                    columns = _annual_target_columns(conn)
+                    for tn in (1, 2):
+                        legacy_cols = [f"annual_target{tn}", f"is_target{tn}_manual", f"target{tn}_is_formula_based", f"target{tn}_formula", f"target{tn}_formula_inputs"]
+                        if not columns.issuperset(legacy_cols): continue
+                        conn.executemany(
+                            f"UPDATE annual_targets SET {', '.join(f'{c}=?' for c in legacy_cols)} WHERE id=?",
+                            [(*row[2:], row[0]) for row in value_rows if row[1] == tn],
+                        )
+            except sqlite3.Error as e:
+                print(f"ERROR: Failed to save annual targets (Year: {self.year}, Plant: {self.plant_id}): {e}")
+                raise
+        self._loaded_settings.update({k: _settings_of(self.entries[k]) for k in (*self._new_entries, *self._changed_entries)})
+        self._loaded_values.update({key: _values_of(self.target_value_record(*key)) for key in self._dirty_values})
+        self._new_entries = {}
+        self._changed_entries = {}
+        self._dirty_values = {}
@@ -1,6 +1,7 @@
 import numpy as np
 import datetime
 import calendar
+from functools import lru_cache
 
 def get_weighted_proportions(num_periods, initial_factor=1.5, final_factor=0.5, decreasing=True):
     """
@@ -81,3 +82,68 @@ def get_date_ranges_for_quarters(year):
         end_date = datetime.date(year, end_month, calendar.monthrange(year, end_month)[1])
         quarter_ranges[q] = (start_date, end_date)
     return quarter_ranges
+
+
+class YearCalendar:
+    """
+    Day-indexed calendar for a single year, expressed as NumPy arrays.
+    Index ``i`` in every array refers to the i-th day of the year (Jan 1 = 0),
+    so repartition profiles and period lookups become plain array operations.
+    Instances are shared through get_year_calendar, so arrays are read-only and
+    label sequences are tuples.
+    """
+    def __init__(self, year: int):
+        self.year = year
+        start = np.datetime64(f"{year:04d}-01-01")
+        end = np.datetime64(f"{year + 1:04d}-01-01")
+        days64 = np.arange(start, end, dtype="datetime64[D]")
+
+        self.days_in_year = len(days64)
+        self.day_of_year = np.arange(self.days_in_year)
+        self.dates = tuple(datetime.date(year, 1, 1) + datetime.timedelta(days=i) for i in range(self.days_in_year))
+        self.iso_dates = tuple(d.isoformat() for d in self.dates)
+
+        # Month (0-11) and quarter (0-3) of each day
+        self.month_index = days64.astype("datetime64[M]").astype(np.int64) % 12
+        self.quarter_index = self.month_index // 3
+        # Weekday with Monday=0 (1970-01-01 was a Thursday)
+        self.weekday = (days64.astype(np.int64) + 3) % 7
+
+        # ISO weeks: keys like "2025-W01", in calendar order, and the week slot of each day
+        iso_keys = [f"{d.isocalendar()[0]:04d}-W{d.isocalendar()[1]:02d}" for d in self.dates]
+        self.week_keys = tuple(sorted(set(iso_keys)))
+        week_pos = {wk: i for i, wk in enumerate(self.week_keys)}
+        self.week_index = np.array([week_pos[wk] for wk in iso_keys], dtype=np.int64)
+
+        # Days per period
+        self.days_per_month = np.bincount(self.month_index, minlength=12)
+        self.days_per_quarter = np.bincount(self.quarter_index, minlength=4)
+        self.days_per_week = np.bincount(self.week_index, minlength=len(self.week_keys))
+
+        # First day index of each period, for np.add.reduceat over contiguous periods
+        self.month_starts = np.concatenate(([0], np.cumsum(self.days_per_month)[:-1]))
+        self.quarter_starts = np.concatenate(([0], np.cumsum(self.days_per_quarter)[:-1]))
+        self.week_starts = np.concatenate(([0], np.cumsum(self.days_per_week)[:-1]))
+
+        for arr in (self.day_of_year, self.month_index, self.quarter_index, self.weekday,
+                    self.week_index, self.days_per_month, self.days_per_quarter, self.days_per_week,
+                    self.month_starts, self.quarter_starts, self.week_starts):
+            arr.setflags(write=False)
+
+    def per_month(self, values_by_month: dict, default: float = 0.0) -> np.ndarray:
+        """Expands a {month_idx (0-11): value} map to a daily array."""
+        return np.array([values_by_month.get(m, default) for m in range(12)], dtype=float)[self.month_index]
+
+    def per_quarter(self, values_by_quarter: dict, default: float = 0.0) -> np.ndarray:
+        """Expands a {quarter_idx (0-3): value} map to a daily array."""
+        return np.array([values_by_quarter.get(q, default) for q in range(4)], dtype=float)[self.quarter_index]
+
+    def per_week(self, values_by_week: dict, default: float = 0.0) -> np.ndarray:
+        """Expands a {"YYYY-Www": value} map to a daily array."""
+        return np.array([values_by_week.get(wk, default) for wk in self.week_keys], dtype=float)[self.week_index]
+
+
+@lru_cache(maxsize=16)
+def get_year_calendar(year: int) -> YearCalendar:
+    """Returns the cached YearCalendar for a given year."""
+    return YearCalendar(year)